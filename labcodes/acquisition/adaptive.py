@@ -0,0 +1,328 @@
+"""
+Adaptive search for resonances with a VNA.
+
+Instead of one long sweep with a fine point spacing and a narrow IF
+bandwidth over the whole range, AdaptiveResonanceSweep
+
+    1. takes a coarse, fast sweep over the whole range,
+    2. looks for features (dips and steep phase changes) in it, see
+       find_features,
+    3. zooms into every feature with narrow, high resolution sweeps, and
+       repeats 2. and 3. on the zoomed data if refine_levels > 1,
+
+and merges all data into one dataset with non-uniform frequency points.
+The zoom sweeps of one level are taken as a single segmented sweep where
+the driver supports it (see load_segments), otherwise one after another.
+
+Works with both VNA drivers (labcodes.drivers.MS46522B and
+labcodes.drivers.N52xx_modified_for_Keysight_P9373A).
+"""
+
+import logging
+import time
+from typing import Any, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from labcodes.drivers.segments import Segment, power_chunks
+
+logger = logging.getLogger()
+
+
+class Feature(NamedTuple):
+    """
+    A feature found in a sweep: its frequency, an estimate of its width and
+    its score (in units of the noise of the detection signal)
+    """
+    frequency: float
+    width: float
+    score: float
+
+
+class SweepRecord(NamedTuple):
+    """
+    One sweep taken by the engine: its level (0 for the coarse sweep),
+    number of points, IF bandwidth and duration in seconds
+    """
+    level: int
+    points: int
+    if_bandwidth: float
+    duration: float
+
+
+class AdaptiveSweepResult(NamedTuple):
+    """
+    Result of an adaptive sweep.
+
+    frequencies and data are the merged, sorted data of all sweeps: within
+    the zoom windows the zoomed data replace the coarser data.
+    """
+    frequencies: np.ndarray
+    data: np.ndarray
+    features: List[Feature]
+    sweeps: List[SweepRecord]
+
+
+def _robust_zscore(values: np.ndarray) -> np.ndarray:
+    median = np.median(values)
+    mad = np.median(np.abs(values - median))
+    if mad == 0:
+        mad = np.finfo(float).eps
+    return (values - median) / (1.4826 * mad)
+
+
+def find_features(frequencies: np.ndarray,
+                  data: np.ndarray,
+                  threshold: float = 6.,
+                  min_width: Optional[float] = None) -> List[Feature]:
+    """
+    Find resonance-like features in complex trace data.
+
+    A point is part of a feature if the derivative of the magnitude (in dB)
+    or of the phase (with the linear phase of the cable delay removed)
+    deviates from its median by more than threshold times the robust
+    standard deviation. Neighbouring points above the threshold form one
+    feature.
+
+    Args:
+        frequencies: frequencies of the points, in increasing order
+        data: complex trace data
+        threshold: detection threshold
+        min_width: lower bound of the width estimate, by default four
+            times the mean point spacing
+
+    Returns:
+        the features, strongest first
+    """
+    frequencies = np.asarray(frequencies, dtype=float)
+    data = np.asarray(data)
+    if len(frequencies) < 5:
+        return []
+    steps = np.diff(frequencies)
+    if min_width is None:
+        min_width = 4 * float(np.mean(steps))
+    magnitude = 20 * np.log10(np.abs(data) + np.finfo(float).tiny)
+    phase = np.unwrap(np.angle(data))
+    # remove the linear phase of the cable delay
+    phase = phase - np.polyval(np.polyfit(frequencies, phase, 1),
+                               frequencies)
+    midpoints = (frequencies[1:] + frequencies[:-1]) / 2
+    score = np.maximum(np.abs(_robust_zscore(np.diff(magnitude) / steps)),
+                       np.abs(_robust_zscore(np.diff(phase) / steps)))
+    above = score > threshold
+    features = []
+    # indices where runs of points above the threshold start and end
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], above.view(np.int8),
+                                                   [0]))))
+    for first, last in zip(edges[0::2], edges[1::2]):
+        peak = first + int(np.argmax(score[first:last]))
+        width = max(midpoints[last - 1] - midpoints[first], min_width)
+        features.append(Feature(float(midpoints[peak]), float(width),
+                                float(score[peak])))
+    features.sort(key=lambda feature: feature.score, reverse=True)
+    return features
+
+
+def merge_windows(features: Sequence[Feature],
+                  span_factor: float,
+                  min_span: float,
+                  start: float,
+                  stop: float) -> List[Tuple[float, float]]:
+    """
+    Frequency windows around features, span_factor times their width but
+    at least min_span wide, clipped to start and stop and with overlapping
+    windows merged
+    """
+    windows = []  # type: List[Tuple[float, float]]
+    for feature in sorted(features, key=lambda feature: feature.frequency):
+        half = max(span_factor * feature.width, min_span) / 2
+        low = max(start, feature.frequency - half)
+        high = min(stop, feature.frequency + half)
+        if windows and low <= windows[-1][1]:
+            windows[-1] = (windows[-1][0], max(high, windows[-1][1]))
+        else:
+            windows.append((low, high))
+    return windows
+
+
+class AdaptiveResonanceSweep:
+    """
+    Coarse-to-fine search for resonances, see the module docstring.
+
+    Args:
+        vna: VNA instrument (root instrument of either driver)
+        trace: trace to measure, the first trace by default
+        coarse_points: points of the coarse sweep
+        coarse_if_bandwidth: IF bandwidth of the coarse sweep
+        zoom_points: points of every zoom window
+        zoom_if_bandwidth: IF bandwidth of the zoom sweeps
+        span_factor: span of a zoom window in units of the feature width
+        threshold: detection threshold, see find_features
+        max_features: at most this many (strongest) features are zoomed into
+            per level
+        refine_levels: number of zoom levels
+        use_segments: take the zoom sweeps of a level as one segmented
+            sweep, if the driver supports it
+    """
+
+    def __init__(self,
+                 vna: Any,
+                 trace: Optional[Any] = None,
+                 coarse_points: int = 2001,
+                 coarse_if_bandwidth: float = 1000.,
+                 zoom_points: int = 201,
+                 zoom_if_bandwidth: float = 10.,
+                 span_factor: float = 3.,
+                 threshold: float = 6.,
+                 max_features: int = 50,
+                 refine_levels: int = 1,
+                 use_segments: bool = True) -> None:
+        self.vna = vna
+        self.trace = vna.traces[0] if trace is None else trace
+        self.coarse_points = coarse_points
+        self.coarse_if_bandwidth = coarse_if_bandwidth
+        self.zoom_points = zoom_points
+        self.zoom_if_bandwidth = zoom_if_bandwidth
+        self.span_factor = span_factor
+        self.threshold = threshold
+        self.max_features = max_features
+        self.refine_levels = refine_levels
+        self.use_segments = use_segments and hasattr(vna, 'load_segments')
+
+    def run(self, start: float, stop: float) -> AdaptiveSweepResult:
+        """
+        Search start to stop for resonances. The sweep settings of the
+        instrument are restored afterwards.
+        """
+        vna = self.vna
+        settings = (vna.start(), vna.stop(), vna.points(),
+                    vna.if_bandwidth())
+        sweep_type = vna.sweep_type() if self.use_segments else None
+        segment_table = vna.segment_table if self.use_segments else None
+        sweeps = []  # type: List[SweepRecord]
+        try:
+            frequencies, data = self._linear_sweep(
+                start, stop, self.coarse_points, self.coarse_if_bandwidth, 0,
+                sweeps)
+            # (frequencies, data, windows) of every level, coarsest first
+            levels = [(frequencies, data, [(start, stop)])]
+            features = []  # type: List[Feature]
+            for level in range(1, self.refine_levels + 1):
+                level_features = []  # type: List[Feature]
+                for low, high in levels[-1][2]:
+                    inside = (levels[-1][0] >= low) & (levels[-1][0] <= high)
+                    level_features += find_features(levels[-1][0][inside],
+                                                    levels[-1][1][inside],
+                                                    self.threshold)
+                level_features.sort(key=lambda feature: feature.score,
+                                    reverse=True)
+                level_features = level_features[:self.max_features]
+                if not level_features:
+                    break
+                features = level_features
+                # zoom windows span at least four points of the last level
+                spacing = float(np.median(np.diff(levels[-1][0])))
+                windows = merge_windows(features, self.span_factor,
+                                        4 * spacing, start, stop)
+                logger.debug("adaptive sweep level %d: %d features, %d "
+                             "windows", level, len(features), len(windows))
+                frequencies, data = self._zoom(windows, level, sweeps)
+                levels.append((frequencies, data, windows))
+        finally:
+            if sweep_type is not None:
+                if segment_table is not None:
+                    vna.load_segments(segment_table)
+                vna.sweep_type(sweep_type)
+            self._set_sweep(*settings)
+        frequencies, data = self._merge(levels)
+        return AdaptiveSweepResult(frequencies, data, features, sweeps)
+
+    def _linear_sweep(self,
+                      start: float,
+                      stop: float,
+                      points: int,
+                      if_bandwidth: float,
+                      level: int,
+                      sweeps: List[SweepRecord]
+                      ) -> Tuple[np.ndarray, np.ndarray]:
+        vna = self.vna
+        if self.use_segments and vna.sweep_geometry.segmented:
+            vna.sweep_type('LIN')
+        self._set_sweep(start, stop, points, if_bandwidth)
+        t_start = time.perf_counter()
+        self.trace.run_sweep()
+        data = self.trace.sweep_data()
+        sweeps.append(SweepRecord(level, points, if_bandwidth,
+                                  time.perf_counter() - t_start))
+        return np.array(vna.sweep_geometry.frequencies), data
+
+    def _set_sweep(self,
+                   start: float,
+                   stop: float,
+                   points: int,
+                   if_bandwidth: float) -> None:
+        """
+        Set the linear sweep with one message. The stop frequency goes
+        first if the new start is not below the current stop, so that the
+        instrument never sees a start above the stop.
+        """
+        if start < self.vna.stop():
+            self.vna.configure(start=start, stop=stop, points=points,
+                               if_bandwidth=if_bandwidth)
+        else:
+            self.vna.configure(stop=stop, start=start, points=points,
+                               if_bandwidth=if_bandwidth)
+
+    def _zoom(self,
+              windows: Sequence[Tuple[float, float]],
+              level: int,
+              sweeps: List[SweepRecord]) -> Tuple[np.ndarray, np.ndarray]:
+        if not self.use_segments:
+            results = [self._linear_sweep(low, high, self.zoom_points,
+                                          self.zoom_if_bandwidth, level,
+                                          sweeps)
+                       for low, high in windows]
+            return (np.concatenate([result[0] for result in results]),
+                    np.concatenate([result[1] for result in results]))
+        vna = self.vna
+        segments = [Segment(low, high, self.zoom_points,
+                            self.zoom_if_bandwidth)
+                    for low, high in windows]
+        frequencies = []
+        data = []
+        # as many windows per segmented sweep as the instrument allows
+        for chunk in power_chunks(len(segments), self.zoom_points,
+                                  vna.MAX_POINTS, vna.MAX_SEGMENTS):
+            vna.load_segments(segments[chunk])
+            vna.sweep_type(vna.SEGMENTED_SWEEP_TYPE)
+            t_start = time.perf_counter()
+            self.trace.run_sweep()
+            data.append(self.trace.sweep_data())
+            sweeps.append(SweepRecord(level, len(data[-1]),
+                                      self.zoom_if_bandwidth,
+                                      time.perf_counter() - t_start))
+            frequencies.append(np.array(vna.sweep_geometry.frequencies))
+        return np.concatenate(frequencies), np.concatenate(data)
+
+    @staticmethod
+    def _merge(levels: Sequence[Tuple[np.ndarray, np.ndarray,
+                                      Sequence[Tuple[float, float]]]]
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Merge the data of all levels: the points of a level within the
+        windows of a finer level are dropped
+        """
+        frequencies = []
+        data = []
+        for index, (level_frequencies, level_data, _) in enumerate(levels):
+            keep = np.ones(len(level_frequencies), dtype=bool)
+            if index + 1 < len(levels):
+                for low, high in levels[index + 1][2]:
+                    keep &= ~((level_frequencies >= low)
+                              & (level_frequencies <= high))
+            frequencies.append(level_frequencies[keep])
+            data.append(level_data[keep])
+        frequencies = np.concatenate(frequencies)
+        data = np.concatenate(data)
+        order = np.argsort(frequencies, kind='stable')
+        return frequencies[order], data[order]
@@ -0,0 +1,511 @@
+"""
+Benchmark of the acquisition paths of the VNA drivers.
+
+run_benchmarks times the loops of the measurement scripts against a real
+or a simulated VNA (see labcodes.drivers.simulated_vna), for every
+combination of number of points, number of traces and transfer format:
+
+    'power_sweep':  the power list swept by the instrument with
+                    vna.power_sweep, and every sweep stored with a
+                    SweepWriter, as in record_S21_sweep_power_sweep_frequency
+                    (there run_pipelined overlaps the sweeps with storing;
+                    here the stages run one after another). One iteration
+                    is one power list, of the first trace only.
+    'power_loop':   one sweep per power set from Python, every trace read
+                    on its own, as in the sweep loop of earlier versions of
+                    record_S21_sweep_power_sweep_frequency
+    'screen':       all traces of a sweep read at once with get_all_traces,
+                    as in take_screen_anritsu_all_traces
+
+Every iteration of a loop is split into the stages
+
+    parameter_set:  setting instrument parameters (the power)
+    sweep_wait:     triggering the sweep and waiting for it to finish
+                    (for power_sweep: everything in vna.power_sweep but the
+                    transfer, i.e. also the segment table with the powers)
+    transfer:       querying the data and reading the response (the time
+                    recorded in the instrument's transfer_stats)
+    decode:         the rest of fetching the data (decoding the blocks,
+                    selecting traces) and deriving the formats
+    db_write:       datasaver.add_result into a temporary qcodes database
+    export:         writing the data to a text file
+
+and the report lists mean and percentiles of every stage and of whole
+iterations, and the throughput in sweeps and points per second. The
+report is a JSON-serializable dict, so results can be compared between
+versions, e.g.
+
+    python -m labcodes.acquisition.benchmark --simulate keysight \\
+        --output benchmark.json
+
+import_times times the imports of the labcodes modules used in notebooks,
+each in a fresh interpreter, and records which of the slow dependencies
+(qcodes, pyvisa, matplotlib, h5py) each import loads. These need no VNA:
+
+    python -m labcodes.acquisition.benchmark --imports \\
+        --output import_times.json
+"""
+
+import contextlib
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+from labcodes.drivers.sweep_data import derive_format
+
+logger = logging.getLogger()
+
+STAGES = ('parameter_set', 'sweep_wait', 'transfer', 'decode', 'db_write',
+          'export')
+SCENARIOS = ('power_sweep', 'power_loop', 'screen')
+# powers per iteration of the power_sweep scenario, by default
+POWER_SWEEP_POWERS = 5
+PERCENTILES = (50, 90, 99)
+
+# imports timed by import_times
+IMPORTS = ('labcodes', 'labcodes.drivers',
+           'labcodes.misc_scripts.keysight.keysight_measurement',
+           'labcodes.misc_scripts.anritsu.anritsu_measurement',
+           'labcodes.misc_scripts.combined.combined_measurement',
+           'labcodes.drivers.simulated_vna',
+           'labcodes.drivers.Keysight_P9373A',
+           'labcodes.drivers.Anritsu_MS46522B',
+           'labcodes.acquisition.plotting')
+# dependencies that make an import slow
+HEAVY_MODULES = ('qcodes', 'pyvisa', 'matplotlib', 'h5py', 'numpy')
+
+_IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds,
+                  'loaded': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+# formats stored per trace, as in the measurement scripts
+STORED_FORMATS = (('magnitude', 'MLOG'), ('phase', 'PHAS'),
+                  ('real', 'REAL'), ('imaginary', 'IMAG'))
+
+
+class BenchmarkCase(NamedTuple):
+    """
+    One configuration to benchmark
+    """
+    scenario: str
+    points: int
+    traces: int
+    transfer_format: str
+
+
+class StageTimer:
+    """
+    Collects the duration of every stage of every iteration of a loop.
+    A stage may be entered several times per iteration, its durations are
+    summed.
+    """
+
+    def __init__(self) -> None:
+        self.iterations = []  # type: List[Dict[str, float]]
+
+    def next_iteration(self) -> None:
+        self.iterations.append(dict.fromkeys(STAGES, 0.))
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.iterations[-1][name] += time.perf_counter() - t_start
+
+    def add(self, name: str, duration: float) -> None:
+        self.iterations[-1][name] += duration
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Statistics in seconds of every stage and of whole iterations
+        """
+        stages = {name: _statistics([iteration[name]
+                                     for iteration in self.iterations])
+                  for name in STAGES}
+        return {'stages': stages,
+                'iteration': _statistics([sum(iteration.values())
+                                          for iteration in self.iterations])}
+
+
+def _statistics(values: Sequence[float]) -> Dict[str, float]:
+    values = np.asarray(values, dtype=float)
+    statistics = {'total': float(np.sum(values)),
+                  'mean': float(np.mean(values))}
+    for percentile, value in zip(PERCENTILES,
+                                 np.percentile(values, PERCENTILES)):
+        statistics['p{}'.format(percentile)] = float(value)
+    return statistics
+
+
+def _transfer_seconds(vna: Any) -> float:
+    return sum(stats['seconds']
+               for stats in vna.transfer_stats.summary().values())
+
+
+class _Fetch:
+    """
+    Times fetching data, splitting off the transfer time recorded by the
+    driver from the rest (by default decode)
+    """
+
+    def __init__(self, vna: Any, timer: StageTimer,
+                 rest: str = 'decode') -> None:
+        self.vna = vna
+        self.timer = timer
+        self.rest = rest
+
+    def __enter__(self) -> None:
+        self.t_start = time.perf_counter()
+        self.transferred = _transfer_seconds(self.vna)
+
+    def __exit__(self, *exc: Any) -> None:
+        duration = time.perf_counter() - self.t_start
+        transfer = _transfer_seconds(self.vna) - self.transferred
+        self.timer.add('transfer', transfer)
+        self.timer.add(self.rest, duration - transfer)
+
+
+def benchmark_case(vna: Any,
+                   case: BenchmarkCase,
+                   repetitions: int,
+                   directory: str,
+                   powers: Optional[Sequence[float]] = None
+                   ) -> Dict[str, Any]:
+    """
+    Run the loop of one case repetitions times.
+
+    Args:
+        vna: VNA instrument (root instrument of either driver)
+        case: the configuration to run
+        repetitions: number of iterations
+        directory: directory for the database and the exported files
+        powers: powers of the power_loop scenario, cycled through, and
+            the power list of every iteration of the power_sweep scenario.
+            By default the current power (POWER_SWEEP_POWERS times for
+            power_sweep).
+
+    Returns:
+        the statistics of the case, see the module docstring
+    """
+    from qcodes.dataset.measurements import Measurement
+
+    from labcodes.acquisition.storage import SweepWriter
+
+    traces = list(vna.traces)[:case.traces]
+    t_start = time.perf_counter()
+    vna.points(case.points)
+    vna.transfer_format(case.transfer_format)
+    # the setpoints are queried once, not in the loop
+    frequencies = np.array(vna.sweep_geometry.frequencies)
+    setup = time.perf_counter() - t_start
+    if powers is None:
+        powers = [vna.power()] * (POWER_SWEEP_POWERS
+                                  if case.scenario == 'power_sweep' else 1)
+    sweeps = len(powers) if case.scenario == 'power_sweep' else 1
+
+    meas = Measurement()
+    swept = case.scenario in ('power_sweep', 'power_loop')
+    if swept:
+        meas.register_parameter(vna.power)
+    setpoints = (vna.power,) if swept else None
+    for trace in traces:
+        for name, _ in STORED_FORMATS:
+            meas.register_parameter(getattr(trace, name), setpoints=setpoints)
+    export_path = os.path.join(directory, 'export.txt')
+
+    timer = StageTimer()
+    vna.transfer_stats.clear()
+    t_run = time.perf_counter()
+    with meas.run() as datasaver:
+        writer = SweepWriter(datasaver, batch_size=10)
+        for iteration in range(repetitions):
+            timer.next_iteration()
+            if case.scenario == 'power_sweep':
+                # the powers go to the instrument with the segment table
+                with _Fetch(vna, timer, rest='sweep_wait'):
+                    data = vna.power_sweep(powers, trace=traces[0])
+                with timer.stage('decode'):
+                    formatted = [[derive_format(sweep, sweep_format)
+                                  for _, sweep_format in STORED_FORMATS]
+                                 for sweep in data]
+                with timer.stage('db_write'):
+                    for power, sweep_formatted in zip(powers, formatted):
+                        writer.add_sweep(*[(getattr(traces[0], name), values)
+                                           for (name, _), values
+                                           in zip(STORED_FORMATS,
+                                                  sweep_formatted)],
+                                         (vna.power, power))
+                with timer.stage('export'):
+                    np.savetxt(export_path, np.column_stack(
+                        [frequencies]
+                        + [values for sweep_formatted in formatted
+                           for values in sweep_formatted[:2]]))
+                continue
+            results = []
+            if case.scenario == 'power_loop':
+                power = powers[iteration % len(powers)]
+                with timer.stage('parameter_set'):
+                    vna.power(power)
+                results.append((vna.power, power))
+            with timer.stage('sweep_wait'):
+                traces[0].run_sweep()
+            with _Fetch(vna, timer):
+                if case.scenario == 'screen':
+                    data = vna.get_all_traces()['data'][:len(traces)]
+                else:
+                    data = [trace.sweep_data() for trace in traces]
+                formatted = [[derive_format(trace_data, sweep_format)
+                              for _, sweep_format in STORED_FORMATS]
+                             for trace_data in data]
+            with timer.stage('db_write'):
+                for trace, trace_formatted in zip(traces, formatted):
+                    for (name, _), values in zip(STORED_FORMATS,
+                                                 trace_formatted):
+                        results.append((getattr(trace, name), values))
+                datasaver.add_result(*results)
+            with timer.stage('export'):
+                np.savetxt(export_path, np.column_stack(
+                    [frequencies] + [values for trace_formatted in formatted
+                                     for values in trace_formatted[:2]]))
+        # the datasaver writes in batches; the last one counts towards the
+        # last iteration
+        with timer.stage('db_write'):
+            writer.flush()
+    duration = time.perf_counter() - t_run
+
+    result = {'case': case._asdict(),
+              'repetitions': repetitions,
+              'setup_seconds': setup,
+              'duration': duration,
+              'throughput': {
+                  'sweeps_per_second': repetitions * sweeps / duration,
+                  'points_per_second':
+                      repetitions * sweeps * case.points * len(traces)
+                      / duration},
+              'transfer': vna.transfer_stats.summary()}
+    result.update(timer.summary())
+    logger.info("%s: %d points, %d traces, %s: %.1f sweeps/s",
+                case.scenario, case.points, len(traces),
+                case.transfer_format,
+                result['throughput']['sweeps_per_second'])
+    return result
+
+
+def import_times(modules: Sequence[str] = IMPORTS,
+                 repetitions: int = 5) -> Dict[str, Any]:
+    """
+    Time the import of every module in a fresh interpreter, repetitions
+    times, see the module docstring. Modules that fail to import are
+    reported with the error instead.
+
+    Returns:
+        the report: the software versions, and for every module the
+        statistics of the import time in s and the slow dependencies it
+        loaded
+    """
+    results = {}  # type: Dict[str, Any]
+    for module in modules:
+        script = _IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+        seconds = []
+        for _ in range(repetitions):
+            process = subprocess.run([sys.executable, '-c', script],
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     universal_newlines=True)
+            if process.returncode != 0:
+                error = process.stderr.strip().splitlines()
+                results[module] = {'error': error[-1] if error else ''}
+                break
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+            seconds.append(result['seconds'])
+        else:
+            results[module] = {'seconds': _statistics(seconds),
+                               'loaded': result['loaded']}
+    return {'created': datetime.datetime.now().isoformat(),
+            'software': {'python': platform.python_version()},
+            'repetitions': repetitions,
+            'imports': results}
+
+
+def print_import_report(report: Dict[str, Any]) -> None:
+    """
+    Print the median import time and the slow dependencies loaded for
+    every module of an import_times report
+    """
+    for module, result in report['imports'].items():
+        if 'error' in result:
+            print("{:<56}{}".format(module, result['error']))
+        else:
+            print("{:<56}{:>8.3f} s  {}".format(
+                module, result['seconds']['p50'],
+                ", ".join(result['loaded']) or "-"))
+
+
+def run_benchmarks(vna: Any,
+                   points: Sequence[int] = (201, 2001, 20001),
+                   trace_counts: Sequence[int] = (1, 2),
+                   transfer_formats: Sequence[str] = ('REAL32', 'REAL64',
+                                                      'ASCII'),
+                   scenarios: Sequence[str] = SCENARIOS,
+                   repetitions: int = 10,
+                   powers: Optional[Sequence[float]] = None
+                   ) -> Dict[str, Any]:
+    """
+    Benchmark every combination of the given settings, see the module
+    docstring. Trace counts larger than the number of traces on the
+    instrument are skipped. The settings of the instrument are restored
+    afterwards, and the data go to a temporary database.
+
+    Returns:
+        the report: the instrument, the software versions and the results
+        of every case
+    """
+    import qcodes as qc
+    from qcodes.dataset.experiment_container import new_experiment
+    from qcodes.dataset.sqlite.database import initialise_or_create_database_at
+
+    cases = [BenchmarkCase(scenario, n_points, n_traces, transfer_format)
+             for scenario in scenarios
+             for n_points in points
+             for n_traces in trace_counts
+             for transfer_format in transfer_formats]
+    available = len(vna.traces)
+    for case in cases:
+        if case.traces > available:
+            logger.warning("skipping %s: the instrument has only %d traces",
+                           case, available)
+    cases = [case for case in cases if case.traces <= available]
+    # power_sweep reads one trace, as the scripts do
+    cases = [case for case in cases
+             if case.scenario != 'power_sweep' or case.traces == 1]
+
+    settings = (vna.points(), vna.transfer_format(), vna.power(),
+                vna.auto_sweep())
+    db_location = qc.config['core']['db_location']
+    directory = tempfile.mkdtemp(prefix='labcodes_benchmark_')
+    results = []
+    try:
+        initialise_or_create_database_at(os.path.join(directory,
+                                                      'benchmark.db'))
+        new_experiment('benchmark', sample_name=vna.name)
+        vna.auto_sweep(False)
+        for case in cases:
+            results.append(benchmark_case(vna, case, repetitions, directory,
+                                          powers))
+    finally:
+        vna.points(settings[0])
+        vna.transfer_format(settings[1])
+        vna.power(settings[2])
+        vna.auto_sweep(settings[3])
+        qc.config['core']['db_location'] = db_location
+        shutil.rmtree(directory, ignore_errors=True)
+    return {'created': datetime.datetime.now().isoformat(),
+            'instrument': vna.get_idn(),
+            'software': {'python': platform.python_version(),
+                         'numpy': np.__version__,
+                         'qcodes': qc.__version__},
+            'repetitions': repetitions,
+            'results': results}
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    """
+    Print a table of the results of a report: throughput, and median
+    seconds per stage and per iteration
+    """
+    columns = ('sweeps/s', 'points/s') + STAGES + ('iteration',)
+    print("{:<12}{:>7}{:>4} {:<7}".format('scenario', 'points', 'tr',
+                                          'format')
+          + "".join("{:>14}".format(column) for column in columns))
+    for result in report['results']:
+        case = result['case']
+        values = [result['throughput']['sweeps_per_second'],
+                  result['throughput']['points_per_second']]
+        values += [result['stages'][stage]['p50'] for stage in STAGES]
+        values.append(result['iteration']['p50'])
+        print("{:<12}{:>7}{:>4} {:<7}".format(
+            case['scenario'], case['points'], case['traces'],
+            case['transfer_format'])
+            + "".join("{:>14.4g}".format(value) for value in values))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the acquisition paths of a VNA")
+    parser.add_argument('--simulate', choices=('anritsu', 'keysight'),
+                        help="benchmark a simulated VNA of this kind")
+    parser.add_argument('--driver', choices=('anritsu', 'keysight'),
+                        help="driver of the real VNA at --address")
+    parser.add_argument('--address', help="VISA address of the real VNA")
+    parser.add_argument('--points', type=int, nargs='+',
+                        default=[201, 2001, 20001])
+    parser.add_argument('--traces', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--formats', nargs='+',
+                        default=['REAL32', 'REAL64', 'ASCII'])
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS))
+    parser.add_argument('--repetitions', type=int, default=10)
+    parser.add_argument('--sweep-time', type=float, default=0.01,
+                        help="sweep time of the simulated VNA in s")
+    parser.add_argument('--imports', action='store_true',
+                        help="time the imports of the labcodes modules "
+                             "instead")
+    parser.add_argument('--output', help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    server = None
+    if args.imports:
+        report = import_times(repetitions=args.repetitions)
+        print_import_report(report)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        parser.exit()
+    if args.simulate:
+        from labcodes.drivers.simulated_vna import SimulatedVNAServer
+        server = SimulatedVNAServer(dialect=args.simulate,
+                                    sweep_time=args.sweep_time).start()
+        kind, address, visalib = args.simulate, server.address, '@py'
+    elif args.driver and args.address:
+        kind, address, visalib = args.driver, args.address, None
+    else:
+        parser.error("either --simulate or --driver and --address are "
+                     "required")
+
+    if kind == 'anritsu':
+        from labcodes.drivers.Anritsu_MS46522B import Anritsu_MS46522B
+        vna = Anritsu_MS46522B('VNA_benchmark', address,
+                               50e6, 20e9, -30, 30, 2, visalib=visalib)
+    else:
+        from labcodes.drivers.Keysight_P9373A import Keysight_P9373A
+        vna = Keysight_P9373A('VNA_benchmark', address,
+                              300e3, 13.5e9, -90, 13, 2, visalib=visalib)
+    try:
+        report = run_benchmarks(vna, args.points, args.traces, args.formats,
+                                args.scenarios, args.repetitions)
+    finally:
+        vna.close()
+        if server is not None:
+            server.stop()
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
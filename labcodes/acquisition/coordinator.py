@@ -0,0 +1,121 @@
+"""
+Concurrent acquisition with several instruments from one process.
+
+run_concurrently drives several instruments (e.g. the Anritsu and the
+Keysight VNA) at the same time, with one worker thread per instrument, so
+every VISA session is only used from its own thread. For every step
+
+    - the workers wait for each other at a barrier, so the instruments
+      start their sweeps together,
+    - each worker calls the acquire function of its instrument and puts the
+      result into its own bounded queue (see labcodes.acquisition.pipeline),
+    - the calling thread takes one result from every queue and hands them
+      to consume together, e.g. to store them in one qcodes dataset.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Mapping, NamedTuple, Optional, \
+    Sequence
+
+from labcodes.acquisition.pipeline import _DONE, _Producer
+
+logger = logging.getLogger()
+
+
+class CoordinatorStats(NamedTuple):
+    """
+    Timing of a concurrent run, in seconds: the total duration, and the
+    time every instrument spent acquiring and waiting for the consumer
+    """
+    steps: int
+    duration: float
+    consume_time: float
+    acquire_time: Dict[str, float]
+    producer_blocked: Dict[str, float]
+
+
+def run_concurrently(acquire: Mapping[str, Callable[[Any], Any]],
+                     steps: Sequence[Any],
+                     consume: Callable[[Any, Dict[str, Any]], None],
+                     maxsize: int = 2,
+                     synchronized: bool = True,
+                     stop: Optional[threading.Event] = None
+                     ) -> CoordinatorStats:
+    """
+    Acquire with several instruments concurrently, see the module
+    docstring.
+
+    If an acquire function raises, the other workers are stopped (a worker
+    waiting at the barrier is released) and its exception is raised here.
+
+    Args:
+        acquire: acquire function by instrument name, called with a step in
+            the instrument's worker thread
+        steps: the steps of the measurement, the same for every instrument
+        consume: called in the calling thread with a step and the data of
+            every instrument by name
+        maxsize: maximum number of results per instrument waiting to be
+            consumed
+        synchronized: start every step on all instruments together
+        stop: optional event to stop the workers early
+
+    Returns:
+        timing statistics of the run
+    """
+    stop = threading.Event() if stop is None else stop
+    barrier = threading.Barrier(len(acquire)) if synchronized else None
+    before_step = barrier.wait if barrier is not None else None
+    workers = {name: _Producer(steps, function, maxsize, stop,
+                               name='acquisition-{}'.format(name),
+                               before_step=before_step)
+               for name, function in acquire.items()}
+    t_run = time.perf_counter()
+    consume_time = 0.
+    count = 0
+    for worker in workers.values():
+        worker.start()
+    try:
+        while True:
+            items = {}
+            for name, worker in workers.items():
+                try:
+                    items[name] = worker.get()
+                except BaseException:
+                    # release the workers waiting for this one
+                    if barrier is not None:
+                        barrier.abort()
+                    raise
+            if any(item is _DONE for item in items.values()):
+                break
+            step = next(iter(items.values()))[0]
+            t_start = time.perf_counter()
+            consume(step, {name: item[1] for name, item in items.items()})
+            consume_time += time.perf_counter() - t_start
+            count += 1
+    except threading.BrokenBarrierError:
+        # a worker waiting at the barrier was released because another
+        # one failed: raise the original error
+        stop.set()
+        for worker in workers.values():
+            worker.join()
+        errors = [worker.error for worker in workers.values()
+                  if worker.error is not None and not isinstance(
+                      worker.error, threading.BrokenBarrierError)]
+        if errors:
+            raise errors[0]
+        raise
+    finally:
+        stop.set()
+        if barrier is not None:
+            barrier.abort()
+        for worker in workers.values():
+            worker.join()
+    stats = CoordinatorStats(
+        count, time.perf_counter() - t_run, consume_time,
+        {name: worker.acquire_time for name, worker in workers.items()},
+        {name: worker.blocked for name, worker in workers.items()})
+    logger.debug("concurrent acquisition with %s: %d steps in %.3f s",
+                 ", ".join(workers), stats.steps, stats.duration)
+    return stats
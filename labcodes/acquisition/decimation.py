@@ -0,0 +1,214 @@
+"""
+Min/max envelopes of traces at several zoom levels.
+
+A power sweep of a few hundred 20001 point traces is more than a viewer
+can draw quickly, and more than a screen can show: a plot is a few
+thousand pixels wide. Drawing the minimum and the maximum of the points
+that fall on each pixel column gives the same picture (narrow resonances
+stay visible, unlike with every n-th point or bin means) from a fraction
+of the data.
+
+EnvelopePyramid keeps these envelopes at several zoom levels: level 1 has
+the min/max of bins of factor points, level 2 of factor**2 points, ..., up
+to the level with fewer than min_points bins. Each level is computed from
+the one below it. Sweeps can be added as they arrive, and only the
+levels from 1 on are kept, not the traces themselves (level 0). A plot
+asks for the finest level with no more bins than it has pixels (level),
+and draws its low and high values.
+
+The envelopes are for plotting finished runs: export_run builds the
+pyramid of a run while it writes the HDF5 file of the run, and stores it
+there next to the raw data (see labcodes.acquisition.export); load reads a
+level back, e.g. for the PNGs of PlotWorker. Nothing is added to the
+qcodes database, so live viewers (plot_by_id, plottr-inspectr) still
+read the data at full resolution.
+"""
+
+from typing import Any, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+
+class EnvelopeLevel(NamedTuple):
+    """
+    The envelope at one zoom level: frequency (the centers of the bins),
+    and the low and high values of every sweep in every bin, of shape
+    (sweeps, bins)
+    """
+    factor: int
+    frequency: np.ndarray
+    low: np.ndarray
+    high: np.ndarray
+
+    @property
+    def middle(self) -> np.ndarray:
+        """ a value per bin for maps, halfway between low and high """
+        return (self.low + self.high) / 2
+
+
+def _bins(values: np.ndarray, factor: int, fill: float) -> np.ndarray:
+    """
+    values with the last axis split into bins of factor points, the last
+    bin padded with fill
+    """
+    points = values.shape[-1]
+    bins = -(-points // factor)
+    if bins * factor != points:
+        padding = np.full(values.shape[:-1] + (bins * factor - points,),
+                          fill, dtype=values.dtype)
+        values = np.concatenate((values, padding), axis=-1)
+    return values.reshape(values.shape[:-1] + (bins, factor))
+
+
+def minmax_envelope(low: np.ndarray,
+                    high: np.ndarray,
+                    factor: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reduce the last axis of an envelope (or of a trace, with low and high
+    the same array) by factor: the minimum of low and the maximum of high
+    in every bin of factor points. NaN values are ignored.
+    """
+    return (np.nanmin(_bins(low, factor, np.inf), axis=-1),
+            np.nanmax(_bins(high, factor, -np.inf), axis=-1))
+
+
+def decimate_minmax(x: np.ndarray,
+                    y: np.ndarray,
+                    max_points: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reduce a single trace to at most max_points points, the minimum and
+    the maximum of each of max_points // 2 bins in the order they occur,
+    for drawing it as a line
+    """
+    if len(y) <= max_points:
+        return x, y
+    factor = -(-len(y) // max(max_points // 2, 1))
+    blocks = _bins(y, factor, np.nan)
+    low, high = np.nanargmin(blocks, axis=1), np.nanargmax(blocks, axis=1)
+    index = np.minimum(np.sort(np.column_stack((low, high)), axis=1)
+                       + factor * np.arange(len(blocks))[:, None],
+                       len(y) - 1).ravel()
+    return x[index], y[index]
+
+
+class EnvelopePyramid:
+    """
+    Min/max envelopes of sweeps that share their frequencies, see the
+    module docstring.
+
+    Args:
+        frequency: the frequencies of the points of a sweep
+        factor: number of bins of a level merged into one bin of the next
+        min_points: the coarsest level is the first with fewer bins
+    """
+
+    def __init__(self,
+                 frequency: Any,
+                 factor: int = 8,
+                 min_points: int = 256) -> None:
+        if factor < 2:
+            raise ValueError("factor must be at least 2")
+        self.frequency = np.asarray(frequency, dtype=float)
+        self.factor = factor
+        # bin centers of every level, level 0 is the trace itself
+        self.frequencies = [self.frequency]
+        while len(self.frequencies[-1]) >= min_points:
+            self.frequencies.append(np.nanmean(
+                _bins(self.frequencies[-1], factor, np.nan), axis=-1))
+        self._low = [[] for _ in self.frequencies
+                     ]  # type: List[List[np.ndarray]]
+        self._high = [[] for _ in self.frequencies
+                      ]  # type: List[List[np.ndarray]]
+        self.sweeps = 0
+
+    @property
+    def levels(self) -> int:
+        return len(self.frequencies)
+
+    def add(self, values: Any) -> None:
+        """
+        Add one sweep, or several sweeps as rows of a 2D array
+        """
+        values = np.atleast_2d(np.asarray(values, dtype=float))
+        if values.shape[1] != len(self.frequency):
+            raise ValueError("{} points per sweep, expected {}".format(
+                values.shape[1], len(self.frequency)))
+        low = high = values
+        for level in range(1, self.levels):
+            low, high = minmax_envelope(low, high, self.factor)
+            self._low[level].append(low)
+            self._high[level].append(high)
+        if self.levels == 1:
+            # traces shorter than min_points are their own coarsest level;
+            # otherwise the raw data are not kept
+            self._low[0].append(values)
+        self.sweeps += len(values)
+
+    def level(self, max_points: Optional[int] = None,
+              index: Optional[int] = None) -> EnvelopeLevel:
+        """
+        The finest level with at most max_points bins (the coarsest level
+        if none has so few), or the level with the given index
+        """
+        if index is None:
+            index = self.levels - 1
+            if max_points is not None:
+                index = next((level for level in range(self._first(),
+                                                       self.levels)
+                              if len(self.frequencies[level]) <= max_points),
+                             index)
+        if index < self._first():
+            raise ValueError("Level 0 (the raw data) is not kept")
+        if not self._low[index]:
+            empty = np.empty((0, len(self.frequencies[index])))
+            return EnvelopeLevel(self.factor ** index,
+                                 self.frequencies[index], empty, empty)
+        low = self._low[index] = [np.concatenate(self._low[index])]
+        if index == 0:
+            high = low
+        else:
+            high = self._high[index] = [np.concatenate(self._high[index])]
+        return EnvelopeLevel(self.factor ** index, self.frequencies[index],
+                             low[0], high[0])
+
+    def _first(self) -> int:
+        # the finest level that is kept
+        return 0 if self.levels == 1 else 1
+
+    def save(self, group: Any, compression: Optional[str] = 'gzip') -> None:
+        """
+        Write the levels into an h5py group, as datasets
+        level_<n>/frequency, level_<n>/low and level_<n>/high
+        """
+        group.attrs['factor'] = self.factor
+        group.attrs['levels'] = self.levels
+        for index in range(self._first(), self.levels):
+            level = self.level(index=index)
+            subgroup = group.require_group('level_{}'.format(index))
+            for name in ('frequency', 'low', 'high'):
+                if name in subgroup:
+                    del subgroup[name]
+                subgroup.create_dataset(name, data=getattr(level, name),
+                                        compression=compression)
+
+    @staticmethod
+    def load(group: Any,
+             max_points: Optional[int] = None,
+             sweeps: Optional[slice] = None) -> EnvelopeLevel:
+        """
+        Read the finest level with at most max_points bins from an h5py
+        group written by save, only reading that level (and only the given
+        sweeps of it)
+        """
+        factor = int(group.attrs['factor'])
+        levels = int(group.attrs['levels'])
+        index = levels - 1
+        if max_points is not None:
+            index = next((level for level in range(min(1, index), levels)
+                          if len(group['level_{}/frequency'.format(level)])
+                          <= max_points), index)
+        subgroup = group['level_{}'.format(index)]
+        sweeps = slice(None) if sweeps is None else sweeps
+        return EnvelopeLevel(factor ** index, subgroup['frequency'][()],
+                             subgroup['low'][sweeps],
+                             subgroup['high'][sweeps])
@@ -0,0 +1,251 @@
+"""
+Export of measurement runs to compressed, columnar HDF5 files.
+
+export_run writes one file per run, containing
+
+    /<name>         complex trace data, e.g. /S21, of shape (sweeps, points)
+    /<setpoint>     the setpoints of the data by full name: setpoints that
+                    are constant during a sweep (e.g. /VNA_power) with one
+                    value per sweep, the others (e.g. /VNA_tr1_frequency)
+                    of shape (sweeps, points)
+    /envelopes/<name>_<format>
+                    min/max envelopes of the data in the given formats
+                    (e.g. /envelopes/S21_MLOG) at several zoom levels, for
+                    plotting, see labcodes.acquisition.decimation
+
+and the run id, guid, experiment and sample name, metadata and the
+instrument snapshot of the run as attributes of the file. The data are
+read from the dataset chunk by chunk (see labcodes.acquisition.storage) and
+appended to gzip-compressed HDF5 datasets, so a run is never held in
+memory as a whole. Compared to the text tables written before, a power
+sweep takes one file instead of four, at a fraction of the size and
+time.
+
+The text tables can still be made from an exported file when needed, see
+export_text.
+"""
+
+import json
+import logging
+import os
+from typing import (Any, Dict, Iterator, List, Mapping, Optional, Sequence,
+                    Tuple)
+
+import h5py
+import numpy as np
+
+from labcodes.acquisition.decimation import EnvelopeLevel, EnvelopePyramid
+from labcodes.acquisition.storage import iter_sweep_chunks
+from labcodes.drivers.sweep_data import derive_format
+
+logger = logging.getLogger()
+
+# quantities of the text tables and the formats they are derived with
+TEXT_QUANTITIES = (('magnitude', 'MLOG'), ('phase', 'PHAS'),
+                   ('real', 'REAL'), ('imaginary', 'IMAG'))
+
+# formats whose envelopes are exported by default, those of the formatted
+# sweeps the scripts plot
+ENVELOPE_FORMATS = ('MLOG', 'PHAS')
+
+
+def _append(group: Any,
+            name: str,
+            values: np.ndarray,
+            compression: Optional[str]) -> None:
+    """
+    Append the sweeps in values to the dataset name, creating it on the
+    first call
+    """
+    if name not in group:
+        group.create_dataset(name, shape=(0,) + values.shape[1:],
+                             maxshape=(None,) + values.shape[1:],
+                             dtype=values.dtype, chunks=True,
+                             compression=compression, shuffle=True)
+    dataset = group[name]
+    count = dataset.shape[0]
+    dataset.resize(count + len(values), axis=0)
+    dataset[count:] = values
+
+
+def _strings(values: List[str]) -> np.ndarray:
+    # lists of str are stored as variable length strings, which older h5py
+    # versions do not do by themselves
+    return np.array(values, dtype=h5py.special_dtype(vlen=str))
+
+
+def _run_attributes(dataset: Any) -> Dict[str, Any]:
+    return {'run_id': dataset.run_id,
+            'guid': dataset.guid,
+            'name': dataset.name,
+            'exp_name': dataset.exp_name,
+            'sample_name': dataset.sample_name,
+            'run_timestamp': dataset.run_timestamp() or '',
+            'metadata': json.dumps(dataset.metadata),
+            'snapshot': dataset.snapshot_raw or ''}
+
+
+def export_run(dataset: Any,
+               path: str,
+               traces: Mapping[str, Tuple[str, str]],
+               sweeps_per_chunk: int = 10,
+               points: Optional[int] = None,
+               compression: Optional[str] = 'gzip',
+               envelopes: Sequence[str] = ENVELOPE_FORMATS) -> None:
+    """
+    Export complex trace data of a run to an HDF5 file, see the module
+    docstring.
+
+    Args:
+        dataset: the qcodes dataset of the run
+        path: the HDF5 file, overwritten if it exists
+        traces: full names of the real and the imaginary parameter by name
+            of the complex data, e.g.
+            {'S21': ('VNA_tr1_real', 'VNA_tr1_imaginary')}
+        sweeps_per_chunk: number of sweeps read and written at a time
+        points: points per sweep, by default from the metadata written by
+            SweepWriter
+        compression: HDF5 compression filter
+        envelopes: formats (see derive_format) whose min/max envelope
+            pyramid is stored as /envelopes/<name>_<format>
+    """
+    with h5py.File(path, 'w') as f:
+        f.attrs.update(_run_attributes(dataset))
+        for name, (real, imaginary) in traces.items():
+            specs = dataset.paramspecs
+            setpoints = list(specs[real].depends_on_)
+            # setpoints shared with an earlier trace are written only once
+            new_setpoints = [setpoint for setpoint in setpoints
+                             if setpoint not in f]
+            per_sweep = {}  # type: Dict[str, bool]
+            pyramids = None  # type: Optional[Dict[str, EnvelopePyramid]]
+            for real_chunk, imaginary_chunk in zip(
+                    iter_sweep_chunks(dataset, real, sweeps_per_chunk,
+                                      points),
+                    iter_sweep_chunks(dataset, imaginary, sweeps_per_chunk,
+                                      points)):
+                data = real_chunk[real] + 1j * imaginary_chunk[imaginary]
+                _append(f, name, data, compression)
+                # the last setpoint is the one swept by the instrument;
+                # envelopes need the same frequencies in every sweep
+                frequency = real_chunk[setpoints[-1]]
+                if pyramids is None:
+                    pyramids = {sweep_format: EnvelopePyramid(frequency[0])
+                                for sweep_format in envelopes}
+                if pyramids and np.all(frequency
+                                       == pyramids[envelopes[0]].frequency):
+                    for sweep_format, pyramid in pyramids.items():
+                        pyramid.add(derive_format(data, sweep_format))
+                elif pyramids:
+                    logger.debug("the sweeps of %s have different "
+                                 "frequencies, no envelopes exported", name)
+                    pyramids = {}
+                for setpoint in new_setpoints:
+                    values = real_chunk[setpoint]
+                    if setpoint not in per_sweep:
+                        per_sweep[setpoint] = bool(
+                            np.all(values == values[:, :1]))
+                    if per_sweep[setpoint]:
+                        values = values[:, 0]
+                    _append(f, setpoint, values, compression)
+            for sweep_format, pyramid in (pyramids or {}).items():
+                pyramid.save(f.require_group('envelopes').create_group(
+                    '{}_{}'.format(name, sweep_format)), compression)
+            f[name].attrs['setpoints'] = _strings(setpoints)
+            f[name].attrs['source'] = _strings([real, imaginary])
+            for setpoint in new_setpoints:
+                f[setpoint].attrs['label'] = specs[setpoint].label
+                f[setpoint].attrs['unit'] = specs[setpoint].unit
+    logger.debug("exported run %s to %s", dataset.run_id, path)
+
+
+def _iter_sweeps(data: Any,
+                 setpoints: List[Any],
+                 sweeps_per_chunk: int
+                 ) -> Iterator[Tuple[np.ndarray, List[np.ndarray]]]:
+    """
+    The complex data and the setpoints, broadcast to the shape of the data,
+    a few sweeps at a time
+    """
+    sweeps, points = data.shape
+    for first in range(0, sweeps, sweeps_per_chunk):
+        chunk = data[first:first + sweeps_per_chunk]
+        columns = []
+        for setpoint in setpoints:
+            values = setpoint[first:first + sweeps_per_chunk]
+            columns.append(np.broadcast_to(
+                np.reshape(values, (len(chunk), -1)), chunk.shape))
+        yield chunk, columns
+
+
+def export_text(path: str,
+                name: str = 'S21',
+                layout: str = 'rows',
+                sweeps_per_chunk: int = 10,
+                fmt: str = '%.18e') -> List[str]:
+    """
+    Convert the complex data name of an HDF5 file written by export_run to
+    the text tables of the measurement scripts, next to the HDF5 file.
+
+    Args:
+        path: the HDF5 file
+        name: the complex data to convert
+        layout: 'rows' writes one file per quantity (magnitude, phase,
+            real, imaginary), with one row per setpoint and one for the
+            quantity, as for power sweeps. 'columns' writes one file with a
+            column per setpoint and per quantity, as for single sweeps.
+        sweeps_per_chunk: number of sweeps converted at a time
+        fmt: format of a value
+
+    Returns:
+        the paths of the text files
+    """
+    if layout not in ('rows', 'columns'):
+        raise ValueError("layout must be 'rows' or 'columns'")
+    stem = os.path.splitext(path)[0]
+    paths = []
+    with h5py.File(path, 'r') as f:
+        data = f[name]
+        setpoints = [f[setpoint] for setpoint in data.attrs['setpoints']]
+        if layout == 'columns':
+            paths.append(stem + '.txt')
+            with open(paths[-1], 'w') as text:
+                for chunk, columns in _iter_sweeps(data, setpoints,
+                                                   sweeps_per_chunk):
+                    columns += [derive_format(chunk, sweep_format)
+                                for _, sweep_format in TEXT_QUANTITIES]
+                    np.savetxt(text, np.column_stack(
+                        [np.ravel(column) for column in columns]), fmt=fmt)
+            return paths
+        for quantity, sweep_format in TEXT_QUANTITIES:
+            paths.append('{}_{}.txt'.format(stem, quantity))
+            with open(paths[-1], 'w') as text:
+                # one pass over the data per row of the table
+                for row in range(len(setpoints) + 1):
+                    separator = ''
+                    for chunk, columns in _iter_sweeps(data, setpoints,
+                                                       sweeps_per_chunk):
+                        values = np.ravel(
+                            columns[row] if row < len(setpoints)
+                            else derive_format(chunk, sweep_format))
+                        text.write(separator + ' '.join([fmt] * len(values))
+                                   % tuple(values))
+                        separator = ' '
+                    text.write('\n')
+    return paths
+
+
+def read_envelope(path: str,
+                  name: str = 'S21',
+                  sweep_format: str = 'MLOG',
+                  max_points: Optional[int] = None,
+                  sweeps: Optional[slice] = None) -> EnvelopeLevel:
+    """
+    Read the envelope of the complex data name in sweep_format from an HDF5
+    file written by export_run, at the finest level with at most max_points
+    bins, see EnvelopePyramid.load
+    """
+    with h5py.File(path, 'r') as f:
+        return EnvelopePyramid.load(
+            f['envelopes/{}_{}'.format(name, sweep_format)], max_points,
+            sweeps)
@@ -0,0 +1,249 @@
+"""
+Power x frequency maps of power sweeps.
+
+A power sweep is stored in long format: one row per point with the power,
+the frequency and the measured value, as returned by get_parameter_data()
+or written to the text tables. For plotting and fitting it is needed as a
+grid with one row per power and one column per frequency point.
+
+SweepMap holds such a grid:
+
+    - power_frequency_map builds it from the long-format columns. If all
+      sweeps have the same number of points, the grid is a reshaped view
+      of the columns, nothing is copied.
+    - add appends sweeps as they arrive (e.g. from the store function of a
+      measurement or from iter_sweep_chunks), into a buffer that grows by
+      doubling, so the map can be updated after every sweep.
+
+Sweeps with different numbers of points (ragged grids) are padded with NaN
+to the longest sweep. The frequencies are kept once if all sweeps share
+them and per sweep otherwise, and the powers need not be equally spaced:
+edges gives the cell edges for plt.pcolormesh of non-uniform grids.
+"""
+
+from typing import Any, Optional, Tuple
+
+import numpy as np
+
+
+def grid_edges(centers: Any) -> np.ndarray:
+    """
+    Edges of the cells around the given, possibly unequally spaced,
+    centers: halfway between neighbours, and half a cell beyond the first
+    and the last center
+    """
+    centers = np.asarray(centers, dtype=float)
+    if centers.size == 1:
+        return centers + np.array([-.5, .5])
+    middle = (centers[1:] + centers[:-1]) / 2
+    return np.concatenate(([2 * centers[0] - middle[0]], middle,
+                           [2 * centers[-1] - middle[-1]]))
+
+
+def _pad(values: np.ndarray,
+         starts: np.ndarray,
+         lengths: np.ndarray) -> np.ndarray:
+    """
+    The consecutive runs of values with the given starts and lengths as
+    rows of a NaN padded 2D array
+    """
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    columns = np.arange(len(values)) - np.repeat(starts, lengths)
+    grid = np.full((len(lengths), lengths.max()), np.nan,
+                   dtype=np.result_type(float, values.dtype))
+    grid[rows, columns] = values
+    return grid
+
+
+class SweepMap:
+    """
+    A (power, frequency) grid of a measured quantity, see the module
+    docstring.
+
+    Args:
+        capacity: number of sweeps the buffer is allocated for initially
+    """
+
+    def __init__(self, capacity: int = 16) -> None:
+        self._capacity = capacity
+        self._count = 0
+        self._power = None  # type: Optional[np.ndarray]
+        self._values = None  # type: Optional[np.ndarray]
+        # 1D if all sweeps share their frequencies, 2D otherwise
+        self._frequency = None  # type: Optional[np.ndarray]
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def power(self) -> np.ndarray:
+        """ the power of every sweep, shape (sweeps,) """
+        return self._power[:self._count]
+
+    @property
+    def frequency(self) -> np.ndarray:
+        """
+        the frequencies, shape (points,) if all sweeps share them,
+        (sweeps, points) otherwise
+        """
+        if self._frequency is None or self._frequency.ndim == 1:
+            return self._frequency
+        return self._frequency[:self._count]
+
+    @property
+    def values(self) -> np.ndarray:
+        """ the measured values, shape (sweeps, points) """
+        return self._values[:self._count]
+
+    @classmethod
+    def from_grid(cls,
+                  power: np.ndarray,
+                  frequency: np.ndarray,
+                  values: np.ndarray) -> 'SweepMap':
+        """
+        A map that uses the given arrays as its buffers, without copying
+        """
+        sweep_map = cls(capacity=len(values))
+        sweep_map._count = len(values)
+        sweep_map._power = power
+        sweep_map._values = values
+        if frequency.ndim == 2 and np.all(frequency == frequency[:1]):
+            frequency = frequency[0]
+        sweep_map._frequency = frequency
+        return sweep_map
+
+    def _reserve(self,
+                 count: int,
+                 points: int,
+                 shared: bool,
+                 dtype: np.dtype) -> None:
+        """
+        Make room for count more sweeps of up to points points of dtype,
+        and for frequencies per sweep unless shared
+        """
+        needed = self._count + count
+        width = self._values.shape[1] if self._values is not None else 0
+        capacity = len(self._values) if self._values is not None else 0
+        if self._values is not None:
+            dtype = np.result_type(dtype, self._values.dtype)
+        if (needed <= capacity and points <= width
+                and dtype == self._values.dtype
+                and (shared or self._frequency.ndim == 2)):
+            return
+        capacity = max(needed, 2 * capacity, self._capacity)
+        width = max(width, points)
+        power = np.full(capacity, np.nan)
+        values = np.full((capacity, width), np.nan, dtype=dtype)
+        if shared and (self._frequency is None
+                       or self._frequency.ndim == 1):
+            frequency = self._frequency
+        else:
+            frequency = np.full((capacity, width), np.nan)
+            if self._frequency is not None:
+                frequency[:self._count, :self._frequency.shape[-1]] = \
+                    self.frequency
+        if self._count:
+            power[:self._count] = self.power
+            values[:self._count, :self._values.shape[1]] = self.values
+        self._power, self._values, self._frequency = power, values, frequency
+
+    def add(self, power: Any, frequency: Any, values: Any) -> None:
+        """
+        Append one sweep, or several sweeps of the same length.
+
+        Args:
+            power: the power of the sweep, or one power per sweep
+            frequency: the frequencies of the points, shape (points,) or
+                (sweeps, points)
+            values: the measured values, shape (points,) or
+                (sweeps, points)
+        """
+        values = np.atleast_2d(values)
+        power = np.broadcast_to(np.ravel(power), (len(values),))
+        frequency = np.asarray(frequency, dtype=float)
+        points = values.shape[1]
+        if frequency.ndim == 2 and np.all(frequency == frequency[:1]):
+            frequency = frequency[0]
+        # sweeps share their frequencies as long as all sweeps have the
+        # same ones
+        shared = frequency.ndim == 1 and (
+            self._frequency is None
+            or (self._frequency.ndim == 1
+                and np.array_equal(self._frequency, frequency)))
+        self._reserve(len(values), points, shared,
+                      np.result_type(float, values.dtype))
+        rows = slice(self._count, self._count + len(values))
+        self._power[rows] = power
+        self._values[rows, :points] = values
+        if self._frequency is None:
+            self._frequency = frequency.copy()
+        elif self._frequency.ndim == 2:
+            self._frequency[rows, :points] = frequency
+        self._count += len(values)
+
+    def edges(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Cell edges of the power and the frequency axis for
+        plt.pcolormesh(frequency_edges, power_edges, values). Frequencies
+        per sweep are approximated by those of the first sweep.
+        """
+        frequency = self.frequency
+        if frequency.ndim == 2:
+            frequency = frequency[0][np.isfinite(frequency[0])]
+        return grid_edges(self.power), grid_edges(frequency)
+
+    def table(self) -> np.ndarray:
+        """
+        The map as one table, with the frequencies in the first column,
+        the powers in the first row and the values of every power in the
+        column below it (the table_ampl/table_phase layout of the old
+        scripts). Needs shared frequencies.
+        """
+        if self.frequency.ndim != 1:
+            raise ValueError("The sweeps do not share their frequencies")
+        table = np.zeros((self.values.shape[1] + 1, len(self) + 1),
+                         dtype=self.values.dtype)
+        table[1:, 0] = self.frequency
+        table[0, 1:] = self.power
+        table[1:, 1:] = self.values.T
+        return table
+
+
+def power_frequency_map(power: Any,
+                        frequency: Any,
+                        values: Any,
+                        points: Optional[int] = None) -> SweepMap:
+    """
+    The SweepMap of a power sweep in long format.
+
+    Args:
+        power, frequency, values: the power, the frequency and the measured
+            value of every point, e.g. the columns of get_parameter_data()
+            for one parameter, sweep after sweep
+        points: points per sweep. By default, a new sweep starts wherever
+            the power changes or the frequency does not increase, which
+            also finds sweeps of different lengths.
+
+    Returns:
+        the map. If all sweeps have the same number of points, its arrays
+        are views of the given ones.
+    """
+    power, frequency, values = (np.ravel(array) for array in
+                                (power, frequency, values))
+    if points is None:
+        starts = np.concatenate(([0], 1 + np.flatnonzero(
+            (power[1:] != power[:-1]) | (frequency[1:] <= frequency[:-1]))))
+        lengths = np.diff(np.append(starts, len(values)))
+        if len(values) == 0:
+            return SweepMap()
+        if np.any(lengths != lengths[0]):
+            return SweepMap.from_grid(power[starts],
+                                      _pad(frequency, starts, lengths),
+                                      _pad(values, starts, lengths))
+        points = int(lengths[0])
+    if len(values) % points:
+        raise ValueError("{} values are not a whole number of sweeps of {} "
+                         "points".format(len(values), points))
+    return SweepMap.from_grid(power[::points],
+                              np.reshape(frequency, (-1, points)),
+                              np.reshape(values, (-1, points)))
@@ -0,0 +1,180 @@
+"""
+Pipelined acquisition: keep the instrument busy while data are stored.
+
+In a plain measurement loop the VNA is idle while Python derives formats,
+writes to the database and prints. run_pipelined splits every step of a
+loop into
+
+    acquire(step):          talks to the instrument (e.g. sweep and read
+                            the data), runs in a worker thread
+    consume(step, result):  everything else (formatting, datasaver.
+                            add_result, plotting), runs in the calling
+                            thread
+
+The two are connected by a bounded queue: the worker starts the next
+sweep as soon as it has handed over the data of the last one, and blocks
+when the consumer falls more than maxsize results behind (backpressure),
+so memory use stays bounded. consume runs in the calling thread since
+qcodes datasavers (and their sqlite connections) must be used from the
+thread that created them.
+
+acquire must return data that are not modified afterwards, e.g. a trace's
+sweep_data() or the result of power_sweep, which are copies.
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, NamedTuple, Optional
+
+logger = logging.getLogger()
+
+_DONE = object()
+
+
+class PipelineStats(NamedTuple):
+    """
+    Timing of a pipelined run, in seconds. instrument_busy is the fraction
+    of the run the worker spent in acquire; producer_blocked is the time it
+    waited for the consumer because the queue was full.
+    """
+    steps: int
+    duration: float
+    acquire_time: float
+    consume_time: float
+    producer_blocked: float
+    max_queued: int
+
+    @property
+    def instrument_busy(self) -> float:
+        return self.acquire_time / self.duration if self.duration else 0.
+
+
+class _Failure:
+    def __init__(self, exception: BaseException) -> None:
+        self.exception = exception
+
+
+class _Producer(threading.Thread):
+    """
+    Worker thread calling acquire for every step and putting the results
+    into its bounded queue, followed by _DONE. An exception in acquire
+    (or in before_step) ends the thread, and is put into the queue and
+    kept in error.
+    """
+
+    def __init__(self,
+                 steps: Iterable[Any],
+                 acquire: Callable[[Any], Any],
+                 maxsize: int,
+                 stop: threading.Event,
+                 name: str = 'acquisition-worker',
+                 before_step: Optional[Callable[[], Any]] = None) -> None:
+        super().__init__(name=name, daemon=True)
+        self.steps = steps
+        self.acquire = acquire
+        self.before_step = before_step
+        self.stop = stop
+        self.results = queue.Queue(maxsize=maxsize)  # type: queue.Queue
+        self.error = None  # type: Optional[BaseException]
+        self.acquire_time = 0.
+        self.blocked = 0.
+        self.max_queued = 0
+
+    def put(self, item: Any) -> None:
+        # wait for space, but give up if the consumer is gone
+        t_start = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                self.results.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.blocked += time.perf_counter() - t_start
+        self.max_queued = max(self.max_queued, self.results.qsize())
+
+    def run(self) -> None:
+        try:
+            for step in self.steps:
+                if self.stop.is_set():
+                    break
+                if self.before_step is not None:
+                    self.before_step()
+                t_start = time.perf_counter()
+                data = self.acquire(step)
+                self.acquire_time += time.perf_counter() - t_start
+                self.put((step, data))
+        except BaseException as e:
+            self.error = e
+            self.put(_Failure(e))
+        finally:
+            self.put(_DONE)
+
+    def get(self) -> Any:
+        """
+        The next (step, data) from the queue, or _DONE. Raises the
+        exception of the worker if it failed.
+        """
+        item = self.results.get()
+        if isinstance(item, _Failure):
+            raise item.exception
+        return item
+
+
+def run_pipelined(steps: Iterable[Any],
+                  acquire: Callable[[Any], Any],
+                  consume: Callable[[Any, Any], None],
+                  maxsize: int = 2,
+                  stop: Optional[threading.Event] = None) -> PipelineStats:
+    """
+    Run acquire for every step in a worker thread and consume the results
+    in the calling thread, in order, see the module docstring.
+
+    If acquire raises, the exception is raised here after the results
+    acquired before it were consumed. If consume raises (or on
+    KeyboardInterrupt), the worker is stopped after its current step and
+    the exception propagates.
+
+    acquire runs while consume does and may use the same instrument: it
+    must not invalidate state that consume reads, e.g. the sweep geometry
+    behind the setpoints and shapes of the formatted sweeps (power_sweep
+    leaves it as it is), or consume queries the instrument concurrently.
+
+    Args:
+        steps: the steps of the measurement, e.g. powers
+        acquire: called with a step, returns its data
+        consume: called with a step and its data
+        maxsize: maximum number of acquired results waiting to be consumed
+        stop: optional event to stop the worker early, e.g. from another
+            thread
+
+    Returns:
+        timing statistics of the run
+    """
+    stop = threading.Event() if stop is None else stop
+    worker = _Producer(steps, acquire, maxsize, stop)
+    t_run = time.perf_counter()
+    consume_time = 0.
+    count = 0
+    worker.start()
+    try:
+        while True:
+            item = worker.get()
+            if item is _DONE:
+                break
+            step, data = item
+            t_start = time.perf_counter()
+            consume(step, data)
+            consume_time += time.perf_counter() - t_start
+            count += 1
+    finally:
+        stop.set()
+        worker.join()
+    stats = PipelineStats(count, time.perf_counter() - t_run,
+                          worker.acquire_time, consume_time, worker.blocked,
+                          worker.max_queued)
+    logger.debug("pipelined acquisition: %d steps in %.3f s, instrument "
+                 "busy %.0f %%", stats.steps, stats.duration,
+                 100 * stats.instrument_busy)
+    return stats
@@ -0,0 +1,324 @@
+"""
+Plotting of finished runs in a background thread.
+
+plot_by_id and plt.savefig after every run keep the instrument idle until
+the figures are drawn, which takes seconds for a power sweep of 20001
+point traces. A PlotWorker instead takes run ids from a queue and renders
+the PNGs of a run in its own thread, while the next measurement runs:
+
+    plotter = PlotWorker()
+    ...
+    plotter.submit(datasaver.run_id, directory, '12_powersweep_exp')
+
+submit never blocks: if more than maxsize runs are waiting, the run is not
+plotted and a warning is logged. The worker reads the run from the
+database with its own connection, and draws with matplotlib's Agg backend
+on figures of its own, so pyplot and the figures of the notebook are not
+touched.
+
+Every dependent parameter of a run gives one PNG: a line plot over its
+setpoint for single sweeps, and a map over both setpoints (e.g. power and
+frequency) for sweeps of sweeps. Traces longer than max_points are
+decimated before drawing, to the min/max envelope for lines (which keeps
+narrow resonances visible) and to the bin means for maps. Power sweeps
+written by SweepWriter are read a few sweeps at a time.
+
+Runs exported with export_run are plotted from the min/max envelopes in
+their HDF5 file instead (submit(..., envelopes=path), see
+labcodes.acquisition.decimation): only the zoom level that fits max_points
+is read, e.g. 313 of 20001 points per sweep, rather than the whole run.
+"""
+
+import logging
+import os
+import queue
+import threading
+from typing import Any, List, NamedTuple, Optional, Sequence, Tuple
+
+import h5py
+import numpy as np
+import qcodes as qc
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from qcodes.dataset.data_set import load_by_id
+from qcodes.dataset.sqlite.database import connect
+
+from labcodes.acquisition.decimation import (EnvelopePyramid,
+                                             decimate_minmax)
+from labcodes.acquisition.maps import (SweepMap, grid_edges,
+                                       power_frequency_map)
+from labcodes.acquisition.storage import (SWEEP_POINTS_METADATA,
+                                          iter_sweep_chunks)
+
+logger = logging.getLogger()
+
+_STOP = None
+
+# axis labels of the formats of labcodes.drivers.sweep_data.derive_format
+FORMAT_LABELS = {'MLOG': 'Magnitude (dB)', 'MLIN': 'Magnitude',
+                 'PHAS': 'Phase (deg)', 'UPH': 'Unwrapped phase (deg)',
+                 'REAL': 'Real', 'IMAG': 'Imaginary'}
+
+
+class PlotRequest(NamedTuple):
+    run_id: int
+    directory: str
+    prefix: str
+    parameters: Optional[Tuple[str, ...]]
+    db_path: str
+    envelopes: Optional[str]
+
+
+def decimate_mean(values: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Reduce the rows of a map to at most max_points columns, by the mean of
+    equally sized bins of columns
+    """
+    points = values.shape[1]
+    if points <= max_points:
+        return values
+    size = -(-points // max_points)
+    bins = -(-points // size)
+    padded = np.full((len(values), bins * size), np.nan,
+                     dtype=values.dtype)
+    padded[:, :points] = values
+    return np.nanmean(padded.reshape(len(values), bins, size), axis=2)
+
+
+class PlotWorker:
+    """
+    Renders the PNGs of finished runs in a background thread, see the
+    module docstring.
+
+    Args:
+        maxsize: number of runs that may wait to be plotted
+        max_points: number of points per trace above which traces are
+            decimated
+        dpi: resolution of the PNGs
+        start: start the worker thread right away
+    """
+
+    def __init__(self,
+                 maxsize: int = 20,
+                 max_points: int = 2000,
+                 dpi: int = 100,
+                 start: bool = True) -> None:
+        self.max_points = max_points
+        self.dpi = dpi
+        self.requests = queue.Queue(maxsize=maxsize)  # type: queue.Queue
+        self.rendered = []  # type: List[str]
+        self.dropped = 0
+        self.errors = 0
+        self._thread = None  # type: Optional[threading.Thread]
+        if start:
+            self.start()
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run,
+                                        name='plot-worker', daemon=True)
+        self._thread.start()
+
+    def submit(self,
+               run_id: int,
+               directory: Optional[str] = None,
+               prefix: Optional[str] = None,
+               parameters: Optional[Sequence[str]] = None,
+               envelopes: Optional[str] = None) -> bool:
+        """
+        Queue a run for plotting, without waiting.
+
+        Args:
+            run_id: the run in the current database
+            directory: where the PNGs are saved, by default the folder of
+                the database
+            prefix: file name prefix, the PNG of a parameter is
+                <prefix>_<parameter>.png. By default the run id.
+            parameters: full names of the parameters to plot, by default
+                all dependent parameters of the run
+            envelopes: the HDF5 file of the run written by export_run. If
+                given, the PNGs are drawn from the min/max envelopes stored
+                in it (<prefix>_<name>_<format>.png, e.g. for S21_MLOG),
+                reading only the zoom level needed, instead of from the
+                database.
+
+        Returns:
+            False if the queue was full and the run will not be plotted
+        """
+        db_path = qc.config['core']['db_location']
+        if directory is None:
+            directory = os.path.dirname(os.path.abspath(db_path))
+        request = PlotRequest(run_id, directory,
+                              str(run_id) if prefix is None else prefix,
+                              None if parameters is None
+                              else tuple(parameters),
+                              db_path, envelopes)
+        try:
+            self.requests.put_nowait(request)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("plot queue full, run %s is not plotted", run_id)
+            return False
+        return True
+
+    def wait(self) -> None:
+        """
+        Wait until all queued runs are plotted
+        """
+        self.requests.join()
+
+    def stop(self) -> None:
+        """
+        Plot the queued runs and end the worker thread
+        """
+        if self._thread is None:
+            return
+        self.requests.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self) -> 'PlotWorker':
+        self.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+    def _run(self) -> None:
+        while True:
+            request = self.requests.get()
+            try:
+                if request is _STOP:
+                    return
+                self.rendered.extend(self.plot(request))
+            except Exception:
+                self.errors += 1
+                logger.exception("plotting run %s failed", request.run_id)
+            finally:
+                self.requests.task_done()
+
+    def plot(self, request: PlotRequest) -> List[str]:
+        """
+        Render the PNGs of a run, returns their paths
+        """
+        if request.envelopes is not None:
+            return self._plot_envelopes(request)
+        conn = connect(request.db_path)
+        try:
+            dataset = load_by_id(request.run_id, conn=conn)
+            names = request.parameters or [
+                spec.name for spec in dataset.dependent_parameters
+                if spec.type != 'text']
+            paths = []
+            for name in names:
+                path = os.path.join(request.directory,
+                                    '{}_{}.png'.format(request.prefix, name))
+                self._plot_parameter(dataset, name, path)
+                paths.append(path)
+        finally:
+            conn.close()
+        logger.debug("plotted run %s: %s", request.run_id, paths)
+        return paths
+
+    def _plot_envelopes(self, request: PlotRequest) -> List[str]:
+        paths = []
+        with h5py.File(request.envelopes, 'r') as f:
+            for key, group in f.get('envelopes', {}).items():
+                name, sweep_format = key.rsplit('_', 1)
+                level = EnvelopePyramid.load(group, self.max_points)
+                setpoints = [f[setpoint]
+                             for setpoint in f[name].attrs['setpoints']]
+                figure = Figure()
+                FigureCanvasAgg(figure)
+                axes = figure.add_subplot(111)
+                if len(level.low) == 1:
+                    axes.fill_between(level.frequency, level.low[0],
+                                      level.high[0], linewidth=.5)
+                    axes.set_ylabel(FORMAT_LABELS[sweep_format])
+                else:
+                    power = setpoints[0][()]
+                    if power.ndim == 2:
+                        power = power[:, 0]
+                    mesh = axes.pcolormesh(grid_edges(level.frequency),
+                                           grid_edges(power), level.middle)
+                    figure.colorbar(mesh, ax=axes,
+                                    label=FORMAT_LABELS[sweep_format])
+                    axes.set_ylabel(_h5_label(setpoints[0]))
+                axes.set_xlabel(_h5_label(setpoints[-1]))
+                axes.set_title('#{} {} {} (1:{})'.format(
+                    request.run_id, name, sweep_format, level.factor))
+                paths.append(os.path.join(request.directory,
+                                          '{}_{}.png'.format(request.prefix,
+                                                             key)))
+                figure.savefig(paths[-1], dpi=self.dpi)
+        logger.debug("plotted run %s: %s", request.run_id, paths)
+        return paths
+
+    def _read_map(self, dataset: Any, name: str,
+                  setpoints: List[str]) -> SweepMap:
+        """
+        The data of name over its two setpoints. The sweeps of maps with
+        more than one sweep are reduced to max_points by decimate_mean.
+        """
+        if SWEEP_POINTS_METADATA in dataset.metadata:
+            sweep_map = SweepMap()
+            for chunk in iter_sweep_chunks(dataset, name):
+                sweep_map.add(chunk[setpoints[0]][:, 0],
+                              decimate_mean(chunk[setpoints[1]],
+                                            self.max_points),
+                              decimate_mean(chunk[name], self.max_points))
+            return sweep_map
+        data = dataset.get_parameter_data(name)[name]
+        # array data have one row per sweep, with scalar setpoints
+        rows = len(data[name]) if np.ndim(data[name]) == 2 else 1
+        shape = np.broadcast(*[np.reshape(data[key], (rows, -1))
+                               for key in data]).shape
+        sweep_map = power_frequency_map(*[
+            np.broadcast_to(np.reshape(data[key], (rows, -1)), shape)
+            for key in setpoints + [name]])
+        if len(sweep_map) == 1:
+            return sweep_map
+        return SweepMap.from_grid(
+            sweep_map.power,
+            decimate_mean(np.atleast_2d(sweep_map.frequency),
+                          self.max_points),
+            decimate_mean(sweep_map.values, self.max_points))
+
+    def _plot_parameter(self, dataset: Any, name: str, path: str) -> None:
+        specs = dataset.paramspecs
+        setpoints = list(specs[name].depends_on_)
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        axes = figure.add_subplot(111)
+        sweep_map = None
+        if len(setpoints) == 1:
+            data = dataset.get_parameter_data(name)[name]
+            x, y = np.ravel(data[setpoints[0]]), np.ravel(data[name])
+        else:
+            sweep_map = self._read_map(dataset, name, setpoints)
+            y = sweep_map.values[0]
+            x = np.ravel(sweep_map.frequency)[:len(y)]
+        if sweep_map is None or len(sweep_map) == 1:
+            axes.plot(*decimate_minmax(x, y, self.max_points))
+            axes.set_ylabel(_label(specs[name]))
+        else:
+            power_edges, frequency_edges = sweep_map.edges()
+            mesh = axes.pcolormesh(frequency_edges, power_edges,
+                                   sweep_map.values)
+            figure.colorbar(mesh, ax=axes, label=_label(specs[name]))
+            axes.set_ylabel(_label(specs[setpoints[0]]))
+        axes.set_xlabel(_label(specs[setpoints[-1]]))
+        axes.set_title('#{} {}'.format(dataset.run_id, name))
+        figure.savefig(path, dpi=self.dpi)
+
+
+def _label(spec: Any) -> str:
+    label = spec.label or spec.name
+    return '{} ({})'.format(label, spec.unit) if spec.unit else label
+
+
+def _h5_label(dataset: Any) -> str:
+    label = dataset.attrs.get('label') or dataset.name.lstrip('/')
+    unit = dataset.attrs.get('unit')
+    return '{} ({})'.format(label, unit) if unit else label
@@ -0,0 +1,178 @@
+"""
+Streaming storage of sweeps in qcodes datasets.
+
+A power sweep of 500 powers with 20001 points is 10 million values per
+format; keeping it in memory, either in the datasaver's buffer or by
+reading the dataset back with get_parameter_data() for export, needs
+several GB. Instead,
+
+    - SweepWriter hands every sweep to the datasaver as it arrives and
+      writes the buffered sweeps to the database every batch_size sweeps
+      (or every write_period seconds, whichever comes first),
+    - iter_sweep_chunks reads a dataset back a few sweeps at a time, and
+    - save_sweep_table exports a dataset to the text tables of the
+      measurement scripts chunk by chunk.
+
+SweepWriter records the number of points per sweep in the metadata of the
+dataset ('sweep_points'), so the readers know how to split the rows of a
+dataset into sweeps.
+"""
+
+import logging
+import time
+from typing import Any, Dict, Iterator, Optional, Sequence, Union
+
+import numpy as np
+
+logger = logging.getLogger()
+
+SWEEP_POINTS_METADATA = 'sweep_points'
+
+
+class SweepWriter:
+    """
+    Stores sweeps in a qcodes dataset as they arrive, see the module
+    docstring. Can be used as the consume stage of run_pipelined.
+
+    Args:
+        datasaver: the datasaver of the run, from Measurement.run()
+        batch_size: number of sweeps after which the buffered results are
+            written to the database
+        write_period: if given, replaces the write period of the datasaver
+            (the maximum time in seconds between writes)
+    """
+
+    def __init__(self,
+                 datasaver: Any,
+                 batch_size: int = 10,
+                 write_period: Optional[float] = None) -> None:
+        self.datasaver = datasaver
+        self.batch_size = batch_size
+        if write_period is not None:
+            datasaver.write_period = float(write_period)
+        self.sweeps = 0
+        self.flushes = 0
+        self.write_time = 0.
+        self.points = None  # type: Optional[int]
+        self._pending = 0
+
+    def add_sweep(self, *results: Any) -> None:
+        """
+        Add the results of one sweep, given as for datasaver.add_result:
+        (parameter, values) pairs, where the values of the swept
+        parameters are arrays of one sweep
+        """
+        t_start = time.perf_counter()
+        if self.points is None:
+            self.points = max(np.size(values) for _, values in results)
+            self.datasaver.dataset.add_metadata(SWEEP_POINTS_METADATA,
+                                                self.points)
+        self.datasaver.add_result(*results)
+        self.sweeps += 1
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+        self.write_time += time.perf_counter() - t_start
+
+    def flush(self) -> None:
+        """
+        Write all buffered results to the database
+        """
+        self.datasaver.flush_data_to_database()
+        self.flushes += 1
+        self._pending = 0
+
+
+def _name(parameter: Union[str, Any]) -> str:
+    return getattr(parameter, 'full_name', parameter)
+
+
+def iter_sweep_chunks(dataset: Any,
+                      parameter: Union[str, Any],
+                      sweeps_per_chunk: int = 10,
+                      points: Optional[int] = None
+                      ) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Read the data of a swept parameter back from a dataset, a few sweeps
+    at a time.
+
+    Args:
+        dataset: the qcodes dataset, e.g. datasaver.dataset or
+            load_by_id(run_id)
+        parameter: the dependent parameter or its full name, e.g.
+            'VNA_tr1_magnitude'
+        sweeps_per_chunk: number of sweeps per chunk
+        points: points per sweep, by default from the metadata written by
+            SweepWriter
+
+    Yields:
+        the values of the parameter and of its setpoints by name, as
+        arrays of shape (sweeps in the chunk, points)
+    """
+    name = _name(parameter)
+    if points is None:
+        try:
+            points = int(dataset.metadata[SWEEP_POINTS_METADATA])
+        except KeyError:
+            raise ValueError("The dataset has no '{}' metadata, pass the "
+                             "points per sweep".format(
+                                 SWEEP_POINTS_METADATA)) from None
+    # numeric data are stored one point per row, array data one sweep
+    # per row
+    array = dataset.paramspecs[name].type == 'array'
+    rows = sweeps_per_chunk if array else sweeps_per_chunk * points
+    start = 1
+    while True:
+        data = dataset.get_parameter_data(name, start=start,
+                                          end=start + rows - 1).get(name, {})
+        count = len(data[name]) if data else 0
+        if count == 0:
+            return
+        if not array and count % points:
+            raise ValueError("{} values of {} are not a whole number of "
+                             "sweeps of {} points".format(count, name,
+                                                          points))
+        if array:
+            # scalar setpoints of array data have one value per sweep
+            yield {key: np.broadcast_to(
+                       np.reshape(values, (count, -1)), (count, points))
+                   for key, values in data.items()}
+        else:
+            yield {key: np.reshape(values, (-1, points))
+                   for key, values in data.items()}
+        if count < rows:
+            return
+        start += rows
+
+
+def save_sweep_table(path: str,
+                     dataset: Any,
+                     parameter: Union[str, Any],
+                     columns: Sequence[Union[str, Any]],
+                     sweeps_per_chunk: int = 10,
+                     fmt: str = '%.18e') -> None:
+    """
+    Save the given columns of a swept parameter's data (e.g. power,
+    frequency and the parameter itself) as a text table with one row per
+    column, as np.savetxt(path, np.vstack(columns)) would, but reading the
+    dataset chunk by chunk, see iter_sweep_chunks.
+
+    Args:
+        path: the text file
+        dataset: the qcodes dataset
+        parameter: the dependent parameter or its full name
+        columns: names of the setpoints and the parameter to save, in order
+        sweeps_per_chunk: number of sweeps read at a time
+        fmt: format of a value
+    """
+    names = [_name(column) for column in columns]
+    with open(path, 'w') as f:
+        for name in names:
+            separator = ''
+            for chunk in iter_sweep_chunks(dataset, parameter,
+                                           sweeps_per_chunk):
+                values = np.ravel(chunk[name])
+                f.write(separator + ' '.join([fmt] * len(values))
+                        % tuple(values))
+                separator = ' '
+            f.write('\n')
@@ -10,7 +10,7 @@ inspired by qcodes/instrument_drivers/Keysight/N5230C.py
 
 from qcodes.instrument.base import Instrument
 
-from qcodes.instrument_drivers.Keysight.N52xx import PNABase
+from labcodes.drivers.N52xx_modified_for_Keysight_P9373A import PNABase
 
 class Keysight_P9373A(PNABase):
     def __init__(self, name, address, 
@@ -1,4 +1,5 @@
-from typing import Sequence, Union, Any, Tuple, List
+from typing import (Sequence, Union, Any, Tuple, List, Callable, Dict,
+                    Optional)
 import time
 import re
 import logging
@@ -9,6 +10,20 @@ from qcodes import (VisaInstrument, InstrumentChannel, ArrayParameter,
                     ChannelList)
 from qcodes.utils.validators import Ints, Numbers, Enum, Bool
 
+from labcodes.drivers.scpi_trace import ScpiTracer
+from labcodes.drivers.segments import (Segment, power_chunks,
+                                       power_sweep_segments,
+                                       segment_frequencies)
+from labcodes.drivers.settings_cache import SWEEP_SETTINGS, SettingsCache
+from labcodes.drivers.sweep_completion import (SweepCompletion,
+                                               completion_strategies)
+from labcodes.drivers.sweep_data import (LOCAL_FORMATS, TRANSFER_FORMATS,
+                                         ComplexSweepCache, SweepGeometry,
+                                         TransferStats,
+                                         complex_from_interleaved,
+                                         decode_block, read_data_blocks,
+                                         structured_traces, transfer_dtype)
+
 logger = logging.getLogger()
 
 
@@ -28,7 +43,7 @@ class VNASweep(ArrayParameter):
     def shape(self) -> Sequence[int]: # type: ignore
         if self._instrument is None:
             return (0,)
-        return (self._instrument.root_instrument.points(),)
+        return (self._instrument.root_instrument.sweep_geometry.points,)
     @shape.setter
     def shape(self, val: Sequence[int]) -> None:
         pass
@@ -38,9 +53,7 @@ class VNASweep(ArrayParameter):
         if self._instrument is None:
             raise RuntimeError("Cannot return setpoints if not attached "
                                "to instrument")
-        start = self._instrument.root_instrument.start()
-        stop = self._instrument.root_instrument.stop()
-        return (np.linspace(start, stop, self.shape[0]),)
+        return (self._instrument.root_instrument.sweep_geometry.frequencies,)
     @setpoints.setter
     def setpoints(self, val: Sequence[int]) -> None:
         pass
@@ -77,22 +90,22 @@ class FormattedSweep(VNASweep):
         root_instr = self._instrument.root_instrument
         # Check if we should run a new sweep
         if root_instr.auto_sweep():
-            print('try new sweep')
+            logger.debug("%s: starting a new sweep", self.full_name)
             prev_mode = self._instrument.run_sweep()
-            print('new sweep complete')
-        # Ask for data, setting the format to the requested form
-        self._instrument.format(self.sweep_format)
-        print('data taken')
-        data = root_instr.visa_handle.query_binary_values('CALC:DATA:FDAT?',
-                                                          datatype='f',
-                                                          is_big_endian=False)
+        data = self._instrument.read_format(self.sweep_format)
+        logger.debug("%s: read %d points", self.full_name, len(data))
         #data = np.array(data)
         #data1=[]
         #data1.append(data)
         # Restore previous state if it was changed
         if root_instr.auto_sweep():
             root_instr.sweep_mode(prev_mode)
-        print('success')
+        points = root_instr.sweep_geometry.points
+        if len(data) != points:
+            raise RuntimeError(
+                "{}: read {} points, the current sweep has {}: the data are "
+                "not those of the current sweep, run a sweep first".format(
+                    self.full_name, len(data), points))
         return data
 
 
@@ -151,6 +164,9 @@ class VNATrace(InstrumentChannel):
         super().__init__(parent, name)
         self.trace_name = trace_name
         self.trace_num = trace_num
+        # Complex data of the last sweep, shared by all formatted sweeps
+        self.sweep_cache = ComplexSweepCache()
+        self._data_buffer = None  # type: Optional[np.ndarray]
 
         def get_S_param_on_this_trace():
             return parent.ask(":CALC1:PAR" + str(self.trace_num) + ":DEF?")
@@ -177,18 +193,14 @@ class VNATrace(InstrumentChannel):
         # supported as there isn't really a good way of saving them into the
         # dataset
         # print("parameters loaded")
-        self.add_parameter('Formatoutput',
-                           label='Format of Output',
-                           get_cmd="FORM:DATA?",
-                           get_parser=str,
-                           set_cmd="FORM:DATA {}",
-                           vals=Enum('REAL', 'ASC', 'REAL32'))
-        self.Formatoutput.set('REAL32')
+        # The current display format is tracked, so that reading data in
+        # the format the trace already has costs no write
+        self.current_format = None  # type: Optional[str]
         self.add_parameter('format',
                            label='Format',
-                           get_cmd=':CALC:FORM?',
-                           set_cmd=':CALC:FORM {}',
-                           vals=Enum('MLIN', 'MLOG', 'PHAS','GDEL',
+                           get_cmd=self._get_format,
+                           set_cmd=self._set_format,
+                           vals=Enum('MLIN', 'MLOG', 'PHAS', 'UPH', 'GDEL',
                                      'IMAG', 'REAL'))
 
         # And a list of individual formats
@@ -207,6 +219,11 @@ class VNATrace(InstrumentChannel):
                            label='Phase',
                            unit='deg',
                            parameter_class=FormattedSweep)
+        self.add_parameter('unwrapped_phase',
+                           sweep_format='UPH',
+                           label='Phase',
+                           unit='deg',
+                           parameter_class=FormattedSweep)
         self.add_parameter("group_delay",
                            sweep_format='GDEL',
                            label='Group Delay',
@@ -224,13 +241,61 @@ class VNATrace(InstrumentChannel):
                            parameter_class=FormattedSweep)
 
 
+    def _get_format(self) -> str:
+        self.root_instrument.active_trace(self.trace_num)
+        self.current_format = self.ask(':CALC:FORM?').strip()
+        return self.current_format
+
+    def _set_format(self, sweep_format: str) -> None:
+        if sweep_format != self.current_format:
+            self.root_instrument.active_trace(self.trace_num)
+            self.write(':CALC:FORM {}'.format(sweep_format))
+            self.current_format = sweep_format
+
+    def read_format(self, sweep_format: str) -> np.ndarray:
+        """
+        Read the data of the current sweep in the given format, without
+        starting a new sweep
+        """
+        root_instr = self.root_instrument
+        if root_instr.local_formatting() and sweep_format in LOCAL_FORMATS:
+            # Derive the format from the complex data of this sweep, which
+            # is fetched only once for all formats
+            return self.sweep_cache.get(sweep_format, self._fetch_sweep_data,
+                                        root_instr.sweep_count)
+        # Ask for data, setting the format to the requested form
+        self.format(sweep_format)
+        root_instr.active_trace(self.trace_num)
+        return root_instr.query_data('CALC:DATA:FDAT?')
+
+    def sweep_data(self) -> np.ndarray:
+        """
+        Fetch the complex data of this trace in a single binary transfer
+        (SDATA), and keep it for deriving the formatted sweeps.
+        """
+        return self._fetch_sweep_data().copy()
+
+    def _fetch_sweep_data(self) -> np.ndarray:
+        # The data of every sweep are decoded into the same buffer, which
+        # the sweep cache refers to
+        root_instr = self.root_instrument
+        root_instr.active_trace(self.trace_num)
+        self._data_buffer = root_instr.query_data('CALC:DATA:SDAT?',
+                                                  out=self._data_buffer)
+        data = complex_from_interleaved(self._data_buffer)
+        self.sweep_cache.store(data, root_instr.sweep_count)
+        return data
+
     def run_sweep(self) -> str:
         """
         Run a set of sweeps on the network analyzer.
         Note that this will run all traces on the current channel.
         """
-        print('sweep')
         root_instr = self.root_instrument
+        logger.debug("%s: running sweep %d", root_instr.name,
+                     root_instr.sweep_count + 1)
+        # Data cached for any trace belong to the previous sweep now
+        root_instr.sweep_count += 1
         # Store previous mode
         prev_mode = root_instr.sweep_mode()
         # Take instrument out of continuous mode, and send triggers equal to
@@ -244,12 +309,13 @@ class VNATrace(InstrumentChannel):
         else:
             root_instr.sweep_mode('SING')
         """
-        root_instr.sweep_mode('SING')
-        print('single')
-        # Once the sweep mode is in hold, we know we're done
+        # Once the sweep mode is in hold, we know we're done. How we find
+        # out is up to the strategy selected with sweep_completion.
         try:
-            while root_instr.sweep_mode() =='SING':#!= 'HOLD':
-                time.sleep(0.1)
+            root_instr.completion.run(
+                root_instr,
+                start=lambda: root_instr.sweep_mode('SING'),
+                is_done=lambda: root_instr.sweep_mode() != 'SING')
         except KeyboardInterrupt:
             # If the user aborts because (s)he is stuck in the infinite loop
             # mentioned above, provide a hint of what can be wrong.
@@ -316,6 +382,13 @@ class VNABase(VisaInstrument):
           may have unexpected results.
     """
 
+    # Sweep type of segmented sweeps and their limits
+    SEGMENTED_SWEEP_TYPE = 'ISEGM'
+    MAX_POINTS = 20001
+    MAX_SEGMENTS = 50
+    # Records the bus traffic if set, see enable_tracing
+    scpi_tracer = None  # type: Optional[ScpiTracer]
+
     def __init__(self,
                  name: str,
                  address: str,
@@ -328,6 +401,32 @@ class VNABase(VisaInstrument):
         super().__init__(name, address, terminator='\n', **kwargs)
         self.min_freq = min_freq
         self.max_freq = max_freq
+        # Incremented on every triggered sweep, used to invalidate cached
+        # trace data
+        self.sweep_count = 0
+        # Points and frequencies of the sweep, invalidated by the setters of
+        # the parameters that change them
+        self.sweep_geometry = SweepGeometry(self)
+        # Responses to the gets of the static sweep settings, see
+        # labcodes.drivers.settings_cache
+        self.settings_cache = SettingsCache()
+        # Set commands and queries of the cached settings by name, for
+        # configure
+        self._setting_commands = {}  # type: Dict[str, str]
+        self._setting_queries = {}  # type: Dict[str, str]
+        # Segment table last loaded with load_segments
+        self.segment_table = None  # type: Optional[List[Segment]]
+        # Format of the trace data transfers, set once for the session.
+        # The data are decoded accordingly, and the bytes and time spent
+        # on every transfer are recorded in transfer_stats.
+        self.transfer_stats = TransferStats()
+        self._transfer_dtype = None  # type: Optional[np.dtype]
+        self.add_parameter('transfer_format',
+                           label='Transfer Format',
+                           set_cmd=self._set_transfer_format,
+                           get_cmd=None,
+                           vals=Enum(*TRANSFER_FORMATS),
+                           initial_value='REAL32')
 
         #Ports
         ports = ChannelList(self, "VNAPorts", VNAPort)
@@ -342,10 +441,12 @@ class VNABase(VisaInstrument):
         # Drive power#only low and high
         self.add_parameter('power',
                            label='Power',
-                           get_cmd=':SOUR:POW:PORT?',
+                           get_cmd=self._cached_get(
+                               'power', ':SOUR:POW:PORT?'),
                            get_parser=float,
                            set_parser=float,
-                           set_cmd='SOUR:POW:PORT {:.2f}',
+                           set_cmd=self._setting_setter(
+                               'power', 'SOUR:POW:PORT {:.2f}'),
                            unit='dBm',
                            vals=Numbers(-30,30))
         """
@@ -358,21 +459,22 @@ class VNABase(VisaInstrument):
                            set_parser=float,
                            vals=Numbers(-30, 30))
         """
+        # Frequencies of all points of the sweep, as reported by the
+        # instrument
         self.add_parameter(name='frequencyList',
                            label='Frequency list',
                            unit='Hz',
-                           get_cmd=':SENS:FREQ:DATA?',
-                           set_cmd=':SENS:FREQ:DATA {:.4f}',
-                           get_parser=float,
-                           set_parser=float,
-                           vals=Numbers(300e3, 20e9))
+                           get_cmd=self._get_frequency_list,
+                           set_cmd=False)
         # IF bandwidth
         
         self.add_parameter(name='if_bandwidth',
                            label='Intermediate Frequency Bandwidth',
                            unit='Hz',
-                           get_cmd=':SENS:BWID?',
-                           set_cmd=':SENS:BWID {}',
+                           get_cmd=self._cached_get(
+                               'if_bandwidth', ':SENS:BWID?'),
+                           set_cmd=self._setting_setter(
+                               'if_bandwidth', ':SENS:BWID {}'),
                            get_parser=float,
                            set_parser=float,
                            vals=Enum(10,20,30,50,70,100,200,300,500,700,1000,3000,5000,7000,10000))
@@ -397,8 +499,10 @@ class VNABase(VisaInstrument):
         self.add_parameter(name='start',
                            label='Start frequency',
                            unit='Hz',
-                           get_cmd=':SENS:FREQ:STAR?',
-                           set_cmd=':SENS:FREQ:STAR {:.4f}',
+                           get_cmd=self._cached_get(
+                               'start', ':SENS:FREQ:STAR?'),
+                           set_cmd=self._sweep_setter(
+                               ':SENS:FREQ:STAR {:.4f}', 'start'),
                            get_parser=float,
                            set_parser=float,
                            vals=Numbers(min_value=min_freq,
@@ -407,8 +511,10 @@ class VNABase(VisaInstrument):
         self.add_parameter(name='stop',
                            label='Stop frequency',
                            unit='Hz',
-                           get_cmd=':SENS:FREQ:STOP?',
-                           set_cmd=':SENS:FREQ:STOP {:.4f}',
+                           get_cmd=self._cached_get(
+                               'stop', ':SENS:FREQ:STOP?'),
+                           set_cmd=self._sweep_setter(
+                               ':SENS:FREQ:STOP {:.4f}', 'stop'),
                            get_parser=float,
                            set_parser=float,
                            vals=Numbers(min_value=min_freq,
@@ -417,8 +523,10 @@ class VNABase(VisaInstrument):
         self.add_parameter(name='center',
                            label='Center frequency',
                            unit='Hz',
-                           get_cmd=':SENS:FREQ:CENT?',
-                           set_cmd=':SENS:FREQ:CENT {:.4f}',
+                           get_cmd=self._cached_get(
+                               'center', ':SENS:FREQ:CENT?'),
+                           set_cmd=self._sweep_setter(
+                               ':SENS:FREQ:CENT {:.4f}', 'center'),
                            get_parser=float,
                            set_parser=float,
                            vals=Numbers(min_value=min_freq,
@@ -426,8 +534,10 @@ class VNABase(VisaInstrument):
         self.add_parameter(name='span',
                            label='Frequency span',
                            unit='Hz',
-                           get_cmd=':SENS:FREQ:SPAN?',
-                           set_cmd=':SENS:FREQ:SPAN {:.4f}',
+                           get_cmd=self._cached_get(
+                               'span', ':SENS:FREQ:SPAN?'),
+                           set_cmd=self._sweep_setter(
+                               ':SENS:FREQ:SPAN {:.4f}', 'span'),
                            get_parser=float,
                            set_parser=float,
                            vals=Numbers(min_value=100,
@@ -447,8 +557,10 @@ class VNABase(VisaInstrument):
         self.add_parameter(name='points',
                            label='Number of measurement points',
                            unit='',
-                           get_cmd=':SENS:SWE:POIN?',
-                           set_cmd=':SENS:SWE:POIN {}',
+                           get_cmd=self._cached_get(
+                               'points', ':SENS:SWE:POIN?'),
+                           set_cmd=self._sweep_setter(
+                               ':SENS:SWE:POIN {}', 'points'),
                            get_parser=int,
                            set_parser=int,
                            vals=Numbers(2, 20001))
@@ -469,6 +581,13 @@ class VNABase(VisaInstrument):
                            set_cmd=':SENS:HOLD:FUNC {}',
                            get_parser=str,
                            vals=Enum('HOLD', 'hold', 'CONT','continuous', 'SING', 'single'))
+        # Sweep type, segmented sweeps are set up with load_segments
+        self.add_parameter('sweep_type',
+                           label='Sweep Type',
+                           get_cmd=':SENS:SWE:TYPE?',
+                           get_parser=str.strip,
+                           set_cmd=self._sweep_setter(':SENS:SWE:TYPE {}'),
+                           vals=Enum('LIN', 'LOG', 'FSEGM', 'ISEGM'))
         """
         # Group trigger count
         self.add_parameter('group_trigger_count',
@@ -484,11 +603,14 @@ class VNABase(VisaInstrument):
         """
 
         # Traces
+        # The selected trace is tracked, so that selecting a trace that is
+        # already selected costs no write
+        self.selected_trace = None  # type: Optional[int]
         self.add_parameter('active_trace',
                            label='Active Trace',
-                           get_cmd="CALC1:PAR:SEL?",
+                           get_cmd=self._get_active_trace,
                            get_parser=int,
-                           set_cmd="CALC1:PAR{}:SEL")
+                           set_cmd=self._set_active_trace)
         """
         self.add_parameter('active_trace',
                            label='Active Trace',
@@ -499,11 +621,16 @@ class VNABase(VisaInstrument):
         """
         self.add_parameter('Number_Traces',
                            label='Number Traces',
-                           get_cmd="CALC1:PAR:COUN?",
+                           get_cmd=self._cached_get(
+                               'Number_Traces', 'CALC1:PAR:COUN?'),
                            get_parser=int,
-                           set_cmd="CALC1:PAR:COUN {}")
+                           set_cmd=self._set_number_of_traces)
         # Note: Traces will be accessed through the traces property which
-        # updates the channellist to include only active trace numbers
+        # updates the channellist to include only active trace numbers.
+        # Trace objects are kept in the registry by trace number and reused
+        # whenever the list is updated.
+        self._trace_count = None  # type: Optional[int]
+        self._trace_registry = {}  # type: Dict[int, VNATrace]
 
         self._traces = ChannelList(self, "VNATraces", VNATrace)
         self.add_submodule("traces", self._traces)
@@ -516,7 +643,6 @@ class VNABase(VisaInstrument):
             self.parameters[param.name] = param
             #print(param)
         # And also add a link to run sweep
-        print('in sweep')
         self.run_sweep = trace1.run_sweep
         # Set this trace to be the default (it's possible to end up in a
         # situation where no traces are selected, causing parameter snapshots
@@ -549,44 +675,470 @@ class VNABase(VisaInstrument):
                            get_cmd=None,
                            vals=Bool(),
                            initial_value=False)
-        
+
+        # How run_sweep waits for the end of the sweep, see
+        # labcodes.drivers.sweep_completion. *OPC? is not used by default,
+        # as the sweep is started through the hold function.
+        self._completion_strategies = completion_strategies()
+        self.add_parameter('sweep_completion',
+                           label='Sweep Completion',
+                           set_cmd=None,
+                           get_cmd=None,
+                           vals=Enum(*self._completion_strategies),
+                           initial_value='poll')
+
+        # Compute magnitude, phase, real and imaginary parts on the host from
+        # one complex data transfer per sweep, instead of switching the
+        # trace format and transferring the data once per format
+        self.add_parameter('local_formatting',
+                           label='Local Formatting',
+                           set_cmd=None,
+                           get_cmd=None,
+                           vals=Bool(),
+                           initial_value=True)
 
         self.connect_message()
 
     @property
     def traces(self) -> ChannelList:
         """
-        Update channel list with active traces and return the new list
+        Return the list of traces on the instrument.
+
+        The number of traces is only queried again if it may have changed
+        (i.e. after Number_Traces was set, or after refresh_traces), and
+        the existing VNATrace objects are reused.
         """
-        # Keep track of which trace was active before. This command may fail
-        # if no traces were selected.
+        if self._trace_count is None:
+            self._trace_count = self.Number_Traces.get()
+            traces = []
+            for trace_num in range(1, self._trace_count + 1):
+                if trace_num not in self._trace_registry:
+                    self._trace_registry[trace_num] = VNATrace(
+                        self, "tr{}".format(trace_num), str(trace_num),
+                        trace_num)
+                traces.append(self._trace_registry[trace_num])
+            # Only touch the channel list if the traces actually changed
+            if traces != list(self._traces):
+                # self_traces.clear() may cause problems when channellist
+                # empty
+                self._traces.clear()
+                for vna_trace in traces:
+                    self._traces.append(vna_trace)
 
+        # Return the list of traces on the instrument
+        return self._traces
 
-        # try:
-        #     active_trace = self.active_trace()
-        # except VisaIOError as e:
-        #     if e.error_code == errors.StatusCode.error_timeout:
-        #         active_trace = None
-        #     else:
-        #         raise
+    @property
+    def completion(self) -> SweepCompletion:
+        """
+        The sweep completion strategy selected with sweep_completion. Its
+        last_wait and last_overhead attributes tell how long the last
+        sweep took to complete, and by how much that exceeded sweep_time.
+        """
+        return self._completion_strategies[self.sweep_completion()]
 
+    def get_formatted(self,
+                      formats: Sequence[str],
+                      traces: Optional[Sequence[Any]] = None
+                      ) -> Dict[str, Dict[str, np.ndarray]]:
+        """
+        Read several formats of several traces from one sweep.
 
-        # Get a list of traces from the instrument and fill in the traces list
-        num_of_traces = self.Number_Traces.get()
-        # self_traces.clear() may cause problems when channellist empty
-        self._traces.clear()
-        for trace_num in range(1, num_of_traces + 1):
-            vna_trace = VNATrace(self, "tr{}".format(trace_num),
-                                 str(trace_num), trace_num)
-            self._traces.append(vna_trace)
+        The data are read grouped by format, i.e. all traces in one format
+        before switching to the next. Formats that can be derived on the
+        host (see local_formatting) cost one complex transfer per trace in
+        total.
 
-        # # Restore the active trace if there was one
-        # if active_trace:
-        #     self.active_trace(active_trace)
+        Args:
+            formats: sweep formats to read, e.g. ('MLOG', 'PHAS')
+            traces: traces to read, all traces by default
 
+        Returns:
+            the data by trace name (e.g. 'tr1') and format
+        """
+        traces = list(self.traces) if traces is None else list(traces)
+        # Check if we should run a new sweep
+        if self.auto_sweep():
+            prev_mode = self.run_sweep()
+        data = {trace.short_name: {} for trace in traces
+                }  # type: Dict[str, Dict[str, np.ndarray]]
+        for sweep_format in formats:
+            for trace in traces:
+                data[trace.short_name][sweep_format] = \
+                    trace.read_format(sweep_format)
+        # Restore previous state if it was changed
+        if self.auto_sweep():
+            self.sweep_mode(prev_mode)
+        return data
 
-        # Return the list of traces on the instrument
-        return self._traces
+    def query_data(self,
+                   query: str,
+                   out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Query trace data in the current transfer format and decode the
+        response directly into a NumPy array, see sweep_data.decode_block.
+
+        Args:
+            query: the data query, e.g. 'CALC:DATA:SDAT?'
+            out: optional buffer to decode the data into
+        """
+        transfer_format = self.transfer_format()
+        t_start = time.perf_counter()
+        self.visa_handle.write(query)
+        block = read_data_blocks(self.visa_handle, 1, transfer_format)[0]
+        self.transfer_stats.record(transfer_format, len(block),
+                                   time.perf_counter() - t_start)
+        if self.scpi_tracer is not None:
+            self.scpi_tracer.record('data', query, t_start, len(query),
+                                    len(block))
+        return decode_block(block, self._transfer_dtype, out)
+
+    def get_all_traces(self) -> np.ndarray:
+        """
+        Read the complex data and S-parameter of every trace from one
+        sweep, with as few transfers as possible: one compound query for the
+        S-parameters, and one message selecting every trace in turn and
+        querying its data, whose responses are read back to back.
+
+        The data are also kept as the traces' current sweep data, so the
+        formatted sweeps (magnitude, phase, ...) of the same sweep are
+        derived from them without further transfers.
+
+        Returns:
+            structured array with one entry per trace and the fields
+            'name', 'parameter' (e.g. 'S21') and 'data' (complex trace data)
+        """
+        traces = list(self.traces)
+        # Check if we should run a new sweep
+        if self.auto_sweep():
+            prev_mode = self.run_sweep()
+        parameters = self.ask(";".join(
+            ":CALC1:PAR{}:DEF?".format(trace.trace_num) for trace in traces))
+        transfer_format = self.transfer_format()
+        t_start = time.perf_counter()
+        self.write(";".join(
+            ":CALC1:PAR{}:SEL;:CALC1:DATA:SDAT?".format(trace.trace_num)
+            for trace in traces))
+        self.selected_trace = traces[-1].trace_num
+        t_read = time.perf_counter()
+        blocks = read_data_blocks(self.visa_handle, len(traces),
+                                  transfer_format)
+        if self.scpi_tracer is not None:
+            self.scpi_tracer.record(
+                'data', 'read {} data blocks'.format(len(traces)), t_read,
+                0, sum(len(block) for block in blocks))
+        self.transfer_stats.record(transfer_format,
+                                   sum(len(block) for block in blocks),
+                                   time.perf_counter() - t_start)
+        data = []
+        for trace, block in zip(traces, blocks):
+            trace._data_buffer = decode_block(block, self._transfer_dtype,
+                                              trace._data_buffer)
+            trace_data = complex_from_interleaved(trace._data_buffer)
+            trace.sweep_cache.store(trace_data, self.sweep_count)
+            data.append(trace_data)
+        # Restore previous state if it was changed
+        if self.auto_sweep():
+            self.sweep_mode(prev_mode)
+        return structured_traces(
+            [trace.trace_name for trace in traces],
+            [parameter.strip() for parameter in parameters.split(";")],
+            data)
+
+    def load_segments(self, segments: Sequence[Segment]) -> None:
+        """
+        Load a segment table for the index based segmented sweep, with one
+        message. It is used once sweep_type is set to SEGMENTED_SWEEP_TYPE
+        ('ISEGM'). The segments may overlap. Per segment IF bandwidths and
+        powers are enabled if any segment sets them, the others then get
+        the channel settings.
+        """
+        self._write_segments(segments)
+        self.sweep_geometry.invalidate()
+        self.settings_cache.invalidate(*SWEEP_SETTINGS)
+
+    def _write_segments(self, segments: Sequence[Segment]) -> None:
+        use_bandwidth = any(seg.if_bandwidth is not None for seg in segments)
+        use_power = any(seg.power is not None for seg in segments)
+        if_bandwidth = self.if_bandwidth() if use_bandwidth else None
+        power = self.power() if use_power else None
+        cmds = [':SENS1:ISEGM:CLE']
+        for index, seg in enumerate(segments, start=1):
+            cmds.append(':SENS1:ISEGM:ADD')
+            cmds.append(':SENS1:ISEGM{}:FREQ:STAR {:.4f}'.format(index,
+                                                                seg.start))
+            cmds.append(':SENS1:ISEGM{}:FREQ:STOP {:.4f}'.format(index,
+                                                                seg.stop))
+            cmds.append(':SENS1:ISEGM{}:SWE:POIN {:d}'.format(index,
+                                                             seg.points))
+            if use_bandwidth:
+                cmds.append(':SENS1:ISEGM{}:BWID {}'.format(
+                    index, seg.if_bandwidth or if_bandwidth))
+            if use_power:
+                cmds.append(':SENS1:ISEGM{}:POW:PORT1 {:.2f}'.format(
+                    index, power if seg.power is None else seg.power))
+        cmds.append(':SENS1:ISEGM:BWID:STAT {}'.format(
+            'ON' if use_bandwidth else 'OFF'))
+        cmds.append(':SENS1:ISEGM:POW:STAT {}'.format(
+            'ON' if use_power else 'OFF'))
+        self.write(';'.join(cmds))
+        self.segment_table = list(segments)
+
+    def power_sweep(self,
+                    powers: Sequence[float],
+                    trace: Optional['VNATrace'] = None) -> np.ndarray:
+        """
+        Repeat the current sweep at several source powers, with the whole
+        power list handed to the instrument: the frequency range (or every
+        segment of a segmented sweep) is swept once per power as segments
+        of one segmented sweep, and the data of all powers are read back
+        with one transfer. Power lists that exceed the segment or point
+        limits of the instrument are split over as few sweeps as possible.
+        The sweep type, the segment table of a segmented sweep and the
+        sweep mode are restored afterwards (the segment table of other
+        sweeps is then unknown, segment_table is None), and the sweep
+        geometry (setpoints of the formatted sweeps) is left as it is, so
+        it can be used from another thread during the power sweep.
+
+        Args:
+            powers: source powers in dBm
+            trace: trace to read, the first trace by default
+
+        Returns:
+            complex trace data with one row per power
+        """
+        trace = self.traces[0] if trace is None else trace
+        powers = np.asarray(powers, dtype=float)
+        for power in powers:
+            self.power.validate(power)
+        sweep_type = self.sweep_type()
+        segmented = self.sweep_geometry.segmented
+        frequencies = self.sweep_geometry.frequencies
+        if segmented:
+            if self.segment_table is None:
+                raise RuntimeError("The segment table of the current sweep "
+                                   "is unknown, load it with load_segments")
+            base = list(self.segment_table)
+        else:
+            base = [Segment(frequencies[0], frequencies[-1],
+                            len(frequencies))]
+        points = sum(segment.points for segment in base)
+        data = np.empty((len(powers), points), dtype=complex)
+        prev_mode = None
+        try:
+            for chunk in power_chunks(len(powers), points, self.MAX_POINTS,
+                                      self.MAX_SEGMENTS, len(base)):
+                self._write_segments(power_sweep_segments(base,
+                                                          powers[chunk]))
+                if chunk.start == 0:
+                    self.write(':SENS:SWE:TYPE {}'.format(
+                        self.SEGMENTED_SWEEP_TYPE))
+                mode = trace.run_sweep()
+                prev_mode = mode if prev_mode is None else prev_mode
+                data[chunk] = trace._fetch_sweep_data().reshape(-1, points)
+        finally:
+            if segmented:
+                self._write_segments(base)
+            else:
+                # the instrument holds the power list's table now
+                self.segment_table = None
+            self.write(':SENS:SWE:TYPE {}'.format(sweep_type))
+            # leave hold, or the data read next are the power list's
+            if prev_mode is not None:
+                self.sweep_mode(prev_mode)
+            # The segmented data are not data of the restored sweep
+            trace.sweep_cache.clear()
+        return data
+
+    def segment_frequencies(self) -> np.ndarray:
+        """
+        Frequencies of the points of the segmented sweep: computed from the
+        segment table if it was loaded with load_segments, otherwise
+        queried from the instrument (frequencyList)
+        """
+        if self.segment_table is not None:
+            return segment_frequencies(self.segment_table)
+        return self.frequencyList()
+
+    def refresh_traces(self) -> ChannelList:
+        """
+        Query the traces from the instrument again, e.g. after traces were
+        added or removed on the front panel
+        """
+        self._trace_count = None
+        return self.traces
+
+    def invalidate_caches(self) -> None:
+        """
+        Forget all cached instrument state, e.g. after settings were
+        changed on the front panel
+        """
+        self.sweep_geometry.invalidate()
+        self.settings_cache.invalidate()
+        self.segment_table = None
+        self._trace_count = None
+        self.selected_trace = None
+        for vna_trace in self._trace_registry.values():
+            vna_trace.current_format = None
+
+    def _get_active_trace(self) -> int:
+        self.selected_trace = int(self.ask("CALC1:PAR:SEL?"))
+        return self.selected_trace
+
+    def _set_active_trace(self, trace_num: int) -> None:
+        trace_num = int(trace_num)
+        if trace_num != self.selected_trace:
+            self.write("CALC1:PAR{}:SEL".format(trace_num))
+            self.selected_trace = trace_num
+
+    def _set_number_of_traces(self, count: int) -> None:
+        self.write("CALC1:PAR:COUN {}".format(count))
+        self.settings_cache.invalidate('Number_Traces')
+        self._trace_count = None
+
+    def _set_transfer_format(self, transfer_format: str) -> None:
+        cmd = {'REAL32': 'FORM:DATA REAL32',
+               'REAL64': 'FORM:DATA REAL',
+               'ASCII': 'FORM:DATA ASC'}[transfer_format]
+        self.write(cmd)
+        self._transfer_dtype = transfer_dtype(transfer_format,
+                                              big_endian=False)
+
+    def _get_frequency_list(self) -> np.ndarray:
+        # In REAL32 the frequencies are only resolved to about 1 kHz at
+        # 10 GHz, use the REAL64 transfer format where that matters
+        return self.query_data(':SENS:FREQ:DATA?').astype(float)
+
+    def _sweep_setter(self, cmd: str,
+                      name: Optional[str] = None) -> Callable[[Any], None]:
+        """
+        Make a set_cmd for a parameter that changes the sweep stimulus: it
+        writes cmd and invalidates the cached sweep geometry. If the
+        parameter is a cached setting, its name registers cmd for
+        configure.
+        """
+        if name is not None:
+            self._setting_commands[name] = cmd
+
+        def set_cmd(value: Any) -> None:
+            self.write(cmd.format(value))
+            self.sweep_geometry.invalidate()
+            self.settings_cache.invalidate(*SWEEP_SETTINGS)
+        return set_cmd
+
+    def _setting_setter(self, name: str,
+                        cmd: str) -> Callable[[Any], None]:
+        """
+        Make a set_cmd for a cached setting: it writes cmd, and the next get
+        queries the instrument again.
+        """
+        self._setting_commands[name] = cmd
+
+        def set_cmd(value: Any) -> None:
+            self.write(cmd.format(value))
+            self.settings_cache.invalidate(name)
+        return set_cmd
+
+    def _cached_get(self, name: str, cmd: str) -> Callable[[], str]:
+        """
+        Make a get_cmd that serves the response to cmd from the settings
+        cache
+        """
+        self._setting_queries[name] = cmd
+
+        def get_cmd() -> str:
+            return self.settings_cache.get(name, lambda: self.ask(cmd))
+        return get_cmd
+
+    def configure(self, strict: bool = False,
+                  **settings: Any) -> Dict[str, Any]:
+        """
+        Set several sweep settings with one message and read them back with
+        one query, e.g.
+
+            vna.configure(power=-10, center=5e9, span=1e9, points=2001,
+                          if_bandwidth=100)
+
+        All values are validated before anything is sent, and the settings
+        are written in the given order. The values read back are stored in
+        the settings cache. Values that the instrument changed (e.g. rounded
+        or coerced to an allowed IF bandwidth) are logged as warnings.
+
+        Args:
+            strict: raise a RuntimeError instead of warning if a value read
+                back differs from the one set
+            **settings: values of the cached settings (points, start, stop,
+                center, span, if_bandwidth, power) by name
+
+        Returns:
+            the values read back by name
+        """
+        unknown = [name for name in settings
+                   if name not in self._setting_commands
+                   or name not in self._setting_queries]
+        if unknown:
+            raise ValueError("Cannot configure {}, only {}".format(
+                ", ".join(unknown), ", ".join(self._setting_commands)))
+        commands = []
+        for name, value in settings.items():
+            parameter = self.parameters[name]
+            parameter.validate(value)
+            # every header starts at the root: after a ';', a header
+            # without a leading ':' is relative to the previous one
+            commands.append(':' + self._setting_commands[name].lstrip(
+                ':').format(parameter._from_value_to_raw_value(value)))
+        self.write(";".join(commands))
+        if any(name in SWEEP_SETTINGS for name in settings):
+            self.sweep_geometry.invalidate()
+            self.settings_cache.invalidate(*SWEEP_SETTINGS)
+        responses = self.ask(";".join(':' + self._setting_queries[name]
+                                      .lstrip(':')
+                                      for name in settings)).split(";")
+        confirmed = {}
+        for (name, value), response in zip(settings.items(), responses):
+            self.settings_cache.store(name, response)
+            # parsed from the cache, which also updates the parameter cache
+            confirmed[name] = self.parameters[name].get()
+            if not np.isclose(confirmed[name], value, rtol=1e-9, atol=0):
+                msg = "{}: {} was set to {} instead of {}".format(
+                    self.name, name, confirmed[name], value)
+                if strict:
+                    raise RuntimeError(msg)
+                logger.warning(msg)
+        return confirmed
+
+    def enable_tracing(self,
+                       maxlen: int = 100000,
+                       find_parameter: bool = True) -> ScpiTracer:
+        """
+        Start recording every message to the instrument, see
+        labcodes.drivers.scpi_trace. Returns the tracer, which is also kept
+        in scpi_tracer.
+        """
+        self.scpi_tracer = ScpiTracer(maxlen, find_parameter)
+        return self.scpi_tracer
+
+    def disable_tracing(self) -> Optional[ScpiTracer]:
+        """
+        Stop recording messages, returns the tracer with the events so far
+        """
+        tracer, self.scpi_tracer = self.scpi_tracer, None
+        return tracer
+
+    def write_raw(self, cmd: str) -> None:
+        if self.scpi_tracer is None:
+            return super().write_raw(cmd)
+        t_start = time.perf_counter()
+        super().write_raw(cmd)
+        self.scpi_tracer.record('write', cmd, t_start, len(cmd))
+
+    def ask_raw(self, cmd: str) -> str:
+        if self.scpi_tracer is None:
+            return super().ask_raw(cmd)
+        t_start = time.perf_counter()
+        response = super().ask_raw(cmd)
+        self.scpi_tracer.record('ask', cmd, t_start, len(cmd), len(response))
+        return response
 
     """
     def get_options(self) -> List[str]:
@@ -3,7 +3,7 @@
 Qcodes-master\qcodes\instrument_drivers\Keysight """
 
 
-from typing import Sequence, Union, Any
+from typing import Sequence, Union, Any, Callable, Dict, List, Optional
 import time
 import re
 import logging
@@ -14,6 +14,20 @@ from qcodes import (VisaInstrument, InstrumentChannel, ArrayParameter,
                     ChannelList)
 from qcodes.utils.validators import Ints, Numbers, Enum, Bool
 
+from labcodes.drivers.scpi_trace import ScpiTracer
+from labcodes.drivers.segments import (Segment, power_chunks,
+                                       power_sweep_segments,
+                                       segment_frequencies)
+from labcodes.drivers.settings_cache import SWEEP_SETTINGS, SettingsCache
+from labcodes.drivers.sweep_completion import (SweepCompletion,
+                                               completion_strategies)
+from labcodes.drivers.sweep_data import (LOCAL_FORMATS, TRANSFER_FORMATS,
+                                         ComplexSweepCache, SweepGeometry,
+                                         TransferStats,
+                                         complex_from_interleaved,
+                                         decode_block, read_data_blocks,
+                                         structured_traces, transfer_dtype)
+
 logger = logging.getLogger()
 
 class PNASweep(ArrayParameter):
@@ -32,7 +46,7 @@ class PNASweep(ArrayParameter):
     def shape(self) -> Sequence[int]: # type: ignore
         if self._instrument is None:
             return (0,)
-        return (self._instrument.root_instrument.points(),)
+        return (self._instrument.root_instrument.sweep_geometry.points,)
     @shape.setter
     def shape(self, val: Sequence[int]) -> None:
         pass
@@ -42,9 +56,7 @@ class PNASweep(ArrayParameter):
         if self._instrument is None:
             raise RuntimeError("Cannot return setpoints if not attached "
                                "to instrument")
-        start = self._instrument.root_instrument.start()
-        stop = self._instrument.root_instrument.stop()
-        return (np.linspace(start, stop, self.shape[0]),)
+        return (self._instrument.root_instrument.sweep_geometry.frequencies,)
     @setpoints.setter
     def setpoints(self, val: Sequence[int]) -> None:
         pass
@@ -79,15 +91,16 @@ class FormattedSweep(PNASweep):
         # Check if we should run a new sweep
         if root_instr.auto_sweep():
             prev_mode = self._instrument.run_sweep()
-        # Ask for data, setting the format to the requested form
-        self._instrument.format(self.sweep_format)
-        data = root_instr.visa_handle.query_binary_values('CALC:DATA? FDATA',
-                                                          datatype='f',
-                                                          is_big_endian=True)
-        data = np.array(data)
+        data = self._instrument.read_format(self.sweep_format)
         # Restore previous state if it was changed
         if root_instr.auto_sweep():
             root_instr.sweep_mode(prev_mode)
+        points = root_instr.sweep_geometry.points
+        if len(data) != points:
+            raise RuntimeError(
+                "{}: read {} points, the current sweep has {}: the data are "
+                "not those of the current sweep, run a sweep first".format(
+                    self.full_name, len(data), points))
 
         return data
 
@@ -141,6 +154,9 @@ class PNATrace(InstrumentChannel):
         super().__init__(parent, name)
         self.trace_name = trace_name
         self.trace_num = trace_num
+        # Complex data of the last sweep, shared by all formatted sweeps
+        self.sweep_cache = ComplexSweepCache()
+        self._data_buffer = None  # type: Optional[np.ndarray]
 
         # Name of parameter (i.e. S11, S21 ...)
         self.add_parameter('trace',
@@ -151,12 +167,15 @@ class PNATrace(InstrumentChannel):
         # Note: Currently parameters that return complex values are not
         # supported as there isn't really a good way of saving them into the
         # dataset
+        # The current display format is tracked, so that reading data in
+        # the format the trace already has costs no write
+        self.current_format = None  # type: Optional[str]
         self.add_parameter('format',
                            label='Format',
-                           get_cmd='CALC:FORM?',
-                           set_cmd='CALC:FORM {}',
+                           get_cmd=self._get_format,
+                           set_cmd=self._set_format,
                            vals=Enum('MLIN', 'MLOG', 'PHAS',
-                                     'UPH', 'IMAG', 'REAL'))
+                                     'UPH', 'GDEL', 'IMAG', 'REAL'))
 
         # And a list of individual formats
         self.add_parameter('magnitude',
@@ -195,12 +214,57 @@ class PNATrace(InstrumentChannel):
                            unit='LinMag',
                            parameter_class=FormattedSweep)
 
+    def _get_format(self) -> str:
+        self.current_format = self.ask('CALC:FORM?').strip()
+        return self.current_format
+
+    def _set_format(self, sweep_format: str) -> None:
+        if sweep_format != self.current_format:
+            self.write('CALC:FORM {}'.format(sweep_format))
+            self.current_format = sweep_format
+
+    def read_format(self, sweep_format: str) -> np.ndarray:
+        """
+        Read the data of the current sweep in the given format, without
+        starting a new sweep
+        """
+        root_instr = self.root_instrument
+        if root_instr.local_formatting() and sweep_format in LOCAL_FORMATS:
+            # Derive the format from the complex data of this sweep, which
+            # is fetched only once for all formats
+            return self.sweep_cache.get(sweep_format, self._fetch_sweep_data,
+                                        root_instr.sweep_count)
+        # Ask for data, setting the format to the requested form
+        self.format(sweep_format)
+        root_instr.active_trace(self.trace_num)
+        return root_instr.query_data('CALC:DATA? FDATA')
+
+    def sweep_data(self) -> np.ndarray:
+        """
+        Fetch the complex data of this trace in a single binary transfer
+        (SDATA), and keep it for deriving the formatted sweeps.
+        """
+        return self._fetch_sweep_data().copy()
+
+    def _fetch_sweep_data(self) -> np.ndarray:
+        # The data of every sweep are decoded into the same buffer, which
+        # the sweep cache refers to
+        root_instr = self.root_instrument
+        root_instr.active_trace(self.trace_num)
+        self._data_buffer = root_instr.query_data('CALC:DATA? SDATA',
+                                                  out=self._data_buffer)
+        data = complex_from_interleaved(self._data_buffer)
+        self.sweep_cache.store(data, root_instr.sweep_count)
+        return data
+
     def run_sweep(self) -> str:
         """
         Run a set of sweeps on the network analyzer.
         Note that this will run all traces on the current channel.
         """
         root_instr = self.root_instrument
+        # Data cached for any trace belong to the previous sweep now
+        root_instr.sweep_count += 1
         # Store previous mode
         prev_mode = root_instr.sweep_mode()
         # Take instrument out of continuous mode, and send triggers equal to
@@ -209,14 +273,17 @@ class PNATrace(InstrumentChannel):
             avg = root_instr.averages()
             root_instr.reset_averages()
             root_instr.group_trigger_count(avg)
-            root_instr.sweep_mode('GRO')
+            mode = 'GRO'
         else:
-            root_instr.sweep_mode('SING')
+            mode = 'SING'
 
-        # Once the sweep mode is in hold, we know we're done
+        # Once the sweep mode is in hold, we know we're done. How we find
+        # out is up to the strategy selected with sweep_completion.
         try:
-            while root_instr.sweep_mode() != 'HOLD':
-                time.sleep(0.1)
+            root_instr.completion.run(
+                root_instr,
+                start=lambda: root_instr.sweep_mode(mode),
+                is_done=lambda: root_instr.sweep_mode() == 'HOLD')
         except KeyboardInterrupt:
             # If the user aborts because (s)he is stuck in the infinite loop
             # mentioned above, provide a hint of what can be wrong.
@@ -241,6 +308,17 @@ class PNATrace(InstrumentChannel):
         self.root_instrument.active_trace(self.trace_num)
         super().write(cmd)
 
+    def write_batch(self, *cmds: str) -> None:
+        """
+        Write several commands for this trace in a single message, with
+        one trace selection in front if the trace is not selected yet
+        """
+        root_instr = self.root_instrument
+        if root_instr.selected_trace != self.trace_num:
+            cmds = ("CALC:PAR:MNUM {}".format(self.trace_num),) + cmds
+            root_instr.selected_trace = self.trace_num
+        super().write(";:".join(cmd.lstrip(":") for cmd in cmds))
+
     def ask(self, cmd: str) -> str:
         """
         Select correct trace before querying
@@ -279,6 +357,13 @@ class PNABase(VisaInstrument):
           may have unexpected results.
     """
 
+    # Sweep type of segmented sweeps and their limits
+    SEGMENTED_SWEEP_TYPE = 'SEGM'
+    MAX_POINTS = 100001
+    MAX_SEGMENTS = 201
+    # Records the bus traffic if set, see enable_tracing
+    scpi_tracer = None  # type: Optional[ScpiTracer]
+
     def __init__(self,
                  name: str,
                  address: str,
@@ -291,6 +376,34 @@ class PNABase(VisaInstrument):
         super().__init__(name, address, terminator='\n', **kwargs)
         self.min_freq = min_freq
         self.max_freq = max_freq
+        # Incremented on every triggered sweep, used to invalidate cached
+        # trace data
+        self.sweep_count = 0
+        # Points and frequencies of the sweep, invalidated by the setters of
+        # the parameters that change them
+        self.sweep_geometry = SweepGeometry(self)
+        # Responses to the gets of the static sweep settings, see
+        # labcodes.drivers.settings_cache
+        self.settings_cache = SettingsCache()
+        # Set commands and queries of the cached settings by name, for
+        # configure
+        self._setting_commands = {}  # type: Dict[str, str]
+        self._setting_queries = {}  # type: Dict[str, str]
+        # Segment table last loaded with load_segments
+        self.segment_table = None  # type: Optional[List[Segment]]
+        # Format of the trace data transfers, set once for the session.
+        # The data are decoded accordingly, and the bytes and time spent
+        # on every transfer are recorded in transfer_stats.
+        # Binary blocks are sent big endian
+        self.write('FORM:BORD NORM')
+        self.transfer_stats = TransferStats()
+        self._transfer_dtype = None  # type: Optional[np.dtype]
+        self.add_parameter('transfer_format',
+                           label='Transfer Format',
+                           set_cmd=self._set_transfer_format,
+                           get_cmd=None,
+                           vals=Enum(*TRANSFER_FORMATS),
+                           initial_value='REAL32')
 
         #Ports
         ports = ChannelList(self, "PNAPorts", PNAPort)
@@ -305,9 +418,11 @@ class PNABase(VisaInstrument):
         # Drive power
         self.add_parameter('power',
                            label='Power',
-                           get_cmd='SOUR:POW?',
+                           get_cmd=self._cached_get(
+                               'power', 'SOUR:POW?'),
                            get_parser=float,
-                           set_cmd='SOUR:POW {:.2f}',
+                           set_cmd=self._setting_setter(
+                               'power', 'SOUR:POW {:.2f}'),
                            unit='dBm',
                            vals=Numbers(min_value=min_power,
                                         max_value=max_power))
@@ -315,9 +430,11 @@ class PNABase(VisaInstrument):
         # IF bandwidth
         self.add_parameter('if_bandwidth',
                            label='IF Bandwidth',
-                           get_cmd='SENS:BAND?',
+                           get_cmd=self._cached_get(
+                               'if_bandwidth', 'SENS:BAND?'),
                            get_parser=float,
-                           set_cmd='SENS:BAND {:.2f}',
+                           set_cmd=self._setting_setter(
+                               'if_bandwidth', 'SENS:BAND {:.2f}'),
                            unit='Hz',
                            vals=Numbers(min_value=1, max_value=15e6))
 
@@ -338,33 +455,41 @@ class PNABase(VisaInstrument):
         # Setting frequency range
         self.add_parameter('start',
                            label='Start Frequency',
-                           get_cmd='SENS:FREQ:STAR?',
+                           get_cmd=self._cached_get(
+                               'start', 'SENS:FREQ:STAR?'),
                            get_parser=float,
-                           set_cmd='SENS:FREQ:STAR {}',
+                           set_cmd=self._sweep_setter(
+                               'SENS:FREQ:STAR {}', 'start'),
                            unit='Hz',
                            vals=Numbers(min_value=min_freq,
                                         max_value=max_freq))
         self.add_parameter('stop',
                            label='Stop Frequency',
-                           get_cmd='SENS:FREQ:STOP?',
+                           get_cmd=self._cached_get(
+                               'stop', 'SENS:FREQ:STOP?'),
                            get_parser=float,
-                           set_cmd='SENS:FREQ:STOP {}',
+                           set_cmd=self._sweep_setter(
+                               'SENS:FREQ:STOP {}', 'stop'),
                            unit='Hz',
                            vals=Numbers(min_value=min_freq,
                                         max_value=max_freq))
         self.add_parameter('center',
                            label='Center Frequency',
-                           get_cmd='SENS:FREQ:CENT?',
+                           get_cmd=self._cached_get(
+                               'center', 'SENS:FREQ:CENT?'),
                            get_parser=float,
-                           set_cmd='SENS:FREQ:CENT {}',
+                           set_cmd=self._sweep_setter(
+                               'SENS:FREQ:CENT {}', 'center'),
                            unit='Hz',
                            vals=Numbers(min_value=min_freq,
                                         max_value=max_freq))
         self.add_parameter('span',
                            label='Frequency Span',
-                           get_cmd='SENS:FREQ:SPAN?',
+                           get_cmd=self._cached_get(
+                               'span', 'SENS:FREQ:SPAN?'),
                            get_parser=float,
-                           set_cmd='SENS:FREQ:SPAN {}',
+                           set_cmd=self._sweep_setter(
+                               'SENS:FREQ:SPAN {}', 'span'),
                            unit='Hz',
                            vals=Numbers(min_value=min_freq,
                                         max_value=max_freq))
@@ -372,11 +497,20 @@ class PNABase(VisaInstrument):
         # Number of points in a sweep
         self.add_parameter('points',
                            label='Points',
-                           get_cmd='SENS:SWE:POIN?',
+                           get_cmd=self._cached_get(
+                               'points', 'SENS:SWE:POIN?'),
                            get_parser=int,
-                           set_cmd='SENS:SWE:POIN {}',
+                           set_cmd=self._sweep_setter(
+                               'SENS:SWE:POIN {}', 'points'),
                            unit='',
                            vals=Numbers(min_value=1, max_value=100001))
+        # Frequencies of all points of the sweep, as reported by the
+        # instrument
+        self.add_parameter('frequencyList',
+                           label='Frequency list',
+                           get_cmd=self._get_frequency_list,
+                           set_cmd=False,
+                           unit='Hz')
 
         # Electrical delay
         self.add_parameter('electrical_delay',
@@ -400,6 +534,14 @@ class PNABase(VisaInstrument):
                            get_cmd='SENS:SWE:MODE?',
                            set_cmd='SENS:SWE:MODE {}',
                            vals=Enum("HOLD", "CONT", "GRO", "SING"))
+        # Sweep type, segmented sweeps are set up with load_segments
+        self.add_parameter('sweep_type',
+                           label='Sweep Type',
+                           get_cmd='SENS:SWE:TYPE?',
+                           get_parser=str.strip,
+                           set_cmd=self._sweep_setter('SENS:SWE:TYPE {}'),
+                           vals=Enum('LIN', 'LOG', 'POW', 'CW', 'SEGM',
+                                     'PHAS'))
         # Group trigger count
         self.add_parameter('group_trigger_count',
                            get_cmd="SENS:SWE:GRO:COUN?",
@@ -413,14 +555,21 @@ class PNABase(VisaInstrument):
                            vals=Enum("EXT", "IMM", "MAN"))
 
         # Traces
+        # The selected measurement number is tracked, so that selecting a
+        # trace that is already selected costs no write
+        self.selected_trace = None  # type: Optional[int]
         self.add_parameter('active_trace',
                            label='Active Trace',
-                           get_cmd="CALC:PAR:MNUM?",
+                           get_cmd=self._get_active_trace,
                            get_parser=int,
-                           set_cmd="CALC:PAR:MNUM {}",
+                           set_cmd=self._set_active_trace,
                            vals=Numbers(min_value=1, max_value=24))
         # Note: Traces will be accessed through the traces property which
-        # updates the channellist to include only active trace numbers
+        # updates the channellist to include only active trace numbers.
+        # Trace objects are kept in the registry by trace name and reused
+        # whenever the list is updated.
+        self._trace_catalog = None  # type: Optional[str]
+        self._trace_registry = {}  # type: Dict[str, PNATrace]
         self._traces = ChannelList(self, "PNATraces", PNATrace)
         self.add_submodule("traces", self._traces)
         # Add shortcuts to first trace
@@ -444,43 +593,469 @@ class PNABase(VisaInstrument):
                            vals=Bool(),
                            initial_value=True)
 
-        # A default output format on initialisation
-        self.write('FORM REAL,32')
-        self.write('FORM:BORD NORM')
+        # How run_sweep waits for the end of the sweep, see
+        # labcodes.drivers.sweep_completion
+        self._completion_strategies = completion_strategies()
+        self.add_parameter('sweep_completion',
+                           label='Sweep Completion',
+                           set_cmd=None,
+                           get_cmd=None,
+                           vals=Enum(*self._completion_strategies),
+                           initial_value='opc')
+
+        # Compute magnitude, phase, real and imaginary parts on the host from
+        # one complex data transfer per sweep, instead of switching the
+        # trace format and transferring the data once per format
+        self.add_parameter('local_formatting',
+                           label='Local Formatting',
+                           set_cmd=None,
+                           get_cmd=None,
+                           vals=Bool(),
+                           initial_value=True)
 
         self.connect_message()
 
     @property
     def traces(self) -> ChannelList:
         """
-        Update channel list with active traces and return the new list
+        Return the list of traces on the instrument.
+
+        The trace catalog is only fetched again if it may have changed
+        (after refresh_traces), and existing PNATrace objects are reused, so
+        only traces that are new on the instrument need to be selected to
+        look up their measurement number.
         """
-        # Keep track of which trace was active before. This command may fail
-        # if no traces were selected.
-        try:
-            active_trace = self.active_trace()
-        except VisaIOError as e:
-            if e.error_code == errors.StatusCode.error_timeout:
-                active_trace = None
-            else:
-                raise
+        if self._trace_catalog is not None:
+            return self._traces
 
-        # Get a list of traces from the instrument and fill in the traces list
-        parlist = self.get_trace_catalog().split(",")
-        self._traces.clear()
-        for trace_name in parlist[::2]:
-            trace_num = self.select_trace_by_name(trace_name)
-            pna_trace = PNATrace(self, "tr{}".format(trace_num),
-                                 trace_name, trace_num)
-            self._traces.append(pna_trace)
+        self._trace_catalog = self.get_trace_catalog()
+        trace_names = self._trace_catalog.split(",")[::2]
+        new_names = [trace_name for trace_name in trace_names
+                     if trace_name not in self._trace_registry]
+        if new_names:
+            # Keep track of which trace was active before. This command may
+            # fail if no traces were selected.
+            try:
+                active_trace = self.active_trace()
+            except VisaIOError as e:
+                if e.error_code == errors.StatusCode.error_timeout:
+                    active_trace = None
+                else:
+                    raise
 
-        # Restore the active trace if there was one
-        if active_trace:
-            self.active_trace(active_trace)
+            for trace_name in new_names:
+                trace_num = self.select_trace_by_name(trace_name)
+                self._trace_registry[trace_name] = PNATrace(
+                    self, "tr{}".format(trace_num), trace_name, trace_num)
+
+            # Restore the active trace if there was one
+            if active_trace:
+                self.active_trace(active_trace)
+
+        # Fill in the traces list, if the traces actually changed
+        traces = [self._trace_registry[trace_name]
+                  for trace_name in trace_names]
+        if traces != list(self._traces):
+            self._traces.clear()
+            for pna_trace in traces:
+                self._traces.append(pna_trace)
 
         # Return the list of traces on the instrument
         return self._traces
 
+    @property
+    def completion(self) -> SweepCompletion:
+        """
+        The sweep completion strategy selected with sweep_completion. Its
+        last_wait and last_overhead attributes tell how long the last
+        sweep took to complete, and by how much that exceeded sweep_time.
+        """
+        return self._completion_strategies[self.sweep_completion()]
+
+    def get_formatted(self,
+                      formats: Sequence[str],
+                      traces: Optional[Sequence[Any]] = None
+                      ) -> Dict[str, Dict[str, np.ndarray]]:
+        """
+        Read several formats of several traces from one sweep.
+
+        The data are read grouped by format, i.e. all traces in one format
+        before switching to the next. Formats that can be derived on the
+        host (see local_formatting) cost one complex transfer per trace in
+        total.
+
+        Args:
+            formats: sweep formats to read, e.g. ('MLOG', 'PHAS')
+            traces: traces to read, all traces by default
+
+        Returns:
+            the data by trace name (e.g. 'tr1') and format
+        """
+        traces = list(self.traces) if traces is None else list(traces)
+        # Check if we should run a new sweep
+        if self.auto_sweep():
+            prev_mode = self.run_sweep()
+        data = {trace.short_name: {} for trace in traces
+                }  # type: Dict[str, Dict[str, np.ndarray]]
+        for sweep_format in formats:
+            for trace in traces:
+                data[trace.short_name][sweep_format] = \
+                    trace.read_format(sweep_format)
+        # Restore previous state if it was changed
+        if self.auto_sweep():
+            self.sweep_mode(prev_mode)
+        return data
+
+    def query_data(self,
+                   query: str,
+                   out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Query trace data in the current transfer format and decode the
+        response directly into a NumPy array, see sweep_data.decode_block.
+
+        Args:
+            query: the data query, e.g. 'CALC:DATA? SDATA'
+            out: optional buffer to decode the data into
+        """
+        transfer_format = self.transfer_format()
+        t_start = time.perf_counter()
+        self.visa_handle.write(query)
+        block = read_data_blocks(self.visa_handle, 1, transfer_format)[0]
+        self.transfer_stats.record(transfer_format, len(block),
+                                   time.perf_counter() - t_start)
+        if self.scpi_tracer is not None:
+            self.scpi_tracer.record('data', query, t_start, len(query),
+                                    len(block))
+        return decode_block(block, self._transfer_dtype, out)
+
+    def get_all_traces(self) -> np.ndarray:
+        """
+        Read the complex data and S-parameter of every trace from one
+        sweep, with as few transfers as possible: one catalog query for the
+        S-parameters, and one message with a data query per trace whose
+        responses are read back to back.
+
+        The data are also kept as the traces' current sweep data, so the
+        formatted sweeps (magnitude, phase, ...) of the same sweep are
+        derived from them without further transfers.
+
+        Returns:
+            structured array with one entry per trace and the fields
+            'name', 'parameter' (e.g. 'S21') and 'data' (complex trace data)
+        """
+        traces = list(self.traces)
+        # Check if we should run a new sweep
+        if self.auto_sweep():
+            prev_mode = self.run_sweep()
+        specs = self.get_trace_catalog().split(',')
+        parameters = dict(zip(specs[0::2], specs[1::2]))
+        transfer_format = self.transfer_format()
+        t_start = time.perf_counter()
+        self.write(";:".join("CALC:MEAS{}:DATA:SDATA?".format(trace.trace_num)
+                             for trace in traces))
+        t_read = time.perf_counter()
+        blocks = read_data_blocks(self.visa_handle, len(traces),
+                                  transfer_format)
+        if self.scpi_tracer is not None:
+            self.scpi_tracer.record(
+                'data', 'read {} data blocks'.format(len(traces)), t_read,
+                0, sum(len(block) for block in blocks))
+        self.transfer_stats.record(transfer_format,
+                                   sum(len(block) for block in blocks),
+                                   time.perf_counter() - t_start)
+        data = []
+        for trace, block in zip(traces, blocks):
+            trace._data_buffer = decode_block(block, self._transfer_dtype,
+                                              trace._data_buffer)
+            trace_data = complex_from_interleaved(trace._data_buffer)
+            trace.sweep_cache.store(trace_data, self.sweep_count)
+            data.append(trace_data)
+        # Restore previous state if it was changed
+        if self.auto_sweep():
+            self.sweep_mode(prev_mode)
+        return structured_traces(
+            [trace.trace_name for trace in traces],
+            [parameters.get(trace.trace_name, '') for trace in traces],
+            data)
+
+    def load_segments(self, segments: Sequence[Segment]) -> None:
+        """
+        Load a segment table with one message (SENS:SEGM:LIST). It is used
+        once sweep_type is set to SEGMENTED_SWEEP_TYPE ('SEGM'). Arbitrary
+        segments are enabled, so the segments may overlap, and per segment
+        IF bandwidths and powers are always used; segments that do not set
+        them get the channel settings.
+        """
+        self._write_segments(segments)
+        self.sweep_geometry.invalidate()
+        self.settings_cache.invalidate(*SWEEP_SETTINGS)
+
+    def _write_segments(self, segments: Sequence[Segment]) -> None:
+        if_bandwidth = self.if_bandwidth()
+        power = self.power()
+        fields = []
+        for seg in segments:
+            fields.append('1,{:d},{},{},{},0,{:.2f}'.format(
+                seg.points, seg.start, seg.stop,
+                seg.if_bandwidth or if_bandwidth,
+                power if seg.power is None else seg.power))
+        self.write('SENS:SEGM:DEL:ALL;:SENS:SEGM:ARB ON;'
+                   ':SENS:SEGM:BWID:CONT ON;:SENS:SEGM:POW:CONT ON;'
+                   ':SENS:SEGM:LIST SSTOP,{},{}'.format(len(segments),
+                                                       ','.join(fields)))
+        self.segment_table = list(segments)
+
+    def power_sweep(self,
+                    powers: Sequence[float],
+                    trace: Optional['PNATrace'] = None) -> np.ndarray:
+        """
+        Repeat the current sweep at several source powers, with the whole
+        power list handed to the instrument: the frequency range (or every
+        segment of a segmented sweep) is swept once per power as segments
+        of one segmented sweep, and the data of all powers are read back
+        with one transfer. Power lists that exceed the segment or point
+        limits of the instrument are split over as few sweeps as possible.
+        The sweep type, the segment table of a segmented sweep and the
+        sweep mode are restored afterwards (the segment table of other
+        sweeps is then unknown, segment_table is None), and the sweep
+        geometry (setpoints of the formatted sweeps) is left as it is, so
+        it can be used from another thread during the power sweep.
+
+        Args:
+            powers: source powers in dBm
+            trace: trace to read, the first trace by default
+
+        Returns:
+            complex trace data with one row per power
+        """
+        trace = self.traces[0] if trace is None else trace
+        powers = np.asarray(powers, dtype=float)
+        for power in powers:
+            self.power.validate(power)
+        sweep_type = self.sweep_type()
+        segmented = self.sweep_geometry.segmented
+        frequencies = self.sweep_geometry.frequencies
+        if segmented:
+            if self.segment_table is None:
+                raise RuntimeError("The segment table of the current sweep "
+                                   "is unknown, load it with load_segments")
+            base = list(self.segment_table)
+        else:
+            base = [Segment(frequencies[0], frequencies[-1],
+                            len(frequencies))]
+        points = sum(segment.points for segment in base)
+        data = np.empty((len(powers), points), dtype=complex)
+        prev_mode = None
+        try:
+            for chunk in power_chunks(len(powers), points, self.MAX_POINTS,
+                                      self.MAX_SEGMENTS, len(base)):
+                self._write_segments(power_sweep_segments(base,
+                                                          powers[chunk]))
+                if chunk.start == 0:
+                    self.write('SENS:SWE:TYPE {}'.format(
+                        self.SEGMENTED_SWEEP_TYPE))
+                mode = trace.run_sweep()
+                prev_mode = mode if prev_mode is None else prev_mode
+                data[chunk] = trace._fetch_sweep_data().reshape(-1, points)
+        finally:
+            if segmented:
+                self._write_segments(base)
+            else:
+                # the instrument holds the power list's table now
+                self.segment_table = None
+            self.write('SENS:SWE:TYPE {}'.format(sweep_type))
+            # leave hold, or the data read next are the power list's
+            if prev_mode is not None:
+                self.sweep_mode(prev_mode)
+            # The segmented data are not data of the restored sweep
+            trace.sweep_cache.clear()
+        return data
+
+    def segment_frequencies(self) -> np.ndarray:
+        """
+        Frequencies of the points of the segmented sweep: computed from the
+        segment table if it was loaded with load_segments, otherwise
+        queried from the instrument (frequencyList)
+        """
+        if self.segment_table is not None:
+            return segment_frequencies(self.segment_table)
+        return self.frequencyList()
+
+    def refresh_traces(self) -> ChannelList:
+        """
+        Fetch the trace catalog from the instrument again, e.g. after traces
+        were added or removed on the front panel
+        """
+        self._trace_catalog = None
+        return self.traces
+
+    def invalidate_caches(self) -> None:
+        """
+        Forget all cached instrument state, e.g. after settings were
+        changed on the front panel
+        """
+        self.sweep_geometry.invalidate()
+        self.settings_cache.invalidate()
+        self.segment_table = None
+        self._trace_catalog = None
+        self.selected_trace = None
+        for pna_trace in self._trace_registry.values():
+            pna_trace.current_format = None
+
+    def _get_active_trace(self) -> int:
+        self.selected_trace = int(self.ask("CALC:PAR:MNUM?"))
+        return self.selected_trace
+
+    def _set_active_trace(self, trace_num: int) -> None:
+        trace_num = int(trace_num)
+        if trace_num != self.selected_trace:
+            self.write("CALC:PAR:MNUM {}".format(trace_num))
+            self.selected_trace = trace_num
+
+    def _set_transfer_format(self, transfer_format: str) -> None:
+        cmd = {'REAL32': 'FORM REAL,32',
+               'REAL64': 'FORM REAL,64',
+               'ASCII': 'FORM ASC,0'}[transfer_format]
+        self.write(cmd)
+        self._transfer_dtype = transfer_dtype(transfer_format,
+                                              big_endian=True)
+
+    def _get_frequency_list(self) -> np.ndarray:
+        # In REAL32 the frequencies are only resolved to about 1 kHz at
+        # 10 GHz, use the REAL64 transfer format where that matters
+        return self.query_data('SENS:X?').astype(float)
+
+    def _sweep_setter(self, cmd: str,
+                      name: Optional[str] = None) -> Callable[[Any], None]:
+        """
+        Make a set_cmd for a parameter that changes the sweep stimulus: it
+        writes cmd and invalidates the cached sweep geometry. If the
+        parameter is a cached setting, its name registers cmd for
+        configure.
+        """
+        if name is not None:
+            self._setting_commands[name] = cmd
+
+        def set_cmd(value: Any) -> None:
+            self.write(cmd.format(value))
+            self.sweep_geometry.invalidate()
+            self.settings_cache.invalidate(*SWEEP_SETTINGS)
+        return set_cmd
+
+    def _setting_setter(self, name: str,
+                        cmd: str) -> Callable[[Any], None]:
+        """
+        Make a set_cmd for a cached setting: it writes cmd, and the next get
+        queries the instrument again.
+        """
+        self._setting_commands[name] = cmd
+
+        def set_cmd(value: Any) -> None:
+            self.write(cmd.format(value))
+            self.settings_cache.invalidate(name)
+        return set_cmd
+
+    def _cached_get(self, name: str, cmd: str) -> Callable[[], str]:
+        """
+        Make a get_cmd that serves the response to cmd from the settings
+        cache
+        """
+        self._setting_queries[name] = cmd
+
+        def get_cmd() -> str:
+            return self.settings_cache.get(name, lambda: self.ask(cmd))
+        return get_cmd
+
+    def configure(self, strict: bool = False,
+                  **settings: Any) -> Dict[str, Any]:
+        """
+        Set several sweep settings with one message and read them back with
+        one query, e.g.
+
+            vna.configure(power=-10, center=5e9, span=1e9, points=2001,
+                          if_bandwidth=100)
+
+        All values are validated before anything is sent, and the settings
+        are written in the given order. The values read back are stored in
+        the settings cache. Values that the instrument changed (e.g. rounded
+        or coerced to an allowed IF bandwidth) are logged as warnings.
+
+        Args:
+            strict: raise a RuntimeError instead of warning if a value read
+                back differs from the one set
+            **settings: values of the cached settings (points, start, stop,
+                center, span, if_bandwidth, power) by name
+
+        Returns:
+            the values read back by name
+        """
+        unknown = [name for name in settings
+                   if name not in self._setting_commands
+                   or name not in self._setting_queries]
+        if unknown:
+            raise ValueError("Cannot configure {}, only {}".format(
+                ", ".join(unknown), ", ".join(self._setting_commands)))
+        commands = []
+        for name, value in settings.items():
+            parameter = self.parameters[name]
+            parameter.validate(value)
+            # every header starts at the root: after a ';', a header
+            # without a leading ':' is relative to the previous one
+            commands.append(':' + self._setting_commands[name].lstrip(
+                ':').format(parameter._from_value_to_raw_value(value)))
+        self.write(";".join(commands))
+        if any(name in SWEEP_SETTINGS for name in settings):
+            self.sweep_geometry.invalidate()
+            self.settings_cache.invalidate(*SWEEP_SETTINGS)
+        responses = self.ask(";".join(':' + self._setting_queries[name]
+                                      .lstrip(':')
+                                      for name in settings)).split(";")
+        confirmed = {}
+        for (name, value), response in zip(settings.items(), responses):
+            self.settings_cache.store(name, response)
+            # parsed from the cache, which also updates the parameter cache
+            confirmed[name] = self.parameters[name].get()
+            if not np.isclose(confirmed[name], value, rtol=1e-9, atol=0):
+                msg = "{}: {} was set to {} instead of {}".format(
+                    self.name, name, confirmed[name], value)
+                if strict:
+                    raise RuntimeError(msg)
+                logger.warning(msg)
+        return confirmed
+
+    def enable_tracing(self,
+                       maxlen: int = 100000,
+                       find_parameter: bool = True) -> ScpiTracer:
+        """
+        Start recording every message to the instrument, see
+        labcodes.drivers.scpi_trace. Returns the tracer, which is also kept
+        in scpi_tracer.
+        """
+        self.scpi_tracer = ScpiTracer(maxlen, find_parameter)
+        return self.scpi_tracer
+
+    def disable_tracing(self) -> Optional[ScpiTracer]:
+        """
+        Stop recording messages, returns the tracer with the events so far
+        """
+        tracer, self.scpi_tracer = self.scpi_tracer, None
+        return tracer
+
+    def write_raw(self, cmd: str) -> None:
+        if self.scpi_tracer is None:
+            return super().write_raw(cmd)
+        t_start = time.perf_counter()
+        super().write_raw(cmd)
+        self.scpi_tracer.record('write', cmd, t_start, len(cmd))
+
+    def ask_raw(self, cmd: str) -> str:
+        if self.scpi_tracer is None:
+            return super().ask_raw(cmd)
+        t_start = time.perf_counter()
+        response = super().ask_raw(cmd)
+        self.scpi_tracer.record('ask', cmd, t_start, len(cmd), len(response))
+        return response
+
     def get_options(self) -> Sequence[str]:
         # Query the instrument for what options are installed
         return self.ask('*OPT?').strip('"').split(',')
@@ -0,0 +1,191 @@
+"""
+Opt-in tracing of the bus traffic of an instrument.
+
+With tracing enabled on a VNA (vna.enable_tracing()), every write, query
+and binary data transfer is recorded as a TraceEvent: the command, the
+bytes sent and received, how long it took and the qcodes parameter that
+caused it, e.g. 'VNA_tr1_magnitude' for the queries of a magnitude get.
+The events are kept in a ring buffer of fixed length, so tracing can be
+left on during long measurements.
+
+The events can be summarized per command or parameter (summary), binned
+by latency (histogram) or saved in the Chrome trace event format
+(save_chrome_trace), which can be viewed in chrome://tracing or
+https://ui.perfetto.dev as a timeline of all threads.
+"""
+
+import collections
+import json
+import sys
+import threading
+import time
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from qcodes.instrument.parameter import _BaseParameter
+
+
+class TraceEvent(NamedTuple):
+    """
+    One message exchanged with the instrument. start is a time.perf_counter
+    value, start and duration are in seconds.
+    """
+    kind: str
+    command: str
+    start: float
+    duration: float
+    bytes_out: int
+    bytes_in: int
+    parameter: Optional[str]
+    thread: int
+
+
+def calling_parameter(max_depth: int = 40) -> Optional[str]:
+    """
+    Full name of the innermost qcodes parameter on the call stack, i.e. the
+    parameter whose get or set sends the current message
+    """
+    frame = sys._getframe(1)
+    depth = 0
+    while frame is not None and depth < max_depth:
+        owner = frame.f_locals.get('self')
+        if isinstance(owner, _BaseParameter):
+            return owner.full_name
+        frame = frame.f_back
+        depth += 1
+    return None
+
+
+def command_header(command: str) -> str:
+    """
+    The command without its arguments, e.g. 'SENS:SWE:POIN' for
+    'SENS:SWE:POIN 201'. The headers of compound messages are joined by ';'.
+    """
+    return ';'.join(part.strip().split(' ', 1)[0]
+                    for part in command.split(';') if part.strip())
+
+
+class ScpiTracer:
+    """
+    Ring buffer of the last maxlen TraceEvents of an instrument.
+
+    Args:
+        maxlen: number of events kept
+        find_parameter: look up the calling parameter of every message,
+            which costs a few microseconds per message
+    """
+
+    def __init__(self, maxlen: int = 100000,
+                 find_parameter: bool = True) -> None:
+        self.events = collections.deque(maxlen=maxlen
+                                        )  # type: Deque[TraceEvent]
+        self.find_parameter = find_parameter
+        self.origin = time.perf_counter()
+
+    def clear(self) -> None:
+        self.events.clear()
+        self.origin = time.perf_counter()
+
+    def record(self,
+               kind: str,
+               command: str,
+               start: float,
+               bytes_out: int = 0,
+               bytes_in: int = 0) -> None:
+        """
+        Record a message that was started at start (time.perf_counter) and
+        has finished now
+        """
+        duration = time.perf_counter() - start
+        parameter = calling_parameter() if self.find_parameter else None
+        self.events.append(TraceEvent(kind, command, start, duration,
+                                      bytes_out, bytes_in, parameter,
+                                      threading.get_ident()))
+
+    def summary(self, by: str = 'command') -> Dict[str, Dict[str, float]]:
+        """
+        Statistics of the events grouped by command header ('command'),
+        calling parameter ('parameter') or kind ('kind'): number of
+        events, total, mean, median, 90th percentile and maximum duration
+        in seconds, and the bytes moved. Sorted by total duration.
+        """
+        if by not in ('command', 'parameter', 'kind'):
+            raise ValueError("by must be 'command', 'parameter' or 'kind'")
+        groups = collections.defaultdict(list
+                                         )  # type: Dict[str, List[TraceEvent]]
+        for event in list(self.events):
+            if by == 'command':
+                key = command_header(event.command)
+            else:
+                key = str(getattr(event, by))
+            groups[key].append(event)
+        summary = {}
+        for key, events in groups.items():
+            durations = np.array([event.duration for event in events])
+            summary[key] = {
+                'count': len(events),
+                'total': float(durations.sum()),
+                'mean': float(durations.mean()),
+                'p50': float(np.percentile(durations, 50)),
+                'p90': float(np.percentile(durations, 90)),
+                'max': float(durations.max()),
+                'bytes': sum(event.bytes_out + event.bytes_in
+                             for event in events)}
+        return dict(sorted(summary.items(),
+                           key=lambda item: item[1]['total'], reverse=True))
+
+    def histogram(self,
+                  bins: Any = None,
+                  key: Optional[str] = None,
+                  by: str = 'command') -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Histogram of the durations of the events, or of the events of one
+        command header or parameter (key, see summary).
+
+        Args:
+            bins: bin edges in seconds, logarithmic from 10 us to 100 s by
+                default
+            key: only count events of this command header or parameter
+            by: what key refers to, 'command', 'parameter' or 'kind'
+
+        Returns:
+            the counts and the bin edges, as numpy.histogram
+        """
+        if bins is None:
+            bins = np.logspace(-5, 2, 29)
+        events = list(self.events)
+        if key is not None:
+            if by == 'command':
+                events = [event for event in events
+                          if command_header(event.command) == key]
+            else:
+                events = [event for event in events
+                          if str(getattr(event, by)) == key]
+        return np.histogram([event.duration for event in events], bins=bins)
+
+    def chrome_trace(self, process_name: str = 'VNA') -> Dict[str, Any]:
+        """
+        The events in the Chrome trace event format, with the messages of
+        every thread on their own track
+        """
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': 0,
+                   'args': {'name': process_name}}]  # type: List[Dict]
+        for event in list(self.events):
+            events.append({
+                'name': command_header(event.command),
+                'cat': event.kind,
+                'ph': 'X',
+                'ts': 1e6 * (event.start - self.origin),
+                'dur': 1e6 * event.duration,
+                'pid': 0,
+                'tid': event.thread,
+                'args': {'command': event.command,
+                         'parameter': event.parameter,
+                         'bytes_out': event.bytes_out,
+                         'bytes_in': event.bytes_in}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save_chrome_trace(self, path: str,
+                          process_name: str = 'VNA') -> None:
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(process_name), f)
@@ -0,0 +1,155 @@
+"""
+Segment tables for segmented (list) sweeps of the VNAs.
+
+In a segmented sweep the instrument sweeps a list of frequency segments in
+one go, each with its own number of points and optionally its own IF
+bandwidth and source power. The segments may overlap, so the same
+frequency range can be swept once per power: this is used for power sweeps
+that run entirely on the instrument, see power_sweep_segments.
+
+Segments also allow placing points densely around resonances and sparsely
+elsewhere, see resonance_segments.
+"""
+
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Values of the drivers' sweep_type parameter for segmented sweeps
+SEGMENTED_SWEEP_TYPES = ('SEGM', 'FSEGM', 'ISEGM')
+
+
+class Segment(NamedTuple):
+    """
+    One segment of a segmented sweep. if_bandwidth and power default to
+    the channel settings if not given.
+    """
+    start: float
+    stop: float
+    points: int
+    if_bandwidth: Optional[float] = None
+    power: Optional[float] = None
+
+
+def power_sweep_segments(segments: Sequence[Segment],
+                         powers: Sequence[float]) -> List[Segment]:
+    """
+    Segments sweeping the given segments once per power
+    """
+    return [segment._replace(power=float(power))
+            for power in powers for segment in segments]
+
+
+def power_chunks(n_powers: int,
+                 points: int,
+                 max_points: int,
+                 max_segments: int,
+                 segments: int = 1) -> List[slice]:
+    """
+    Split a power sweep into as few segmented sweeps as the limits of the
+    instrument allow.
+
+    Args:
+        n_powers: number of powers
+        points: points per power
+        max_points: maximum number of points of a sweep
+        max_segments: maximum number of segments of a sweep
+        segments: segments per power
+
+    Returns:
+        slices into the list of powers, one per sweep
+    """
+    if points > max_points or segments > max_segments:
+        raise ValueError("A sweep of {} points in {} segments exceeds the "
+                         "maximum of {} points in {} segments".format(
+                             points, segments, max_points, max_segments))
+    per_sweep = min(max_points // points, max_segments // segments)
+    return [slice(first, min(first + per_sweep, n_powers))
+            for first in range(0, n_powers, per_sweep)]
+
+
+def segment_frequencies(segments: Sequence[Segment]) -> np.ndarray:
+    """
+    The frequencies of all points of a segmented sweep, in sweep order
+    """
+    if not segments:
+        return np.array([])
+    return np.concatenate([np.linspace(segment.start, segment.stop,
+                                       segment.points)
+                           for segment in segments])
+
+
+def resonance_segments(start: float,
+                       stop: float,
+                       resonances: Sequence[float],
+                       width: float,
+                       resolution: float,
+                       coarse_resolution: float,
+                       if_bandwidth: Optional[float] = None,
+                       coarse_if_bandwidth: Optional[float] = None
+                       ) -> List[Segment]:
+    """
+    Segments covering start to stop, with points every resolution within
+    width around every resonance, and every coarse_resolution in between.
+    Overlapping windows around resonances are merged, and no frequency is
+    measured twice.
+
+    Args:
+        start: start of the frequency range
+        stop: end of the frequency range
+        resonances: frequencies of the resonances
+        width: width of the window around every resonance
+        resolution: point spacing within the windows
+        coarse_resolution: point spacing between the windows
+        if_bandwidth: IF bandwidth within the windows, the channel setting
+            by default
+        coarse_if_bandwidth: IF bandwidth between the windows, the channel
+            setting by default
+
+    Returns:
+        the segments in order of frequency
+    """
+    segments = []  # type: List[Segment]
+    # the last frequency covered by a segment
+    covered = None  # type: Optional[float]
+
+    def add(low: float, high: float, step: float,
+            bandwidth: Optional[float]) -> None:
+        nonlocal covered
+        if covered is not None:
+            low = covered + step
+        if high < low:
+            return
+        points = int(np.ceil((high - low) / step - 1e-9)) + 1
+        if points == 1:
+            high = low
+        segments.append(Segment(low, high, points, bandwidth))
+        covered = high
+
+    for low, high in _merge_windows(start, stop, resonances, width):
+        gap_stop = low - coarse_resolution
+        if (covered is None and gap_stop >= start) \
+                or (covered is not None
+                    and gap_stop >= covered + coarse_resolution):
+            add(start, gap_stop, coarse_resolution, coarse_if_bandwidth)
+        add(low, high, resolution, if_bandwidth)
+    if covered is None or stop >= covered + coarse_resolution:
+        add(start, stop, coarse_resolution, coarse_if_bandwidth)
+    return segments
+
+
+def _merge_windows(start: float,
+                   stop: float,
+                   resonances: Sequence[float],
+                   width: float) -> List[Tuple[float, float]]:
+    windows = []  # type: List[Tuple[float, float]]
+    for center in sorted(resonances):
+        low = max(start, center - width / 2)
+        high = min(stop, center + width / 2)
+        if high < low:
+            continue
+        if windows and low <= windows[-1][1]:
+            windows[-1] = (windows[-1][0], max(high, windows[-1][1]))
+        else:
+            windows.append((low, high))
+    return windows
@@ -0,0 +1,79 @@
+"""
+Cache of instrument settings that only change when they are set.
+
+Settings like the number of points, the frequency range, the IF bandwidth
+and the power are read many times per measurement (by the scripts, by the
+setpoints of the sweep parameters, ...), although they only change when
+the driver sets them. The drivers serve the gets of these settings from a
+SettingsCache: the first get after a set queries the instrument, so the
+cached value is the one the instrument confirmed (including any rounding
+or coercion), and further gets return it without a round trip until
+
+    - the setting, or a setting that changes it, is set again,
+    - the entry is older than max_age seconds, or
+    - invalidate() is called, e.g. by the driver's invalidate_caches after
+      settings were changed on the front panel.
+
+hits counts the round trips that were avoided.
+"""
+
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Settings that change whenever the sweep stimulus changes, e.g. setting
+# the span changes start and stop, and loading a segment table changes all
+FREQUENCY_SETTINGS = ('start', 'stop', 'center', 'span')
+SWEEP_SETTINGS = FREQUENCY_SETTINGS + ('points',)
+
+
+class SettingsCache:
+    """
+    Cache of instrument responses by parameter name, see the module
+    docstring.
+
+    Args:
+        max_age: age in seconds after which an entry is queried again.
+            None keeps entries until they are invalidated, 0 disables the
+            cache.
+    """
+
+    def __init__(self, max_age: Optional[float] = 60.) -> None:
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}  # type: Dict[str, Tuple[Any, float]]
+
+    def get(self, name: str, query: Callable[[], Any]) -> Any:
+        """
+        The cached response for name, or the response of query if there
+        is no valid entry
+        """
+        entry = self._entries.get(name)
+        if entry is not None and (self.max_age is None or
+                                  time.monotonic() - entry[1]
+                                  < self.max_age):
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        response = query()
+        self.store(name, response)
+        return response
+
+    def store(self, name: str, response: Any) -> None:
+        """
+        Cache a response to the query of name that was read elsewhere
+        """
+        self._entries[name] = (response, time.monotonic())
+
+    def invalidate(self, *names: str) -> None:
+        """
+        Forget the entries of the given settings, or all entries
+        """
+        if not names:
+            self._entries.clear()
+        for name in names:
+            self._entries.pop(name, None)
+
+    def reset_counters(self) -> None:
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,869 @@
+"""
+Simulated vector network analyzer for offline development and benchmarking.
+
+The simulator speaks the subset of SCPI that the drivers in this package
+(``MS46522B.VNABase`` and ``N52xx_modified_for_Keysight_P9373A.PNABase``)
+send, and serves it over a plain TCP socket, i.e. the same transport as the
+Anritsu's ``TCPIP0::<host>::5001::SOCKET`` resource. Any pyvisa backend that
+supports raw sockets (e.g. pyvisa-py, ``visalib='@py'``) can connect to
+it, so the drivers run unmodified on a machine without the hardware:
+
+    from labcodes.drivers.simulated_vna import SimulatedVNAServer
+    from labcodes.drivers.Keysight_P9373A import Keysight_P9373A
+
+    with SimulatedVNAServer(dialect='keysight', points=2001) as server:
+        vna = Keysight_P9373A('VNA_sim', server.address,
+                              300e3, 13.5e9, -90, 13, 2,
+                              visalib='@py')
+        mag = vna.magnitude()
+
+The simulated S-parameters contain a few notch-type resonances on top of a
+lossy, dispersive line, so data look like a resonator measurement. Sweep
+duration, point count, per-message latency and link bandwidth are
+configurable to mimic a real instrument.
+
+Headers in compound messages are resolved as a SCPI instrument does: after
+a ';', a header without a leading ':' continues from the path of the one
+before. Commands that do not resolve to a known header, e.g. a relative
+header that a real instrument would reject, are logged and recorded in
+SimulatedVNA.unknown_commands.
+"""
+
+import logging
+import re
+import socket
+import socketserver
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# (center frequency [Hz], loaded Q, coupling Q) of the default resonators
+DEFAULT_RESONANCES = ((4.1e9, 2e4, 3e4),
+                      (5.3e9, 5e4, 6e4),
+                      (6.72e9, 1e4, 1.5e4),
+                      (8.05e9, 3e4, 2e4))
+
+
+def _split_message(message: str) -> List[str]:
+    """
+    Split a compound SCPI message at semicolons that are not quoted
+    """
+    parts, current, quote = [], [], None
+    for char in message:
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == ';':
+            parts.append(''.join(current).strip())
+            current = []
+            continue
+        current.append(char)
+    parts.append(''.join(current).strip())
+    return [part for part in parts if part]
+
+
+def _resolve_headers(commands: Sequence[str]) -> List[Tuple[str, str, str]]:
+    """
+    The full header, argument and text of every command of a compound
+    message. As in a SCPI parser, a header with a leading ':' starts at the
+    root, a header without one continues from the path of the previous
+    header (e.g. 'SENS:FREQ:STAR 1e9;STOP 2e9' sets SENS:FREQ:STOP), and
+    common commands ('*OPC') leave the path as it is.
+    """
+    resolved = []
+    path = ''
+    for command in commands:
+        header, _, arg = command.partition(' ')
+        header = header.upper()
+        if header.startswith('*'):
+            full = header
+        else:
+            full = header[1:] if header.startswith(':') else path + header
+            path = full[:full.rfind(':') + 1]
+        resolved.append((full, arg.strip(), command))
+    return resolved
+
+
+def _format_number(value: Any) -> str:
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    return '{:.12E}'.format(value)
+
+
+class SimulatedVNA:
+    """
+    State and command handling of a simulated two-port VNA.
+
+    Args:
+        dialect: 'anritsu' (MS46522B command set) or 'keysight'
+            (PNA/P937x command set)
+        points: initial number of sweep points
+        start: initial start frequency in Hz
+        stop: initial stop frequency in Hz
+        sweep_time: fixed duration of one sweep in seconds. If None, it is
+            derived from the number of points and the IF bandwidth.
+        latency: processing delay added to every message in seconds
+        bandwidth: link bandwidth in bytes/s used to delay responses,
+            None for no limit
+        resonances: sequence of (f0, loaded Q, coupling Q)
+        seed: seed of the noise generator
+    """
+
+    def __init__(self,
+                 dialect: str = 'keysight',
+                 points: int = 201,
+                 start: float = 3e9,
+                 stop: float = 10e9,
+                 sweep_time: Optional[float] = None,
+                 latency: float = 0.0,
+                 bandwidth: Optional[float] = None,
+                 resonances: Sequence[Tuple[float, float, float]]
+                 = DEFAULT_RESONANCES,
+                 seed: int = 0) -> None:
+        if dialect not in ('anritsu', 'keysight'):
+            raise ValueError("dialect must be 'anritsu' or 'keysight'")
+        self.dialect = dialect
+        self.fixed_sweep_time = sweep_time
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.resonances = tuple(resonances)
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.RLock()
+
+        self.start = float(start)
+        self.stop = float(stop)
+        self.points = int(points)
+        self.if_bandwidth = 1000.
+        self.power = -10.
+        self.port2_power = -10.
+        self.port_extension = 0.
+        self.electrical_delay = 0.
+        self.averages_enabled = False
+        self.averages = 1
+        self.group_count = 1
+        self.trigger_source = 'IMM'
+        self.sweep_mode = 'CONT'
+        self.sweep_type = 'LIN'
+        # binary transfer format: 'REAL32', 'REAL64' or 'ASCII'
+        self.data_format = 'REAL32'
+        self.big_endian = dialect == 'keysight'
+        self.traces = [{'name': 'CH1_S11_1', 'param': 'S11', 'format': 'MLOG'},
+                       {'name': 'CH1_S21_2', 'param': 'S21', 'format': 'MLOG'}]
+        self.active_trace = 1
+        self.segments = []  # type: List[Dict[str, Any]]
+        self.segment_power_control = False
+        self.segment_bandwidth_control = False
+
+        self.esr = 0
+        self.ese = 0
+        self.sre = 0
+        self._sweep_done_at = 0.
+        self._opc_pending = False
+        self._sweep_data = None  # type: Optional[Dict[int, np.ndarray]]
+
+        self.message_count = 0
+        self.bytes_sent = 0
+        self.unknown_commands = []  # type: List[str]
+
+    # -- stimulus -----------------------------------------------------------
+
+    def frequencies(self) -> np.ndarray:
+        if self.sweep_type in ('SEGM', 'FSEGM', 'ISEGM') and self.segments:
+            return np.concatenate([
+                np.linspace(seg['start'], seg['stop'], seg['points'])
+                for seg in self.segments if seg.get('state', True)])
+        return np.linspace(self.start, self.stop, self.points)
+
+    def powers(self) -> np.ndarray:
+        if self.sweep_type in ('SEGM', 'FSEGM', 'ISEGM') and self.segments \
+                and self.segment_power_control:
+            return np.concatenate([
+                np.full(seg['points'], seg.get('power', self.power))
+                for seg in self.segments if seg.get('state', True)])
+        return np.full(len(self.frequencies()), self.power)
+
+    def bandwidths(self) -> np.ndarray:
+        if self.sweep_type in ('SEGM', 'FSEGM', 'ISEGM') and self.segments \
+                and self.segment_bandwidth_control:
+            return np.concatenate([
+                np.full(seg['points'], seg.get('if_bandwidth',
+                                               self.if_bandwidth))
+                for seg in self.segments if seg.get('state', True)])
+        return np.full(len(self.frequencies()), self.if_bandwidth)
+
+    def sweep_time(self) -> float:
+        if self.fixed_sweep_time is not None:
+            return self.fixed_sweep_time
+        # one IF period per point plus a fixed retrace time
+        return float(np.sum(1. / self.bandwidths())) + 2e-3
+
+    # -- simulated response -------------------------------------------------
+
+    def s_parameter(self, param: str) -> np.ndarray:
+        """
+        Complex response of the simulated device for the current stimulus
+        """
+        freq = self.frequencies()
+        power = self.powers()
+        bandwidth = self.bandwidths()
+        line = 0.7 * np.exp(-freq / 40e9) \
+            * np.exp(-2j * np.pi * freq * 25e-9)
+        if param in ('S21', 'S12'):
+            response = line.copy()
+            for f0, q_loaded, q_coupling in self.resonances:
+                # resonances shift down and broaden at high drive power
+                shift = 1. - 2e-6 * np.clip(power + 20., 0., None)
+                q_eff = q_loaded / (1. + 10 ** ((power - 10.) / 10.))
+                detuning = (freq - f0 * shift) / (f0 * shift)
+                response *= 1. - (q_eff / q_coupling) \
+                    / (1. + 2j * q_eff * detuning)
+        else:
+            response = 0.2 * line * np.exp(-1j * freq / 1e9)
+        noise = 1e-4 * np.sqrt(bandwidth / 10.) \
+            * 10 ** (-(power + 30.) / 40.)
+        response = response + noise * (self._rng.standard_normal(len(freq))
+                                       + 1j * self._rng.standard_normal(
+                                           len(freq)))
+        return response
+
+    def _trigger_sweep(self, mode: str) -> None:
+        self.sweep_mode = mode
+        self._sweep_done_at = time.perf_counter() + self.sweep_time()
+        self._sweep_data = None
+        self._opc_pending = False
+
+    def _sweeping(self) -> bool:
+        if self.sweep_mode in ('SING', 'GRO') \
+                and time.perf_counter() >= self._sweep_done_at:
+            self.sweep_mode = 'HOLD'
+            if self._opc_pending:
+                self.esr |= 1
+                self._opc_pending = False
+        return self.sweep_mode in ('SING', 'GRO')
+
+    def _wait_for_sweep(self) -> None:
+        remaining = self._sweep_done_at - time.perf_counter()
+        if remaining > 0 and self.sweep_mode in ('SING', 'GRO'):
+            time.sleep(remaining)
+        self._sweeping()
+
+    def trace_data(self, trace_num: int) -> np.ndarray:
+        """
+        Complex data of a trace. In hold mode this is the data of the last
+        completed sweep, in continuous mode every read sees a new sweep.
+        """
+        if self.sweep_mode == 'CONT' or self._sweep_data is None:
+            self._sweep_data = {num: self.s_parameter(trace['param'])
+                                for num, trace in
+                                enumerate(self.traces, start=1)}
+        return self._sweep_data[trace_num]
+
+    def formatted_data(self, trace_num: int, fmt: Optional[str] = None
+                       ) -> np.ndarray:
+        data = self.trace_data(trace_num)
+        fmt = fmt or self.traces[trace_num - 1]['format']
+        if fmt == 'MLOG':
+            return 20 * np.log10(np.abs(data))
+        if fmt == 'MLIN':
+            return np.abs(data)
+        if fmt == 'PHAS':
+            return np.degrees(np.angle(data))
+        if fmt in ('UPH', 'UPHAS'):
+            return np.degrees(np.unwrap(np.angle(data)))
+        if fmt == 'REAL':
+            return data.real
+        if fmt == 'IMAG':
+            return data.imag
+        if fmt == 'GDEL':
+            omega = 2 * np.pi * self.frequencies()
+            return -np.gradient(np.unwrap(np.angle(data)), omega)
+        raise ValueError(fmt)
+
+    # -- encoding -----------------------------------------------------------
+
+    def encode(self, values: np.ndarray) -> bytes:
+        if self.data_format == 'ASCII':
+            return ','.join('{:.10E}'.format(v) for v in values).encode()
+        dtype = np.dtype('f4' if self.data_format == 'REAL32' else 'f8')
+        dtype = dtype.newbyteorder('>' if self.big_endian else '<')
+        payload = np.asarray(values, dtype=dtype).tobytes()
+        length = str(len(payload))
+        return ('#' + str(len(length)) + length).encode() + payload
+
+    @staticmethod
+    def interleave(data: np.ndarray) -> np.ndarray:
+        pairs = np.empty(2 * len(data))
+        pairs[0::2] = data.real
+        pairs[1::2] = data.imag
+        return pairs
+
+    # -- command dispatch ---------------------------------------------------
+
+    def handle(self, message: str) -> Optional[bytes]:
+        """
+        Process one message and return the response, or None if the
+        message contained no query.
+        """
+        with self._lock:
+            self.message_count += 1
+            if self.latency:
+                time.sleep(self.latency)
+            responses = []  # type: List[bytes]
+            for header, arg, command in _resolve_headers(
+                    _split_message(message)):
+                response = self._dispatch(header, arg, command)
+                if response is not None:
+                    responses.append(response if isinstance(response, bytes)
+                                     else str(response).encode())
+            if not responses:
+                return None
+            out = b';'.join(responses)
+            self.bytes_sent += len(out)
+            if self.bandwidth:
+                time.sleep(len(out) / self.bandwidth)
+            return out
+
+    def _dispatch(self, header: str, arg: str, command: str) -> Any:
+        table = (_ANRITSU_COMMANDS if self.dialect == 'anritsu'
+                 else _KEYSIGHT_COMMANDS) + _COMMON_COMMANDS
+        for pattern, handler in table:
+            match = pattern.fullmatch(header)
+            if match:
+                return handler(self, arg, *match.groups())
+        if header != command.partition(' ')[0].upper().lstrip(':'):
+            # a relative header, as a real instrument would resolve it
+            command = '{} (resolved to {})'.format(command, header)
+        logger.warning("Simulated VNA: unknown command %r", command)
+        self.unknown_commands.append(command)
+        return None
+
+
+def _query_or_set(attr: str, parser: Any = float, query_fmt: Any = None):
+    def handler(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+        if arg:
+            setattr(vna, attr, parser(arg))
+            return None
+        value = getattr(vna, attr)
+        return query_fmt(value) if query_fmt else _format_number(value)
+    return handler
+
+
+def _set_center(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    span = vna.stop - vna.start
+    if arg:
+        center = float(arg)
+        vna.start, vna.stop = center - span / 2, center + span / 2
+        return None
+    return _format_number((vna.start + vna.stop) / 2)
+
+
+def _set_span(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    center = (vna.start + vna.stop) / 2
+    if arg:
+        span = float(arg)
+        vna.start, vna.stop = center - span / 2, center + span / 2
+        return None
+    return _format_number(vna.stop - vna.start)
+
+
+def _sweep_time(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    return _format_number(vna.sweep_time())
+
+
+def _idn(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    model = 'MS46522B' if vna.dialect == 'anritsu' else 'P9373A'
+    vendor = 'Anritsu' if vna.dialect == 'anritsu' else 'Keysight Technologies'
+    return '{},{},SIM0001,1.0'.format(vendor, model)
+
+
+def _opc_query(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    vna._wait_for_sweep()
+    return '1'
+
+
+def _opc(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    if vna._sweeping():
+        vna._opc_pending = True
+    else:
+        vna.esr |= 1
+    return None
+
+
+def _cls(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    vna.esr = 0
+    return None
+
+
+def _esr(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    vna._sweeping()
+    value, vna.esr = vna.esr, 0
+    return str(value)
+
+
+def _stb(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    vna._sweeping()
+    stb = 32 if vna.esr & vna.ese else 0
+    if stb & vna.sre:
+        stb |= 64
+    return str(stb)
+
+
+def _data_format(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    if not arg:
+        if vna.dialect == 'anritsu':
+            return {'REAL32': 'REAL32', 'REAL64': 'REAL',
+                    'ASCII': 'ASC'}[vna.data_format]
+        return {'REAL32': '+REAL,+32', 'REAL64': '+REAL,+64',
+                'ASCII': '+ASC,+0'}[vna.data_format]
+    arg = arg.upper().replace(' ', '')
+    if arg in ('REAL32', 'REAL,32'):
+        vna.data_format = 'REAL32'
+    elif arg in ('REAL', 'REAL64', 'REAL,64'):
+        vna.data_format = 'REAL64'
+    elif arg.startswith('ASC'):
+        vna.data_format = 'ASCII'
+    else:
+        raise ValueError(arg)
+    return None
+
+
+def _byte_order(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    if not arg:
+        return 'NORM' if vna.big_endian else 'SWAP'
+    vna.big_endian = arg.upper().startswith('NORM')
+    return None
+
+
+def _trace_format(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    trace = vna.traces[vna.active_trace - 1]
+    if not arg:
+        return trace['format']
+    trace['format'] = arg.upper()
+    return None
+
+
+# -- Anritsu ShockLine command set -------------------------------------------
+
+def _a_hold(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    if not arg:
+        vna._sweeping()
+        return vna.sweep_mode
+    mode = arg.upper()[:4]
+    if mode in ('SING', 'single'[:4].upper()):
+        vna._trigger_sweep('SING')
+    else:
+        vna.sweep_mode = mode
+    return None
+
+
+def _a_trace_count(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    if not arg:
+        return str(len(vna.traces))
+    count = int(arg)
+    params = ['S11', 'S12', 'S21', 'S22']
+    while len(vna.traces) < count:
+        num = len(vna.traces) + 1
+        vna.traces.append({'name': 'TR{}'.format(num),
+                           'param': params[(num - 1) % 4], 'format': 'MLOG'})
+    del vna.traces[count:]
+    vna.active_trace = min(vna.active_trace, count)
+    vna._sweep_data = None
+    return None
+
+
+def _a_trace_def(vna: SimulatedVNA, arg: str, num: str = None) -> Any:
+    index = int(num) if num else vna.active_trace
+    trace = vna.traces[index - 1]
+    if not arg:
+        return trace['param']
+    trace['param'] = arg.strip('"\'').upper()
+    vna._sweep_data = None
+    return None
+
+
+def _a_select(vna: SimulatedVNA, arg: str, num: str = None) -> Any:
+    if num:
+        vna.active_trace = int(num)
+        return None
+    return str(vna.active_trace)
+
+
+def _a_fdata(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    return vna.encode(vna.formatted_data(vna.active_trace))
+
+
+def _a_sdata(vna: SimulatedVNA, arg: str, num: str = None) -> Any:
+    index = int(num) if num else vna.active_trace
+    return vna.encode(vna.interleave(vna.trace_data(index)))
+
+
+def _a_freq_data(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    return vna.encode(vna.frequencies())
+
+
+def _a_segment_clear(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    vna.segments = []
+
+
+def _a_segment_add(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    vna.segments.append({'start': vna.start, 'stop': vna.stop,
+                         'points': vna.points})
+
+
+def _a_segment_field(key: str, parser: Any = float):
+    def handler(vna: SimulatedVNA, arg: str, num: str) -> Any:
+        segment = vna.segments[int(num) - 1]
+        if arg:
+            segment[key] = parser(arg)
+            return None
+        return _format_number(segment.get(key))
+    return handler
+
+
+def _a_segment_state(attr: str):
+    def handler(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+        if not arg:
+            return '1' if getattr(vna, attr) else '0'
+        setattr(vna, attr, arg.upper() in ('1', 'ON'))
+    return handler
+
+
+def _a_segment_count(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    return str(len(vna.segments))
+
+
+_ANRITSU_COMMANDS = [
+    (re.compile(r'SENS1?:ISEGM:CLE'), _a_segment_clear),
+    (re.compile(r'SENS1?:ISEGM:ADD'), _a_segment_add),
+    (re.compile(r'SENS1?:ISEGM:COUN\?'), _a_segment_count),
+    (re.compile(r'SENS1?:ISEGM(\d+):FREQ:STAR\??'),
+     _a_segment_field('start')),
+    (re.compile(r'SENS1?:ISEGM(\d+):FREQ:STOP\??'),
+     _a_segment_field('stop')),
+    (re.compile(r'SENS1?:ISEGM(\d+):SWE:POIN\??'),
+     _a_segment_field('points', lambda arg: int(float(arg)))),
+    (re.compile(r'SENS1?:ISEGM(\d+):BWID\??'),
+     _a_segment_field('if_bandwidth')),
+    (re.compile(r'SENS1?:ISEGM(\d+):POW:PORT1\??'),
+     _a_segment_field('power')),
+    (re.compile(r'SENS1?:ISEGM:BWID:STAT\??'),
+     _a_segment_state('segment_bandwidth_control')),
+    (re.compile(r'SENS1?:ISEGM:POW:STAT\??'),
+     _a_segment_state('segment_power_control')),
+    (re.compile(r'SOUR(?:CE)?1?:POW(?:ER)?(?::PORT2|2)\??'),
+     _query_or_set('port2_power')),
+    (re.compile(r'SOUR(?:CE)?1?:POW(?:ER)?(?::PORT1?|1)?\??'),
+     _query_or_set('power')),
+    (re.compile(r'SENS1?:BWID\??'), _query_or_set('if_bandwidth')),
+    (re.compile(r'SENS1?:FREQ:STAR\??'), _query_or_set('start')),
+    (re.compile(r'SENS1?:FREQ:STOP\??'), _query_or_set('stop')),
+    (re.compile(r'SENS1?:FREQ:CENT\??'), _set_center),
+    (re.compile(r'SENS1?:FREQ:SPAN\??'), _set_span),
+    (re.compile(r'SENS1?:FREQ:DATA\?'), _a_freq_data),
+    (re.compile(r'SENS1?:CORR:EXT:PORT1\??'),
+     _query_or_set('port_extension')),
+    (re.compile(r'SENS1?:SWE:POIN\??'),
+     _query_or_set('points', lambda arg: int(float(arg)))),
+    (re.compile(r'SENS1?:SWE:TIME\?'), _sweep_time),
+    (re.compile(r'SENS1?:SWE:TYPE\??'),
+     _query_or_set('sweep_type', str.upper, str)),
+    (re.compile(r'SENS1?:HOLD:FUNC\??'), _a_hold),
+    (re.compile(r'FORM:DATA\??'), _data_format),
+    (re.compile(r'FORM:BORD\??'), _byte_order),
+    (re.compile(r'CALC1?(?::PAR(\d+))?:FORM\??'),
+     lambda vna, arg, num=None: _trace_format(vna, arg)),
+    (re.compile(r'CALC1?:PAR:COUN\??'), _a_trace_count),
+    (re.compile(r'CALC1?:PAR(\d+):DEF\??'), _a_trace_def),
+    (re.compile(r'CALC1?:PAR:DEF\??'), _a_trace_def),
+    (re.compile(r'CALC1?:PAR(\d+):SEL'), _a_select),
+    (re.compile(r'CALC1?:PAR:SEL\?'), _a_select),
+    (re.compile(r'CALC1?:DATA:FDAT\?'), _a_fdata),
+    (re.compile(r'CALC1?:DATA:SDAT\?'), _a_sdata),
+    (re.compile(r'CALC1?:PAR(\d+):DATA:SDAT\?'), _a_sdata),
+]
+
+
+# -- Keysight PNA command set ------------------------------------------------
+
+def _k_mode(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    if not arg:
+        vna._sweeping()
+        return vna.sweep_mode
+    mode = arg.upper()[:4]
+    if mode in ('SING', 'GRO', 'GROU'):
+        vna._trigger_sweep('GRO' if mode.startswith('GRO') else 'SING')
+    else:
+        vna.sweep_mode = mode
+    return None
+
+
+def _k_catalog(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    return '"' + ','.join('{},{}'.format(trace['name'], trace['param'])
+                          for trace in vna.traces) + '"'
+
+
+def _k_select(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    name = arg.strip('"\'')
+    for num, trace in enumerate(vna.traces, start=1):
+        if trace['name'] == name:
+            vna.active_trace = num
+            return None
+    raise ValueError("no trace named " + name)
+
+
+def _k_mnum(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    if not arg:
+        return str(vna.active_trace)
+    vna.active_trace = int(float(arg))
+    return None
+
+
+def _k_define(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    trace = vna.traces[vna.active_trace - 1]
+    trace['param'] = arg.strip('"\'').upper()
+    vna._sweep_data = None
+    return None
+
+
+def _k_data(vna: SimulatedVNA, arg: str, mnum: str = None) -> Any:
+    index = int(mnum) if mnum else vna.active_trace
+    kind = arg.upper() if arg else 'FDATA'
+    if kind.startswith('SDATA'):
+        return vna.encode(vna.interleave(vna.trace_data(index)))
+    return vna.encode(vna.formatted_data(index))
+
+
+def _k_meas_data(kind: str):
+    def handler(vna: SimulatedVNA, arg: str, mnum: str) -> Any:
+        return _k_data(vna, kind, mnum)
+    return handler
+
+
+def _k_stimulus(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    return vna.encode(vna.frequencies())
+
+
+def _k_averaging(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    if not arg:
+        return '1' if vna.averages_enabled else '0'
+    vna.averages_enabled = arg.upper() in ('1', 'ON')
+    return None
+
+
+def _k_segment_list(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+    if not arg:
+        fields = []
+        for segment in vna.segments:
+            fields += [1, segment['points'], segment['start'],
+                       segment['stop'], segment.get('if_bandwidth',
+                                                    vna.if_bandwidth),
+                       0, segment.get('power', vna.power)]
+        return ','.join(['SSTOP', str(len(vna.segments))]
+                        + [_format_number(value) for value in fields])
+    values = arg.split(',')
+    count = int(float(values[1]))
+    vna.segments = []
+    for index in range(count):
+        state, points, start, stop, bandwidth, dwell, power = \
+            values[2 + 7 * index:9 + 7 * index]
+        vna.segments.append({'state': float(state) != 0,
+                             'points': int(float(points)),
+                             'start': float(start), 'stop': float(stop),
+                             'if_bandwidth': float(bandwidth),
+                             'power': float(power)})
+
+
+def _k_segment_flag(attr: Optional[str]):
+    def handler(vna: SimulatedVNA, arg: str, *groups: str) -> Any:
+        if attr is None:
+            return None
+        if not arg:
+            return '1' if getattr(vna, attr) else '0'
+        setattr(vna, attr, arg.upper() in ('1', 'ON'))
+    return handler
+
+
+_KEYSIGHT_COMMANDS = [
+    (re.compile(r'SENS1?:SEGM:DEL:ALL'),
+     lambda vna, arg: setattr(vna, 'segments', [])),
+    (re.compile(r'SENS1?:SEGM:LIST\??'), _k_segment_list),
+    (re.compile(r'SENS1?:SEGM:COUN\?'),
+     lambda vna, arg: str(len(vna.segments))),
+    (re.compile(r'SENS1?:SEGM:ARB\??'), _k_segment_flag(None)),
+    (re.compile(r'SENS1?:SEGM:BWID:CONT\??'),
+     _k_segment_flag('segment_bandwidth_control')),
+    (re.compile(r'SENS1?:SEGM:POW:CONT\??'),
+     _k_segment_flag('segment_power_control')),
+    (re.compile(r'SOUR(?:CE)?1?:POW(?:ER)?1?\??'), _query_or_set('power')),
+    (re.compile(r'SOUR(?:CE)?1?:POW(?:ER)?2\??'),
+     _query_or_set('port2_power')),
+    (re.compile(r'SENS1?:BAND\??'), _query_or_set('if_bandwidth')),
+    (re.compile(r'SENS1?:BWID\??'), _query_or_set('if_bandwidth')),
+    (re.compile(r'SENS1?:AVER\??'), _k_averaging),
+    (re.compile(r'SENS1?:AVER:COUN\??'),
+     _query_or_set('averages', lambda arg: int(float(arg)))),
+    (re.compile(r'SENS1?:AVER:CLE'), lambda vna, arg: None),
+    (re.compile(r'SENS1?:FREQ:STAR\??'), _query_or_set('start')),
+    (re.compile(r'SENS1?:FREQ:STOP\??'), _query_or_set('stop')),
+    (re.compile(r'SENS1?:FREQ:CENT\??'), _set_center),
+    (re.compile(r'SENS1?:FREQ:SPAN\??'), _set_span),
+    (re.compile(r'SENS1?:X(?::VAL(?:UES)?)?\?'), _k_stimulus),
+    (re.compile(r'SENS1?:SWE:POIN\??'),
+     _query_or_set('points', lambda arg: int(float(arg)))),
+    (re.compile(r'SENS1?:SWE:TIME\?'), _sweep_time),
+    (re.compile(r'SENS1?:SWE:TYPE\??'),
+     _query_or_set('sweep_type', lambda arg: arg.upper()[:4], str)),
+    (re.compile(r'SENS1?:SWE:MODE\??'), _k_mode),
+    (re.compile(r'SENS1?:SWE:GRO:COUN\??'),
+     _query_or_set('group_count', lambda arg: int(float(arg)))),
+    (re.compile(r'TRIG:SOUR\??'),
+     _query_or_set('trigger_source', str.upper, str)),
+    (re.compile(r'CALC1?:CORR:EDEL:TIME\??'),
+     _query_or_set('electrical_delay')),
+    (re.compile(r'FORM(?::DATA)?\??'), _data_format),
+    (re.compile(r'FORM:BORD\??'), _byte_order),
+    (re.compile(r'CALC1?:FORM\??'), _trace_format),
+    (re.compile(r'CALC1?:PAR:CAT:EXT\?'), _k_catalog),
+    (re.compile(r'CALC1?:PAR:SEL'), _k_select),
+    (re.compile(r'CALC1?:PAR:MNUM\??'), _k_mnum),
+    (re.compile(r'CALC1?:PAR:MOD:EXT'), _k_define),
+    (re.compile(r'CALC1?:DATA\?'), _k_data),
+    (re.compile(r'CALC1?:MEAS(\d+):DATA:SDATA\?'), _k_meas_data('SDATA')),
+    (re.compile(r'CALC1?:MEAS(\d+):DATA:FDATA\?'), _k_meas_data('FDATA')),
+    (re.compile(r'\*OPT\?'), lambda vna, arg: '"010,219"'),
+]
+
+
+_COMMON_COMMANDS = [
+    (re.compile(r'\*IDN\?'), _idn),
+    (re.compile(r'\*OPC\?'), _opc_query),
+    (re.compile(r'\*OPC'), _opc),
+    (re.compile(r'\*CLS'), _cls),
+    (re.compile(r'\*ESR\?'), _esr),
+    (re.compile(r'\*ESE\??'),
+     _query_or_set('ese', lambda arg: int(float(arg)), str)),
+    (re.compile(r'\*SRE\??'),
+     _query_or_set('sre', lambda arg: int(float(arg)), str)),
+    (re.compile(r'\*STB\?'), _stb),
+    (re.compile(r'\*WAI'), lambda vna, arg: vna._wait_for_sweep()),
+    (re.compile(r'\*RST'), lambda vna, arg: None),
+]
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def _quickack(self) -> None:
+        # Acknowledge every message right away: with delayed ACKs the
+        # client's Nagle algorithm would hold back consecutive writes that
+        # expect no response by up to 40 ms.
+        if hasattr(socket, 'TCP_QUICKACK'):
+            self.connection.setsockopt(socket.IPPROTO_TCP,
+                                       socket.TCP_QUICKACK, 1)
+
+    def handle(self) -> None:
+        vna = self.server.vna  # type: ignore
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            self._quickack()
+            line = self.rfile.readline()
+            self._quickack()
+            if not line:
+                return
+            message = line.decode('ascii', errors='replace').strip()
+            if not message:
+                continue
+            try:
+                response = vna.handle(message)
+            except Exception:
+                logger.exception("Simulated VNA failed on %r", message)
+                continue
+            if response is not None:
+                self.wfile.write(response + b'\n')
+                self.wfile.flush()
+
+
+class _ThreadingServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SimulatedVNAServer:
+    """
+    Serve a SimulatedVNA on a local TCP socket.
+
+    Args:
+        vna: the simulated instrument. If None, one is created from kwargs.
+        host: interface to listen on
+        port: port to listen on, 0 picks a free one
+        **kwargs: passed to SimulatedVNA
+    """
+
+    def __init__(self,
+                 vna: Optional[SimulatedVNA] = None,
+                 host: str = '127.0.0.1',
+                 port: int = 0,
+                 **kwargs: Any) -> None:
+        self.vna = vna if vna is not None else SimulatedVNA(**kwargs)
+        self._server = _ThreadingServer((host, port), _Handler)
+        self._server.vna = self.vna  # type: ignore
+        self._thread = None  # type: Optional[threading.Thread]
+
+    @property
+    def address(self) -> str:
+        """
+        VISA resource name of the simulated instrument
+        """
+        host, port = self._server.server_address[:2]
+        return 'TCPIP0::{}::{}::SOCKET'.format(host, port)
+
+    def start(self) -> 'SimulatedVNAServer':
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'SimulatedVNAServer':
+        return self.start()
+
+    def __exit__(self, *exc: Any) -> None:
+        self.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Serve a simulated VNA until interrupted")
+    parser.add_argument('--dialect', choices=('anritsu', 'keysight'),
+                        default='keysight')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--points', type=int, default=201)
+    parser.add_argument('--sweep-time', type=float, default=None,
+                        help="duration of one sweep in s")
+    parser.add_argument('--latency', type=float, default=0.,
+                        help="delay per message in s")
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help="link bandwidth in bytes/s")
+    args = parser.parse_args()
+
+    server = SimulatedVNAServer(host=args.host, port=args.port,
+                                dialect=args.dialect, points=args.points,
+                                sweep_time=args.sweep_time,
+                                latency=args.latency,
+                                bandwidth=args.bandwidth).start()
+    print("simulated {} VNA at {}".format(args.dialect, server.address))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
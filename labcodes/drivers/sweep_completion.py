@@ -0,0 +1,195 @@
+"""
+Strategies for waiting until a triggered VNA sweep has finished.
+
+The drivers used to poll the sweep mode every 100 ms, which adds up to
+100 ms of latency per sweep and keeps the bus busy. The strategies here
+can be selected per instrument with its ``sweep_completion`` parameter:
+
+    'opc':  a single blocking *OPC? query, with a VISA timeout derived from
+            the expected sweep time
+    'srq':  arm the status byte (*ESE/*SRE) and wait for the service
+            request raised by *OPC, or poll *STB? where the interface does
+            not support service requests (e.g. raw sockets)
+    'poll': poll the sweep state, sleeping through most of the expected
+            sweep time first and then backing off exponentially
+
+Every strategy records how long the last wait took and how much longer
+that was than the sweep time reported by the instrument.
+"""
+
+import logging
+import time
+from typing import Any, Callable, Dict, Optional
+
+from pyvisa import VisaIOError, errors
+
+logger = logging.getLogger()
+
+
+class SweepCompletion:
+    """
+    Base class of the strategies. Subclasses implement wait, and may
+    implement prepare to arm the instrument before the sweep is started.
+    """
+    name = ''
+
+    def __init__(self) -> None:
+        self.last_wait = None  # type: Optional[float]
+        self.last_overhead = None  # type: Optional[float]
+        self.count = 0
+        self.total_overhead = 0.
+
+    def run(self,
+            instrument: Any,
+            start: Callable[[], Any],
+            is_done: Callable[[], bool]) -> None:
+        """
+        Start a sweep and wait until it has finished.
+
+        Args:
+            instrument: the root instrument
+            start: callable that triggers the sweep
+            is_done: callable that queries whether the sweep has finished
+        """
+        expected = instrument.sweep_time()
+        self.prepare(instrument)
+        t_start = time.perf_counter()
+        start()
+        self.wait(instrument, is_done, expected)
+        self.last_wait = time.perf_counter() - t_start
+        self.last_overhead = self.last_wait - expected
+        self.count += 1
+        self.total_overhead += self.last_overhead
+        logger.debug("%s: sweep of %.4f s took %.4f s to complete (%s)",
+                     instrument.name, expected, self.last_wait, self.name)
+
+    def prepare(self, instrument: Any) -> None:
+        pass
+
+    def wait(self,
+             instrument: Any,
+             is_done: Callable[[], bool],
+             expected: float) -> None:
+        raise NotImplementedError
+
+
+class PollingCompletion(SweepCompletion):
+    """
+    Poll the sweep state. Sleeps through most of the expected sweep time
+    first, then polls with an interval that doubles from min_interval up to
+    max_interval.
+    """
+    name = 'poll'
+
+    def __init__(self,
+                 min_interval: float = 1e-3,
+                 max_interval: float = 0.1,
+                 early_fraction: float = 0.9) -> None:
+        super().__init__()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.early_fraction = early_fraction
+
+    def wait(self,
+             instrument: Any,
+             is_done: Callable[[], bool],
+             expected: float) -> None:
+        time.sleep(self.early_fraction * expected)
+        interval = self.min_interval
+        while not is_done():
+            time.sleep(interval)
+            interval = min(2 * interval, self.max_interval)
+
+
+class OPCCompletion(SweepCompletion):
+    """
+    Block on *OPC?, which the instrument answers once the sweep is
+    complete. The VISA timeout is raised to margin * expected + extra
+    seconds for the query. If the query times out anyway, the interface is
+    cleared and the sweep state is polled instead.
+    """
+    name = 'opc'
+
+    def __init__(self, margin: float = 2., extra: float = 5.) -> None:
+        super().__init__()
+        self.margin = margin
+        self.extra = extra
+        self._fallback = PollingCompletion()
+
+    def wait(self,
+             instrument: Any,
+             is_done: Callable[[], bool],
+             expected: float) -> None:
+        visa_handle = instrument.visa_handle
+        previous_timeout = visa_handle.timeout
+        visa_handle.timeout = 1000 * (self.margin * expected + self.extra)
+        try:
+            instrument.ask('*OPC?')
+        except VisaIOError as e:
+            if e.error_code != errors.StatusCode.error_timeout:
+                raise
+            logger.warning("%s: *OPC? timed out, falling back to polling",
+                           instrument.name)
+            instrument.device_clear()
+            self._fallback.wait(instrument, is_done, 0.)
+        finally:
+            visa_handle.timeout = previous_timeout
+
+
+class SRQCompletion(SweepCompletion):
+    """
+    Let the instrument signal the end of the sweep through the status byte:
+    operation complete (*OPC) sets the event status register, which is
+    summarised in the ESB bit of the status byte and raises a service
+    request. Interfaces without service requests poll *STB? instead.
+    """
+    name = 'srq'
+    ESB = 32
+
+    def __init__(self, margin: float = 2., extra: float = 5.) -> None:
+        super().__init__()
+        self.margin = margin
+        self.extra = extra
+        self._stb_polling = PollingCompletion()
+
+    def prepare(self, instrument: Any) -> None:
+        instrument.write('*CLS;*ESE 1;*SRE {}'.format(self.ESB))
+
+    def wait(self,
+             instrument: Any,
+             is_done: Callable[[], bool],
+             expected: float) -> None:
+        instrument.write('*OPC')
+        if not self._wait_for_srq(instrument, expected):
+            self._stb_polling.wait(
+                instrument,
+                lambda: bool(int(instrument.ask('*STB?')) & self.ESB),
+                expected)
+        # Reading the event status register clears it for the next sweep
+        instrument.ask('*ESR?')
+
+    def _wait_for_srq(self, instrument: Any, expected: float) -> bool:
+        """
+        Wait for the service request. Returns False if the interface does
+        not support service requests.
+        """
+        wait_for_srq = getattr(instrument.visa_handle, 'wait_for_srq', None)
+        if wait_for_srq is None:
+            return False
+        try:
+            wait_for_srq(1000 * (self.margin * expected + self.extra))
+        except VisaIOError as e:
+            if e.error_code in (errors.StatusCode.error_nonsupported_operation,
+                                errors.StatusCode.error_invalid_event):
+                return False
+            raise
+        return True
+
+
+def completion_strategies() -> Dict[str, SweepCompletion]:
+    """
+    A fresh set of strategies, keyed by the values of the instruments'
+    sweep_completion parameter
+    """
+    return {strategy.name: strategy for strategy in
+            (OPCCompletion(), SRQCompletion(), PollingCompletion())}
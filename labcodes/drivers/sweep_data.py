@@ -0,0 +1,318 @@
+"""
+Helpers shared by the VNA drivers for handling sweep data.
+
+The VNAs can return a trace either already formatted (CALC:DATA:FDAT,
+one transfer per format) or as complex data (SDATA, real and imaginary
+part of every point). Since magnitude, phase, real and imaginary parts are
+all simple functions of the complex data, one SDATA transfer per sweep is
+enough to serve all of them.
+"""
+
+from typing import (Any, Callable, Dict, Hashable, List, Optional, Sequence,
+                    Set)
+
+import numpy as np
+
+from labcodes.drivers.segments import SEGMENTED_SWEEP_TYPES
+
+# Formats that can be computed from the complex trace data on the host.
+# Group delay is left to the instrument, as it depends on its smoothing
+# aperture settings.
+LOCAL_FORMATS = ('MLOG', 'MLIN', 'PHAS', 'UPH', 'REAL', 'IMAG')
+
+# Formats in which trace data can be transferred, with the size of a value
+# in binary blocks. ASCII data are comma separated numbers.
+TRANSFER_FORMATS = {'REAL32': 4, 'REAL64': 8, 'ASCII': None}
+
+
+def derive_format(data: np.ndarray, sweep_format: str) -> np.ndarray:
+    """
+    Compute a formatted trace from complex trace data.
+
+    Args:
+        data: complex trace data
+        sweep_format: one of LOCAL_FORMATS
+
+    Returns:
+        a new array with the formatted data
+    """
+    if sweep_format == 'MLOG':
+        return 20 * np.log10(np.abs(data))
+    if sweep_format == 'MLIN':
+        return np.abs(data)
+    if sweep_format == 'PHAS':
+        return np.degrees(np.angle(data))
+    if sweep_format == 'UPH':
+        return np.degrees(np.unwrap(np.angle(data)))
+    if sweep_format == 'REAL':
+        return np.array(data.real)
+    if sweep_format == 'IMAG':
+        return np.array(data.imag)
+    raise ValueError("Cannot derive format {} from complex "
+                     "data".format(sweep_format))
+
+
+def complex_from_interleaved(values: np.ndarray) -> np.ndarray:
+    """
+    Convert the (re, im, re, im, ...) sequence returned by SDATA queries
+    into a complex array. Contiguous float32/float64 input in native byte
+    order is reinterpreted in place, without a copy.
+    """
+    values = np.asarray(values)
+    if (values.dtype not in (np.float32, np.float64)
+            or not values.dtype.isnative):
+        values = values.astype(float)
+    values = np.ascontiguousarray(values)
+    complex_type = np.complex64 if values.dtype == np.float32 \
+        else np.complex128
+    return values.view(complex_type)
+
+
+def transfer_dtype(transfer_format: str,
+                   big_endian: bool) -> Optional[np.dtype]:
+    """
+    The data type of the values in blocks of the given transfer format, or
+    None for ASCII data
+    """
+    size = TRANSFER_FORMATS[transfer_format]
+    if size is None:
+        return None
+    return np.dtype('{}f{}'.format('>' if big_endian else '<', size))
+
+
+def decode_block(block: bytes,
+                 dtype: Optional[np.dtype],
+                 out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Decode the data of a binary block straight with NumPy, without a list
+    of Python floats in between.
+
+    Args:
+        block: data of the block, without the header
+        dtype: data type of the values in the block, including the byte
+            order, e.g. '>f4' for big endian float32. None for comma
+            separated ASCII values.
+        out: optional buffer to reuse. If it has the right size, the values
+            are written into it, otherwise a new array is allocated.
+
+    Returns:
+        the values in native byte order
+    """
+    if dtype is None:
+        values = np.fromstring(block.decode('ascii'), dtype=float, sep=',')
+    else:
+        values = np.frombuffer(block, dtype=dtype)
+    native = values.dtype.newbyteorder('=')
+    if out is None or out.shape != values.shape or out.dtype != native:
+        out = np.empty(values.shape, dtype=native)
+    np.copyto(out, values)
+    return out
+
+
+def read_binary_blocks(visa_handle: Any, count: int) -> List[bytes]:
+    """
+    Read the responses to a sequence of binary data queries sent in one
+    message, e.g. 'CALC:MEAS1:DATA:SDATA?;:CALC:MEAS2:DATA:SDATA?'.
+
+    Every response is an IEEE 488.2 definite length block
+    (#<digits><length><data>), and the blocks are separated by ';' and
+    terminated by a newline.
+
+    Args:
+        visa_handle: pyvisa resource of the instrument
+        count: number of blocks to read
+
+    Returns:
+        the data of every block
+    """
+    blocks = []
+    for _ in range(count):
+        header = visa_handle.read_bytes(2)
+        if header[:1] != b'#' or header[1:2] in (b'0', b''):
+            raise ValueError("Expected a definite length block, got "
+                             "{!r}".format(header))
+        length = int(visa_handle.read_bytes(int(header[1:2])))
+        blocks.append(visa_handle.read_bytes(length))
+        # separator (';') or message terminator
+        visa_handle.read_bytes(1)
+    return blocks
+
+
+def read_data_blocks(visa_handle: Any,
+                     count: int,
+                     transfer_format: str) -> List[bytes]:
+    """
+    Read the responses to a sequence of data queries sent in one message,
+    in the given transfer format. Binary responses are read with
+    read_binary_blocks; ASCII responses are read as one line and split at
+    the ';' between the responses.
+    """
+    if TRANSFER_FORMATS[transfer_format] is not None:
+        return read_binary_blocks(visa_handle, count)
+    blocks = visa_handle.read_raw().rstrip(b'\r\n').split(b';')
+    if len(blocks) != count:
+        raise ValueError("Expected {} responses, got {}".format(
+            count, len(blocks)))
+    return blocks
+
+
+def structured_traces(names: Sequence[str],
+                      parameters: Sequence[str],
+                      data: Sequence[np.ndarray]) -> np.ndarray:
+    """
+    Pack the data of several traces into a structured array with the fields
+    'name', 'parameter' (e.g. 'S21') and 'data' (complex trace data)
+    """
+    points = len(data[0]) if len(data) else 0
+    traces = np.zeros(len(data), dtype=[('name', 'U32'),
+                                        ('parameter', 'U8'),
+                                        ('data', complex, (points,))])
+    traces['name'] = names
+    traces['parameter'] = parameters
+    for index, trace_data in enumerate(data):
+        traces['data'][index] = trace_data
+    return traces
+
+
+class TransferStats:
+    """
+    Bytes and time spent transferring trace data, per transfer format.
+
+    The duration of a transfer is measured from sending the query to
+    having read the response, so for a given format it includes the
+    instrument's time to prepare the data.
+    """
+
+    def __init__(self) -> None:
+        self._stats = {}  # type: Dict[str, Dict[str, float]]
+
+    def clear(self) -> None:
+        self._stats = {}
+
+    def record(self,
+               transfer_format: str,
+               nbytes: int,
+               duration: float) -> None:
+        stats = self._stats.setdefault(
+            transfer_format, {'transfers': 0, 'bytes': 0, 'seconds': 0.})
+        stats['transfers'] += 1
+        stats['bytes'] += nbytes
+        stats['seconds'] += duration
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        The totals per transfer format, together with the mean size and
+        duration of a transfer and the throughput in bytes per second
+        """
+        summary = {}
+        for transfer_format, stats in self._stats.items():
+            summary[transfer_format] = dict(
+                stats,
+                bytes_per_transfer=stats['bytes'] / stats['transfers'],
+                seconds_per_transfer=stats['seconds'] / stats['transfers'],
+                bytes_per_second=(stats['bytes'] / stats['seconds']
+                                  if stats['seconds'] else float('nan')))
+        return summary
+
+
+class ComplexSweepCache:
+    """
+    Cache of the complex data of one trace.
+
+    The data are fetched once and every format is derived from them. The
+    cache is considered stale (and the data fetched again) if a new sweep
+    was started, or if a format is requested a second time: in continuous
+    sweep mode this is the only hint that the caller expects fresh data,
+    e.g. when reading the magnitude in a loop.
+    """
+
+    def __init__(self) -> None:
+        self._data = None  # type: Optional[np.ndarray]
+        self._sweep_id = None  # type: Optional[Hashable]
+        self._served = set()  # type: Set[str]
+
+    def clear(self) -> None:
+        self._data = None
+        self._sweep_id = None
+        self._served = set()
+
+    def store(self, data: np.ndarray, sweep_id: Hashable) -> None:
+        """
+        Store freshly fetched complex data of a sweep
+        """
+        self._data = data
+        self._sweep_id = sweep_id
+        self._served = set()
+
+    def get(self,
+            sweep_format: str,
+            fetch: Callable[[], np.ndarray],
+            sweep_id: Hashable) -> np.ndarray:
+        """
+        Return the trace in the given format.
+
+        Args:
+            sweep_format: one of LOCAL_FORMATS
+            fetch: callable returning fresh complex data from the instrument
+            sweep_id: identifier of the most recent sweep
+        """
+        if (self._data is None or sweep_id != self._sweep_id
+                or sweep_format in self._served):
+            self.store(fetch(), sweep_id)
+        self._served.add(sweep_format)
+        return derive_format(self._data, sweep_format)
+
+
+class SweepGeometry:
+    """
+    Cached stimulus of a VNA sweep: the number of points and the frequency
+    of every point.
+
+    The values are queried from the instrument on first use and kept until
+    invalidate is called, which the drivers do whenever a parameter that
+    changes the stimulus is set. For segmented sweeps the frequencies are
+    those of the segment table (see the drivers' segment_frequencies), and
+    are in general not evenly spaced. The frequency array is shared between
+    all users and therefore read-only.
+    """
+
+    def __init__(self, instrument: Any) -> None:
+        self._instrument = instrument
+        self._segmented = None  # type: Optional[bool]
+        self._points = None  # type: Optional[int]
+        self._frequencies = None  # type: Optional[np.ndarray]
+
+    def invalidate(self) -> None:
+        self._segmented = None
+        self._points = None
+        self._frequencies = None
+
+    @property
+    def segmented(self) -> bool:
+        if self._segmented is None:
+            self._segmented = \
+                self._instrument.sweep_type() in SEGMENTED_SWEEP_TYPES
+        return self._segmented
+
+    @property
+    def points(self) -> int:
+        if self._points is None:
+            if self.segmented:
+                self._points = len(self.frequencies)
+            else:
+                self._points = self._instrument.points()
+        return self._points
+
+    @property
+    def frequencies(self) -> np.ndarray:
+        if self._frequencies is None:
+            if self.segmented:
+                frequencies = np.array(self._instrument.segment_frequencies(),
+                                       dtype=float)
+            else:
+                start = self._instrument.start()
+                stop = self._instrument.stop()
+                frequencies = np.linspace(start, stop, self.points)
+            frequencies.setflags(write=False)
+            self._frequencies = frequencies
+        return self._frequencies
@@ -1,22 +1,20 @@
-from labcodes.drivers.Anritsu_MS46522B import Anritsu_MS46522B
-
-import qcodes as qc
 import os
 import time
 from datetime import date
 
-from qcodes.dataset.measurements import Measurement  #, DataSaver
-from qcodes.dataset.plotting import plot_by_id
-from qcodes.dataset.experiment_container import load_experiment_by_name, new_experiment  #, experiments, load_experiment
-import matplotlib.pyplot as plt
 import numpy as np
 
+from labcodes.drivers.segments import power_chunks
+from labcodes.drivers.sweep_data import derive_format
+
+# qcodes, the driver and the acquisition modules (matplotlib, h5py) take
+# seconds to import; they are imported where they are used, so that
+# importing this module (e.g. in a notebook) is fast
+
 import logging  # general logging package
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
-from qcodes.instrument.base import Instrument
-
 
 class AnritsuMeasurement:
     """ Module for the whole measurement """
@@ -27,6 +25,10 @@ class AnritsuMeasurement:
             3. specify paths of the target files: 
                database file and a new folder with raw (txt, png) files """
 
+        from qcodes.instrument.base import Instrument
+        from labcodes.drivers.Anritsu_MS46522B import Anritsu_MS46522B
+        from labcodes.acquisition.plotting import PlotWorker
+
         self.vna_name = "VNA_Anritsu"
         self.vna_class = Anritsu_MS46522B  # this is a qcodes VisaInstrument (interface between visa and qcodes)
         self.vna_address = "TCPIP0::169.254.235.118::5001::SOCKET"
@@ -81,6 +83,13 @@ class AnritsuMeasurement:
         # # vna.groupdelay.set(groupdelayref)#resets to 0 instead of working -> rounding to 0
         # # print(vna.groupdelay.get())
         
+        # also write the text tables (.txt) next to the HDF5 file of a run
+        self.export_text = False
+
+        # PNGs of finished runs are rendered in the background
+        # (see labcodes.acquisition.plotting)
+        self.plotter = PlotWorker()
+
         self.create_database_experiment_and_folders()
         
         # self.ask_what_to_do()
@@ -100,6 +109,8 @@ class AnritsuMeasurement:
         
 
     def take_screen_anritsu_all_traces(self):
+        from qcodes.dataset.measurements import Measurement
+
         # self.vna.active_trace.set(False)  # is this needed at all?
 
         # t1.trace.set("S22")
@@ -129,12 +140,16 @@ class AnritsuMeasurement:
         # actually get the data
         with meas.run() as datasaver:  # try to run the measurement (? but this doesn't yet write to the database)
         
+            # data and S-matrix element labels of all traces in one go; the
+            # formatted sweeps below are derived from these data
+            screen = self.vna.get_all_traces()
+
             data = []
-            for trace in traces:
+            for trace, trace_record in zip(traces, screen):
                 # self.vna.active_trace.set(n)  # there may be even 4 traces (S-matrix elements)
                 # self.vna.traces.tr1.run_sweep()
                 # smatrix_elem = self.vna.smatrix_elem()
-                tp = trace.trace_parameter()
+                tp = trace_record['parameter']
                 
                 imag = trace.imaginary()
                 real = trace.real()
@@ -151,18 +166,24 @@ class AnritsuMeasurement:
             datasaver.add_result(*data)
             dataid = datasaver.run_id
 
-        plot_by_id(dataid)
+        self.plotter.submit(dataid)
 
 
     def record_S21_sweep_power_sweep_frequency(self):
+        import qcodes as qc
+        from qcodes.dataset.measurements import Measurement
+        from labcodes.acquisition.export import export_run, export_text
+        from labcodes.acquisition.pipeline import run_pipelined
+        from labcodes.acquisition.storage import SweepWriter
         
         # -- setting vna parameters 
         # vna.sweep_mode.set('CONT')
-        self.vna.power.set(self.vnapower)
-        self.vna.center.set(self.center_frequency)
-        self.vna.span.set(self.frequency_span)
-        self.vna.points.set(self.numberofpoints)
-        self.vna.if_bandwidth.set(self.ifbandwidth)
+        # one message for all sweep settings, read back with one query
+        self.vna.configure(power=self.vnapower,
+                           center=self.center_frequency,
+                           span=self.frequency_span,
+                           points=self.numberofpoints,
+                           if_bandwidth=self.ifbandwidth)
         self.vna.trace.set(self.measuredtrace)
         self.vna.auto_sweep.set(False)
         
@@ -176,41 +197,51 @@ class AnritsuMeasurement:
         meas.register_parameter(self.vna.magnitude, setpoints=(self.vna.power,))  # now register the dependent one
     
         # -- taking data
+        #    the VNA sweeps the power list itself (one segment per power),
+        #    in blocks of as many powers as fit into one sweep. A worker
+        #    thread takes the next block while the last one is stored.
+        powers = np.linspace(self.powersweepstart, self.powersweepstop, self.powersweepnum, endpoint=True)
+        self.vna.active_trace.set(1)
+        blocks = [powers[chunk] for chunk in
+                  power_chunks(len(powers), self.vna.points(), self.vna.MAX_POINTS, self.vna.MAX_SEGMENTS)]
+
+        def store(block_powers, sweeps):
+            for power, sweep in zip(block_powers, sweeps):
+                writer.add_sweep((self.vna.magnitude, derive_format(sweep, 'MLOG')),
+                                 (self.vna.phase, derive_format(sweep, 'PHAS')),
+                                 (self.vna.real, derive_format(sweep, 'REAL')),
+                                 (self.vna.imaginary, derive_format(sweep, 'IMAG')),
+                                 (self.vna.power, power))
+
+        #    Every sweep is written to the database as it arrives, in batches
+        #    of a few sweeps (see labcodes.acquisition.storage)
         with meas.run() as datasaver:
-            for v1 in np.linspace(self.powersweepstart, self.powersweepstop, self.powersweepnum, endpoint=True):
-                self.vna.active_trace.set(1)
-                
-                power = self.vna.power.set(v1)
-                
-                print(self.vna.power.get())  # check
-                
-                #vna.auto_sweep.set(False)
-                #vna.auto_sweep.set(True)            
-                self.vna.traces.tr1.run_sweep()#some bug not taking the last row therefore two sweeps
-    
-                #power=vna.power()
-                #vna.auto_sweep.set(False)
-                imag = self.vna.imaginary() 
-                real = self.vna.real()
-                phase = self.vna.phase()            
-                mag = self.vna.magnitude()
-    
-                #vna.active_trace.set(2)
-                #vna.traces.tr2.run_sweep()
-                power = self.vna.power()  # should still be the same as a few lines above
-                
-                #time.sleep(2)
-                datasaver.add_result((self.vna.magnitude, mag),
-                                     (self.vna.phase, phase),
-                                     (self.vna.real, real),
-                                     (self.vna.imaginary, imag),
-                                     (self.vna.power, power))
-                
-                print(self.vna.power.get())
-                
-        plot_by_id(datasaver.run_id)
-
-        self.set_of_parameter_data = datasaver.dataset.get_parameter_data()
+            writer = SweepWriter(datasaver, batch_size=10)
+            run_pipelined(blocks,
+                          lambda block_powers: self.vna.power_sweep(block_powers, trace=self.vna.traces.tr1),
+                          store)
+
+        # one compressed HDF5 file per run with the complex data, power,
+        # frequency and the instrument snapshot, written chunk by chunk
+        # (see labcodes.acquisition.export). The text tables of earlier
+        # versions are made from it only if asked for. It goes next to
+        # the database, like the PNGs.
+        h5_path = os.path.join(os.path.dirname(os.path.abspath(qc.config["core"]["db_location"])),
+                               str(datasaver.run_id)+'_powersweep' +
+                               '_'+str(self.exp_name)+'.h5')
+        export_run(datasaver.dataset, h5_path,
+                   {self.measuredtrace: (self.vna_name + "_tr1_real", self.vna_name + "_tr1_imaginary")})
+        if self.export_text:
+            export_text(h5_path, self.measuredtrace, layout='rows')
+
+        # the PNGs are drawn from the min/max envelopes in the HDF5 file
+        self.plotter.submit(datasaver.run_id,
+                            prefix=str(datasaver.run_id)+'_powersweep'+'_'+str(self.exp_name),
+                            envelopes=h5_path)
+
+        # read it back sweep by sweep with iter_sweep_chunks, rather than
+        # all at once with get_parameter_data()
+        self.dataset = datasaver.dataset
 
 
     def ask_what_to_do(self):
@@ -234,6 +265,9 @@ class AnritsuMeasurement:
 
 
     def create_database_experiment_and_folders(self):
+        import qcodes as qc
+        from qcodes.dataset.experiment_container import load_experiment_by_name, new_experiment
+
         # -- set the path where the raw data should be saved to (pngs, txts)
         # self.raw_path = ('C:\\Users\\nanospin\\Nextcloud\\Lab-Shared\\measurements\\chris\\keysight_tests_data' +
         #                  '\\' + self.cooldown_date + '_' + self.sample_name + '\\'
@@ -31,6 +31,8 @@ logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
 from qcodes.instrument.base import Instrument
+
+from labcodes.acquisition.maps import power_frequency_map
 # from pathlib import Path
 
 
@@ -370,26 +372,22 @@ class MeasurementClass:
             
         x = datasaver.dataset.get_parameter_data()
             
-        self.export = np.zeros(((self.numberofpoints)*(self.powersweepnum), 6))
-        self.export[:,0] = list(x['VNA_tr1_magnitude']['VNA_tr1_frequency'])
-        self.export[:,1] = list(x['VNA_tr1_magnitude']['VNA_tr1_magnitude'])
-        self.export[:,2] = list(x['VNA_tr1_phase']['VNA_tr1_phase'])
-        self.export[:,3] = list(x['VNA_tr1_real']['VNA_tr1_real'])
-        self.export[:,4] = list(x['VNA_tr1_imaginary']['VNA_tr1_imaginary'])
-        self.export[:,5] = list(x['VNA_tr1_imaginary']['VNA_power'])
-        
-        table_ampl = np.zeros((self.numberofpoints + 1, self.powersweepnum+1))
-        table_phase = np.zeros((self.numberofpoints + 1, self.powersweepnum+1))
-        table_ampl[1:(self.numberofpoints + 1), 0] = self.export[0:(self.numberofpoints), 0]
-        table_ampl[0, 1:(self.powersweepnum + 1)] = self.export[0:(len(self.export[:,0]) - 1):self.numberofpoints, 5]
-        table_phase[1:(self.numberofpoints + 1), 0] = self.export[0:(self.numberofpoints), 0]
-        table_phase[0, 1:(self.powersweepnum + 1)] = self.export[0:(len(self.export[:,0]) - 1):self.numberofpoints, 5]
-        
-        for i in range(self.powersweepnum):
-            table_ampl[1:(self.numberofpoints + 1), i + 1] = self.export[(self.numberofpoints*i):(self.numberofpoints*(i + 1)), 1]
-            ampl = table_ampl[1:(self.numberofpoints + 1), i + 1]
-            table_phase[1:(self.numberofpoints + 1), i + 1] = self.export[(self.numberofpoints*i):(self.numberofpoints*(i + 1)), 2]
-            phase=table_phase[1:(self.numberofpoints + 1), i + 1]
+        self.export = np.column_stack([np.ravel(x['VNA_tr1_magnitude']['VNA_tr1_frequency']),
+                                       np.ravel(x['VNA_tr1_magnitude']['VNA_tr1_magnitude']),
+                                       np.ravel(x['VNA_tr1_phase']['VNA_tr1_phase']),
+                                       np.ravel(x['VNA_tr1_real']['VNA_tr1_real']),
+                                       np.ravel(x['VNA_tr1_imaginary']['VNA_tr1_imaginary']),
+                                       np.ravel(x['VNA_tr1_imaginary']['VNA_power'])])
+        
+        # (power, frequency) maps: reshaped views of the dataset's columns, no loop over the powers
+        self.map_ampl = power_frequency_map(x['VNA_tr1_magnitude']['VNA_power'],
+                                            x['VNA_tr1_magnitude']['VNA_tr1_frequency'],
+                                            x['VNA_tr1_magnitude']['VNA_tr1_magnitude'],
+                                            points=self.numberofpoints)
+        self.map_phase = power_frequency_map(x['VNA_tr1_phase']['VNA_power'],
+                                             x['VNA_tr1_phase']['VNA_tr1_frequency'],
+                                             x['VNA_tr1_phase']['VNA_tr1_phase'],
+                                             points=self.numberofpoints)
             
         np.savetxt(os.path.join(self.raw_path_with_date,
                      str(datasaver.run_id) + '_powersweep' + '_' + 
@@ -0,0 +1,135 @@
+import os
+
+from labcodes.drivers.sweep_data import derive_format
+
+# qcodes, the drivers and the acquisition modules take seconds to import;
+# they are imported where they are used (see the other measurement scripts)
+
+import logging  # general logging package
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+
+class CombinedMeasurement:
+    """ Measure with the Anritsu and the Keysight VNA at the same time,
+        into one dataset """
+
+    def __init__(self, anritsu_vna, keysight_vna):
+        """ anritsu_vna, keysight_vna: the qcodes drivers of the two VNAs
+            (set up e.g. as in __main__ below). The database and the
+            experiment are set up once, here, for both of them. """
+        from labcodes.acquisition.plotting import PlotWorker
+
+        self.vnas = {'anritsu': anritsu_vna, 'keysight': keysight_vna}
+
+        # -- name the experiment -> automatic file names
+        self.exp_name = 'Combined_test'  # name used by qcodes
+        self.cooldown_date = '20-09-22'
+        self.sample_name = 'test_sample'
+
+        # -- set experiment parameters (sweep settings of each VNA, see configure())
+        self.settings = {
+            'anritsu': dict(power=13, start=3.4e9, stop=7.4e9, points=2001, if_bandwidth=100),
+            'keysight': dict(power=-30, start=3e9, stop=10.e9, points=200, if_bandwidth=10)}
+        self.measuredtrace = 'S21'  # spectral density measured between port 1 and 2
+        self.num_repetitions = 1  # number of sweep pairs to record
+
+        # PNGs of finished runs are rendered in the background
+        # (see labcodes.acquisition.plotting)
+        self.plotter = PlotWorker()
+
+        self.create_database_experiment_and_folders()
+
+    def record_S21_both(self):
+        """ records S21 with both VNAs concurrently: both sweeps start at
+            the same time (see labcodes.acquisition.coordinator), and every
+            pair of sweeps is stored as one result. """
+        from qcodes.dataset.measurements import Measurement
+        from labcodes.acquisition.coordinator import run_concurrently
+
+        vnas = self.vnas
+
+        # -- setting vna parameters
+        for name, vna in vnas.items():
+            vna.configure(**self.settings[name])
+            vna.trace.set(self.measuredtrace)
+            vna.auto_sweep.set(False)
+        for vna in vnas.values():
+            # query the frequencies (setpoints) now: while the workers run,
+            # only they may talk to their VNA
+            vna.sweep_geometry.frequencies
+
+        meas = Measurement(exp=self.exp)
+        meas.register_custom_parameter('repetition', label='Repetition')
+        for vna in vnas.values():
+            meas.register_parameter(vna.magnitude, setpoints=('repetition',))
+            meas.register_parameter(vna.phase, setpoints=('repetition',))
+
+        def sweep(vna):
+            # runs in the worker thread of this VNA
+            def acquire(repetition):
+                vna.traces[0].run_sweep()
+                return vna.traces[0].sweep_data()
+            return acquire
+
+        def store(repetition, data):
+            results = [('repetition', repetition)]
+            for name, vna in vnas.items():
+                results.append((vna.magnitude, derive_format(data[name], 'MLOG')))
+                results.append((vna.phase, derive_format(data[name], 'PHAS')))
+            datasaver.add_result(*results)
+
+        # -- taking data
+        with meas.run() as datasaver:
+            stats = run_concurrently({name: sweep(vna) for name, vna in vnas.items()},
+                                     range(self.num_repetitions), store)
+
+        print("{} sweep pairs in {:.1f} s".format(stats.steps, stats.duration))
+        self.plotter.submit(datasaver.run_id)
+
+    def create_database_experiment_and_folders(self):
+        import qcodes as qc
+        from qcodes.dataset.experiment_container import load_experiment_by_name, new_experiment
+
+        # set the .db path
+        qc.config["core"]["db_location"] = (
+            os.path.join('C:\\Users\\nanospin\\Desktop\\test.db'))
+
+        # -- check if in the standard folder -see qcodes config file- an experiment with exp_name already exists
+        #    if not, create a new folder at path
+        #    if so, just print the last exp. ID and go on
+        try:
+            # qcodes interface of loading an experiment:
+            # -- tries to connect to a database (specificed in config data structure) and searches for the exp_name
+            self.exp = load_experiment_by_name(
+                self.exp_name, sample=self.sample_name)
+            # keep track of the experiment number
+            print('Experiment loaded. Last ID no: ', self.exp.last_counter)
+            print('Database: ', qc.config["core"]["db_location"])
+        except ValueError:
+            print("Experiment name `", self.exp_name, "` with sample name `", self.sample_name, "` not found in ",
+                  qc.config["core"]["db_location"])
+
+            print('Starting new experiment.')
+            self.exp = new_experiment(self.exp_name, self.sample_name)
+
+
+if __name__ == '__main__':
+    from qcodes.instrument.base import Instrument
+    from labcodes.drivers.Anritsu_MS46522B import Anritsu_MS46522B
+    from labcodes.drivers.Keysight_P9373A import Keysight_P9373A
+
+    # -- check if the instruments already exist. If not, create them
+    #    (same addresses and limits as in the Anritsu and Keysight scripts)
+    if Instrument.exist('VNA_Anritsu', Anritsu_MS46522B):
+        anritsu_vna = Instrument.find_instrument('VNA_Anritsu', Anritsu_MS46522B)
+    else:
+        anritsu_vna = Anritsu_MS46522B('VNA_Anritsu', "TCPIP0::169.254.235.118::5001::SOCKET",
+                                       50e6, 20e9, -30, 30, 2)
+    if Instrument.exist('VNA_Keysight', Keysight_P9373A):
+        keysight_vna = Instrument.find_instrument('VNA_Keysight', Keysight_P9373A)
+    else:
+        keysight_vna = Keysight_P9373A('VNA_Keysight', "TCPIP0::maip-franck::hislip0,4880::INSTR",
+                                       300e3, 13.5e9, -90, 13, 2)
+
+    cm = CombinedMeasurement(anritsu_vna, keysight_vna)
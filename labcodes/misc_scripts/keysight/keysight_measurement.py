@@ -1,18 +1,16 @@
-from qcodes.instrument.base import Instrument
-from labcodes.drivers.Keysight_P9373A import Keysight_P9373A
-
-import qcodes as qc
 import os
 import time
 from datetime import date
 
-from qcodes.dataset.measurements import Measurement  # , DataSaver
-from qcodes.dataset.plotting import plot_by_id
-# , experiments, load_experiment
-from qcodes.dataset.experiment_container import load_experiment_by_name, new_experiment
-import matplotlib.pyplot as plt
 import numpy as np
 
+from labcodes.drivers.segments import power_chunks
+from labcodes.drivers.sweep_data import derive_format
+
+# qcodes, the driver and the acquisition modules (matplotlib, h5py) take
+# seconds to import; they are imported where they are used, so that
+# importing this module (e.g. in a notebook) is fast
+
 import logging  # general logging package
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -28,6 +26,10 @@ class KeysightMeasurement:
 
         # import pdb; pdb.set_trace()  # noqa BREAKPOINT
 
+        from qcodes.instrument.base import Instrument
+        from labcodes.drivers.Keysight_P9373A import Keysight_P9373A
+        from labcodes.acquisition.plotting import PlotWorker
+
         self.vna_name = 'VNA_Keysight'
         # this is a qcodes VisaInstrument (interface between visa and qcodes)
         self.vna_class = Keysight_P9373A
@@ -65,10 +67,16 @@ class KeysightMeasurement:
         self.powersweepstop = 13  # stop for powersweep
         # number of power sweeps (perhaps +/-1) MUST BE AN EVEN NUMBER AT LEAST 6
         self.num_power_points = 3
+        # also write the text tables (.txt) next to the HDF5 file of a run
+        self.export_text = False
         # groupdelayref=0.0000000225
         # vna.groupdelay.set(groupdelayref)#resets to 0 instead of working -> rounding to 0
         # print(vna.groupdelay.get())
 
+        # PNGs of finished runs are rendered in the background
+        # (see labcodes.acquisition.plotting)
+        self.plotter = PlotWorker()
+
         self.create_database_experiment_and_folders()
 
         # self.choose_sequence()
@@ -77,6 +85,7 @@ class KeysightMeasurement:
         """ takes a frequency sweep, not setting any values on the hardware """
 
         from qcodes import Station
+        from qcodes.dataset.measurements import Measurement
 
         station = Station()
         station.add_component(self.vna)
@@ -111,23 +120,30 @@ class KeysightMeasurement:
 
             dataid = datasaver.run_id
 
-        pd = datasaver.dataset.get_parameter_data()
         snapshot = datasaver.dataset.snapshot
 
-        plot_by_id(dataid)
+        # the PNGs go next to the database (raw_path_with_date is not set up)
+        self.plotter.submit(dataid, prefix=str(dataid)+'_buffer'+'_'+str(self.exp_name))
 
     def record_S21_sweep_power_sweep_frequency(self):
+        import qcodes as qc
+
         # -- setting vna parameters
         # vna.sweep_mode.set('CONT')
-        self.vna.power.set(self.vnapower)
-        self.vna.center.set(self.center_frequency)
-        self.vna.span.set(self.frequency_span)
-        self.vna.points.set(self.num_freq_points)
-        self.vna.if_bandwidth.set(self.ifbandwidth)
+        # one message for all sweep settings, read back with one query
+        self.vna.configure(power=self.vnapower,
+                           center=self.center_frequency,
+                           span=self.frequency_span,
+                           points=self.num_freq_points,
+                           if_bandwidth=self.ifbandwidth)
         self.vna.trace.set(self.measuredtrace)
         self.vna.auto_sweep.set(False)
         
         from qcodes import Station
+        from qcodes.dataset.measurements import Measurement
+        from labcodes.acquisition.export import export_run, export_text
+        from labcodes.acquisition.pipeline import run_pipelined
+        from labcodes.acquisition.storage import SweepWriter
 
         station = Station()
         station.add_component(self.vna)
@@ -150,91 +166,101 @@ class KeysightMeasurement:
             self.vna.power,))  # now register the dependent one
 
         # -- taking data
+        #    the VNA sweeps the power list itself (one segment per power),
+        #    in blocks of as many powers as fit into one sweep. A worker
+        #    thread takes the next block while the last one is stored.
+        powers = np.linspace(self.powersweepstart, self.powersweepstop, self.num_power_points, endpoint=True)
+        self.vna.active_trace.set(1)
+        blocks = [powers[chunk] for chunk in
+                  power_chunks(len(powers), self.vna.points(), self.vna.MAX_POINTS, self.vna.MAX_SEGMENTS)]
+
+        def store(block_powers, sweeps):
+            for power, sweep in zip(block_powers, sweeps):
+                writer.add_sweep((self.vna.magnitude, derive_format(sweep, 'MLOG')),
+                                 (self.vna.phase, derive_format(sweep, 'PHAS')),
+                                 (self.vna.real, derive_format(sweep, 'REAL')),
+                                 (self.vna.imaginary, derive_format(sweep, 'IMAG')),
+                                 (self.vna.power, power))
+
+        #    Every sweep is written to the database as it arrives, in batches
+        #    of a few sweeps (see labcodes.acquisition.storage)
         with meas.run() as datasaver:
-            for v1 in np.linspace(self.powersweepstart, self.powersweepstop, self.num_power_points, endpoint=True):
-                self.vna.active_trace.set(1)
-
-                power = self.vna.power.set(v1)
-
-                print(self.vna.power.get())  # check
-
-                # vna.auto_sweep.set(False)
-                # vna.auto_sweep.set(True)
-                # some bug not taking the last row therefore two sweeps
-                self.vna.traces.tr1.run_sweep()
-
-                # power=vna.power()
-                # vna.auto_sweep.set(False)
-                imag = self.vna.imaginary()
-                real = self.vna.real()
-                phase = self.vna.phase()
-                mag = self.vna.magnitude()
-
-                # vna.active_trace.set(2)
-                # vna.traces.tr2.run_sweep()
-                power = self.vna.power()  # should still be the same as a few lines above
-
-                # time.sleep(2)
-                datasaver.add_result((self.vna.magnitude, mag),
-                                     (self.vna.phase, phase),
-                                     (self.vna.real, real),
-                                     (self.vna.imaginary, imag),
-                                     (self.vna.power, power))
+            writer = SweepWriter(datasaver, batch_size=10)
+            run_pipelined(blocks,
+                          lambda block_powers: self.vna.power_sweep(block_powers, trace=self.vna.traces.tr1),
+                          store)
+
+        # one compressed HDF5 file per run with the complex data, power,
+        # frequency and the instrument snapshot, written chunk by chunk
+        # (see labcodes.acquisition.export). The text tables of earlier
+        # versions are made from it only if asked for. It goes next to
+        # the database, like the PNGs.
+        h5_path = os.path.join(os.path.dirname(os.path.abspath(qc.config["core"]["db_location"])),
+                               str(datasaver.run_id)+'_powersweep' +
+                               '_'+str(self.exp_name)+'.h5')
+        export_run(datasaver.dataset, h5_path,
+                   {self.measuredtrace: (self.vna_name + "_tr1_real", self.vna_name + "_tr1_imaginary")})
+        if self.export_text:
+            export_text(h5_path, self.measuredtrace, layout='rows')
+
+        # the PNGs are drawn from the min/max envelopes in the HDF5 file
+        self.plotter.submit(datasaver.run_id,
+                            prefix=str(datasaver.run_id)+'_powersweep'+'_'+str(self.exp_name),
+                            envelopes=h5_path)
+
+    def record_S21_adaptive_resonances(self):
+        """ searches the frequency range for resonances: a fast coarse sweep,
+            then narrow high resolution sweeps around every resonance found
+            (see labcodes.acquisition.adaptive). The merged data, with
+            non-uniform frequency points, are saved as one run. """
+        from qcodes.dataset.measurements import Measurement
+        from labcodes.acquisition.adaptive import AdaptiveResonanceSweep
 
-                print(self.vna.power.get())
-
-        plot_by_id(datasaver.run_id)
-
-        pd = datasaver.dataset.get_parameter_data()
-
-        # import pdb; pdb.set_trace()  # noqa BREAKPOINT
-
-        magnitude_table = np.vstack((np.ravel(pd[self.vna_name + "_tr1_magnitude"][self.vna_name + "_power"]),
-                                     np.ravel(pd[self.vna_name + "_tr1_magnitude"][self.vna_name + "_tr1_frequency"]),
-                                     np.ravel(pd[self.vna_name + "_tr1_magnitude"][self.vna_name + "_tr1_magnitude"])))
-
-        phase_table = np.vstack((np.ravel(pd[self.vna_name + "_tr1_phase"][self.vna_name + "_power"]),
-                                 np.ravel(pd[self.vna_name + "_tr1_phase"][self.vna_name + "_tr1_frequency"]),
-                                 np.ravel(pd[self.vna_name + "_tr1_phase"][self.vna_name + "_tr1_phase"])))
-
-        real_table = np.vstack((np.ravel(pd[self.vna_name + "_tr1_real"][self.vna_name + "_power"]),
-                                np.ravel(pd[self.vna_name + "_tr1_real"][self.vna_name + "_tr1_frequency"]),
-                                np.ravel(pd[self.vna_name + "_tr1_real"][self.vna_name + "_tr1_real"])))
+        self.vna.power.set(self.vnapower)
+        self.vna.trace.set(self.measuredtrace)
+        self.vna.auto_sweep.set(False)
 
-        imaginary_table = np.vstack((np.ravel(pd[self.vna_name + "_tr1_imaginary"][self.vna_name + "_power"]),
-                                     np.ravel(pd[self.vna_name + "_tr1_imaginary"][self.vna_name + "_tr1_frequency"]),
-                                     np.ravel(pd[self.vna_name + "_tr1_imaginary"][self.vna_name + "_tr1_imaginary"])))
+        engine = AdaptiveResonanceSweep(self.vna, trace=self.vna.traces.tr1,
+                                        zoom_if_bandwidth=self.ifbandwidth)
+        result = engine.run(self.start_frequency, self.stop_frequency)
 
-        np.savetxt(os.path.join(self.raw_path_with_date,
-                                str(datasaver.run_id)+'_powersweep' +
-                                '_'+str(self.exp_name)+'_magnitude.txt'),
-                   magnitude_table)
+        for feature in sorted(result.features):
+            print("resonance candidate at {:.6f} GHz (score {:.0f})".format(
+                feature.frequency / 1e9, feature.score))
+        print("{} points in {} sweeps, {:.1f} s".format(
+            len(result.frequencies), len(result.sweeps),
+            sum(sweep.duration for sweep in result.sweeps)))
 
-        np.savetxt(os.path.join(self.raw_path_with_date,
-                                str(datasaver.run_id)+'_powersweep'+'_' +
-                                str(self.exp_name)+'_phase.txt'),
-                   phase_table)
+        meas = Measurement()
+        meas.register_custom_parameter('frequency', label='Frequency',
+                                       unit='Hz', paramtype='array')
+        meas.register_custom_parameter('magnitude', label='Magnitude',
+                                       unit='dB', setpoints=('frequency',),
+                                       paramtype='array')
+        meas.register_custom_parameter('phase', label='Phase', unit='deg',
+                                       setpoints=('frequency',),
+                                       paramtype='array')
 
-        np.savetxt(os.path.join(self.raw_path_with_date,
-                                str(datasaver.run_id)+'_powersweep' +
-                                '_'+str(self.exp_name)+'_real.txt'),
-                   real_table)
+        with meas.run() as datasaver:
+            datasaver.add_result(('frequency', result.frequencies),
+                                 ('magnitude', derive_format(result.data, 'MLOG')),
+                                 ('phase', derive_format(result.data, 'PHAS')))
 
-        np.savetxt(os.path.join(self.raw_path_with_date,
-                                str(datasaver.run_id)+'_powersweep' +
-                                '_'+str(self.exp_name)+'_imaginary.txt'),
-                   imaginary_table)
+        self.plotter.submit(datasaver.run_id,
+                            prefix=str(datasaver.run_id)+'_adaptive'+'_'+str(self.exp_name))
 
     def choose_sequence(self):
         print("self.vna.power.get(): ", self.vna.power.get())
         program_part = int(input(
-            "Choose a sequence: \n  1. take_buffer_keysight \n  2. record S21, sweep power and frequency\n"))
+            "Choose a sequence: \n  1. take_buffer_keysight \n  2. record S21, sweep power and frequency\n  3. record S21, adaptive resonance search\n"))
         time.sleep(1)
 
         if program_part == 1:
             self.take_buffer_keysight()
         elif program_part == 2:
             self.record_S21_sweep_power_sweep_frequency()
+        elif program_part == 3:
+            self.record_S21_adaptive_resonances()
         else:
             print("wrong choice")
             exit(1)
@@ -244,6 +270,9 @@ class KeysightMeasurement:
         print("self.vna.points.get(): ", self.vna.points.get())
 
     def create_database_experiment_and_folders(self):
+        import qcodes as qc
+        from qcodes.dataset.experiment_container import load_experiment_by_name, new_experiment
+
         # -- set the path where the raw data should be saved to (pngs, txts)
         # self.raw_path = ('C:\\Users\\nanospin\\Nextcloud\\Lab-Shared\\measurements\\chris\\keysight_tests_data' +
         #                  '\\' + self.cooldown_date + '_' + self.sample_name + '\\'
@@ -7,12 +7,17 @@ import time
 from datetime import date
 
 from qcodes.dataset.measurements import Measurement  # , DataSaver
-from qcodes.dataset.plotting import plot_by_id
 # , experiments, load_experiment
 from qcodes.dataset.experiment_container import load_experiment_by_name, new_experiment
-import matplotlib.pyplot as plt
 import numpy as np
 
+from labcodes.acquisition.export import export_run, export_text
+from labcodes.acquisition.pipeline import run_pipelined
+from labcodes.acquisition.plotting import PlotWorker
+from labcodes.acquisition.storage import SweepWriter
+from labcodes.drivers.segments import power_chunks
+from labcodes.drivers.sweep_data import derive_format
+
 import logging  # general logging package
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -26,8 +31,6 @@ class KeysightMeasurement:
             3. specify paths of the target files: 
                database file and a new folder with raw (txt, png) files """
 
-        import pdb; pdb.set_trace()  # noqa BREAKPOINT
-
         self.vna_name = 'VNA_Keysight'
         # this is a qcodes VisaInstrument (interface between visa and qcodes)
         self.vna_class = Keysight_P9373A
@@ -65,11 +68,17 @@ class KeysightMeasurement:
         self.powersweepstop = 13  # stop for powersweep
         # number of power sweeps (perhaps +/-1) MUST BE AN EVEN NUMBER AT LEAST 6
         self.num_power_points = 3
+        # also write the text tables (.txt) next to the HDF5 file of a run
+        self.export_text = False
         # groupdelayref=0.0000000225
         # vna.groupdelay.set(groupdelayref)#resets to 0 instead of working -> rounding to 0
         # print(vna.groupdelay.get())
 
 
+        # PNGs of finished runs are rendered in the background
+        # (see labcodes.acquisition.plotting)
+        self.plotter = PlotWorker()
+
         self.create_database_experiment_and_folders()
 
         self.ask_what_to_do()
@@ -81,16 +90,20 @@ class KeysightMeasurement:
             set in kwargs, which are set in the instrument before performing 
             the sweep. """
 
-        for key, value in kwargs.items():
+        for key in kwargs:
             # check if the qcodes driver has this parameter
-            self.vna.
-            self.driver_exposed_parameters = __dict__.update(kwargs)
+            if key not in self.vna.parameters:
+                raise KeyError("{} has no parameter {}".format(self.vna_name, key))
         
         self.vna.power(self.vnapower)
         self.vna.start(self.start_frequency)
         self.vna.stop(self.stop_frequency)
         self.vna.points(self.num_freq_points)
         self.vna.trace(self.measuredtrace)
+
+        # the values given in kwargs take precedence over the defaults
+        for key, value in kwargs.items():
+            self.vna.parameters[key](value)
         
         # num_freq_points = self.vna.points.get()  # get current number of points from VNA settings
 
@@ -123,51 +136,28 @@ class KeysightMeasurement:
 
             dataid = datasaver.run_id
 
-        pd = datasaver.dataset.get_parameter_data()
-
-        plot_by_id(dataid)
-
-        export = np.zeros((self.num_freq_points, 5))
-
-        export[:, 0] = pd[self.vna_name +
-                         "_tr1_magnitude"][self.vna_name + '_tr1_frequency'][0]
-        export[:, 1] = pd[self.vna_name +
-                         '_tr1_magnitude'][self.vna_name + '_tr1_magnitude'][0]
-        export[:, 2] = pd[self.vna_name +
-                         '_tr1_phase'][self.vna_name + '_tr1_phase'][0]
-        export[:, 3] = pd[self.vna_name +
-                         '_tr1_real'][self.vna_name + '_tr1_real'][0]
-        export[:, 4] = pd[self.vna_name +
-                         '_tr1_imaginary'][self.vna_name + '_tr1_imaginary'][0]
-
-        np.savetxt(os.path.join(self.raw_path_with_date,
-                                str(datasaver.run_id)+'_nosweep' +
-                                '_'+str(self.exp_name)+'.txt'),
-                   export)
-
-        plt.plot(export[:, 0], export[:, 1])
-        plt.xlabel('Frequency (Hz)')
-        plt.ylabel('Magnitude (dB)')
-        plt.savefig(os.path.join(self.raw_path_with_date,
-                                 str(datasaver.run_id)+'_nosweep' +
-                                 '_'+str(self.exp_name)+'_magnitude.png'))
-
-        plt.cla()
-        plt.plot(export[:, 0], export[:, 2])
-        plt.xlabel('Frequency (Hz)')
-        plt.ylabel('Phase (deg)')
-        plt.savefig(os.path.join(self.raw_path_with_date,
-                                 str(datasaver.run_id)+'_nosweep' +
-                                 '_'+str(self.exp_name)+'_phase.png'))
+        h5_path = os.path.join(self.raw_path_with_date,
+                               str(datasaver.run_id)+'_nosweep' +
+                               '_'+str(self.exp_name)+'.h5')
+        export_run(datasaver.dataset, h5_path,
+                   {self.measuredtrace: (self.vna_name + "_tr1_real", self.vna_name + "_tr1_imaginary")},
+                   points=self.num_freq_points)
+        if self.export_text:
+            export_text(h5_path, self.measuredtrace, layout='columns')
+
+        self.plotter.submit(datasaver.run_id, self.raw_path_with_date,
+                            str(datasaver.run_id)+'_nosweep'+'_'+str(self.exp_name),
+                            envelopes=h5_path)
 
     def record_S21_sweep_power_sweep_frequency(self):
         # -- setting vna parameters
         # vna.sweep_mode.set('CONT')
-        self.vna.power.set(self.vnapower)
-        self.vna.center.set(self.center_frequency)
-        self.vna.span.set(self.frequency_span)
-        self.vna.points.set(self.num_freq_points)
-        self.vna.if_bandwidth.set(self.ifbandwidth)
+        # one message for all sweep settings, read back with one query
+        self.vna.configure(power=self.vnapower,
+                           center=self.center_frequency,
+                           span=self.frequency_span,
+                           points=self.num_freq_points,
+                           if_bandwidth=self.ifbandwidth)
         self.vna.trace.set(self.measuredtrace)
         self.vna.auto_sweep.set(False)
 
@@ -186,80 +176,46 @@ class KeysightMeasurement:
             self.vna.power,))  # now register the dependent one
 
         # -- taking data
+        #    the VNA sweeps the power list itself (one segment per power),
+        #    in blocks of as many powers as fit into one sweep. A worker
+        #    thread takes the next block while the last one is stored.
+        powers = np.linspace(self.powersweepstart, self.powersweepstop, self.num_power_points, endpoint=True)
+        self.vna.active_trace.set(1)
+        blocks = [powers[chunk] for chunk in
+                  power_chunks(len(powers), self.vna.points(), self.vna.MAX_POINTS, self.vna.MAX_SEGMENTS)]
+
+        def store(block_powers, sweeps):
+            for power, sweep in zip(block_powers, sweeps):
+                writer.add_sweep((self.vna.magnitude, derive_format(sweep, 'MLOG')),
+                                 (self.vna.phase, derive_format(sweep, 'PHAS')),
+                                 (self.vna.real, derive_format(sweep, 'REAL')),
+                                 (self.vna.imaginary, derive_format(sweep, 'IMAG')),
+                                 (self.vna.power, power))
+
+        #    Every sweep is written to the database as it arrives, in batches
+        #    of a few sweeps (see labcodes.acquisition.storage)
         with meas.run() as datasaver:
-            for v1 in np.linspace(self.powersweepstart, self.powersweepstop, self.num_power_points, endpoint=True):
-                self.vna.active_trace.set(1)
-
-                power = self.vna.power.set(v1)
-
-                print(self.vna.power.get())  # check
-
-                # vna.auto_sweep.set(False)
-                # vna.auto_sweep.set(True)
-                # some bug not taking the last row therefore two sweeps
-                self.vna.traces.tr1.run_sweep()
-
-                # power=vna.power()
-                # vna.auto_sweep.set(False)
-                imag = self.vna.imaginary()
-                real = self.vna.real()
-                phase = self.vna.phase()
-                mag = self.vna.magnitude()
-
-                # vna.active_trace.set(2)
-                # vna.traces.tr2.run_sweep()
-                power = self.vna.power()  # should still be the same as a few lines above
-
-                # time.sleep(2)
-                datasaver.add_result((self.vna.magnitude, mag),
-                                     (self.vna.phase, phase),
-                                     (self.vna.real, real),
-                                     (self.vna.imaginary, imag),
-                                     (self.vna.power, power))
-
-                print(self.vna.power.get())
-
-        plot_by_id(datasaver.run_id)
-
-        pd = datasaver.dataset.get_parameter_data()
-
-        # import pdb; pdb.set_trace()  # noqa BREAKPOINT
-
-        magnitude_table = np.vstack((np.ravel(pd[self.vna_name + "_tr1_magnitude"][self.vna_name + "_power"]),
-                                     np.ravel(pd[self.vna_name + "_tr1_magnitude"][self.vna_name + "_tr1_frequency"]),
-                                     np.ravel(pd[self.vna_name + "_tr1_magnitude"][self.vna_name + "_tr1_magnitude"])))
-
-        phase_table = np.vstack((np.ravel(pd[self.vna_name + "_tr1_phase"][self.vna_name + "_power"]),
-                                 np.ravel(pd[self.vna_name + "_tr1_phase"][self.vna_name + "_tr1_frequency"]),
-                                 np.ravel(pd[self.vna_name + "_tr1_phase"][self.vna_name + "_tr1_phase"])))
-
-        real_table = np.vstack((np.ravel(pd[self.vna_name + "_tr1_real"][self.vna_name + "_power"]),
-                                np.ravel(pd[self.vna_name + "_tr1_real"][self.vna_name + "_tr1_frequency"]),
-                                np.ravel(pd[self.vna_name + "_tr1_real"][self.vna_name + "_tr1_real"])))
-
-        imaginary_table = np.vstack((np.ravel(pd[self.vna_name + "_tr1_imaginary"][self.vna_name + "_power"]),
-                                     np.ravel(pd[self.vna_name + "_tr1_imaginary"][self.vna_name + "_tr1_frequency"]),
-                                     np.ravel(pd[self.vna_name + "_tr1_imaginary"][self.vna_name + "_tr1_imaginary"])))
-
-        np.savetxt(os.path.join(self.raw_path_with_date,
-                                str(datasaver.run_id)+'_powersweep' +
-                                '_'+str(self.exp_name)+'_magnitude.txt'),
-                   magnitude_table)
-
-        np.savetxt(os.path.join(self.raw_path_with_date,
-                                str(datasaver.run_id)+'_powersweep'+'_' +
-                                str(self.exp_name)+'_phase.txt'),
-                   phase_table)
-
-        np.savetxt(os.path.join(self.raw_path_with_date,
-                                str(datasaver.run_id)+'_powersweep' +
-                                '_'+str(self.exp_name)+'_real.txt'),
-                   real_table)
-
-        np.savetxt(os.path.join(self.raw_path_with_date,
-                                str(datasaver.run_id)+'_powersweep' +
-                                '_'+str(self.exp_name)+'_imaginary.txt'),
-                   imaginary_table)
+            writer = SweepWriter(datasaver, batch_size=10)
+            run_pipelined(blocks,
+                          lambda block_powers: self.vna.power_sweep(block_powers, trace=self.vna.traces.tr1),
+                          store)
+
+        # one compressed HDF5 file per run with the complex data, power,
+        # frequency and the instrument snapshot, written chunk by chunk
+        # (see labcodes.acquisition.export). The text tables of earlier
+        # versions are made from it only if asked for.
+        h5_path = os.path.join(self.raw_path_with_date,
+                               str(datasaver.run_id)+'_powersweep' +
+                               '_'+str(self.exp_name)+'.h5')
+        export_run(datasaver.dataset, h5_path,
+                   {self.measuredtrace: (self.vna_name + "_tr1_real", self.vna_name + "_tr1_imaginary")})
+        if self.export_text:
+            export_text(h5_path, self.measuredtrace, layout='rows')
+
+        # the PNGs are drawn from the min/max envelopes in the HDF5 file
+        self.plotter.submit(datasaver.run_id, self.raw_path_with_date,
+                            str(datasaver.run_id)+'_powersweep'+'_'+str(self.exp_name),
+                            envelopes=h5_path)
 
     def ask_what_to_do(self):
         print("self.vna.power.get(): ", self.vna.power.get())